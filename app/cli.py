@@ -0,0 +1,506 @@
+"""
+Maintenance commands
+
+Usage:
+    python -m app.cli dedupe-addresses [--batch-size N]
+    python -m app.cli backfill-rollups [--tenant-id ID]
+    python -m app.cli export --tenant-id ID [--format parquet|arrow] [--from DATE] [--to DATE] [--out DIR]
+    python -m app.cli rfm [--tenant-id ID]
+    python -m app.cli benchmark-passwords [--seconds N]
+    python -m app.cli benchmark-auth [--iterations N]
+    python -m app.cli benchmark-inventory [--mode locked|flash_sale|both] [--stock N] [--orders N] [--threads N] [--cart-sizes 1,5,20]
+    python -m app.cli benchmark-checkout [--orders N] [--threads N] [--gateway-ms N]
+    python -m app.cli benchmark-rfm [--customers N] [--orders N]
+
+The benchmark-inventory, benchmark-checkout and benchmark-rfm commands write
+to the configured database: they create a scratch tenant and delete everything
+the tenant wrote when they finish.
+"""
+
+import argparse
+import datetime
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import sqlalchemy as sa
+
+from . import crud, models, schemas, security
+from .database import SessionLocal, engine
+from .logging_config import configure_logging
+from .migrations import apply_schema_upgrades
+from .services import export, passwords, payment, rfm
+
+logger = logging.getLogger(__name__)
+
+def dedupe_addresses(args):
+    db = SessionLocal()
+    try:
+        hashed, removed = crud.dedupe_customer_addresses(db, batch_size=args.batch_size)
+        logger.info(f"Address dedupe complete: {hashed} hashed, {removed} duplicates removed")
+    finally:
+        db.close()
+
+def backfill_rollups(args):
+    db = SessionLocal()
+    try:
+        crud.rebuild_sales_rollups(db, tenant_id=args.tenant_id)
+        scope = f"tenant {args.tenant_id}" if args.tenant_id is not None else "all tenants"
+        logger.info(f"Daily sales rollups rebuilt for {scope}")
+    finally:
+        db.close()
+
+def export_tables(args):
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    extension, _ = export.EXPORT_FORMATS[args.format]
+    db = SessionLocal()
+    try:
+        for table in export.EXPORT_TABLES:
+            path = out_dir / f"{table}.{extension}"
+            with open(path, "wb") as sink:
+                rows = sum(export.write_export(db, sink, table, args.tenant_id, args.format, args.date_from, args.date_to))
+            logger.info(f"Exported {rows} {table} rows to {path}")
+    finally:
+        db.close()
+
+def score_customers(args):
+    db = SessionLocal()
+    try:
+        if args.tenant_id is not None:
+            tenant_ids = [args.tenant_id]
+        else:
+            tenant_ids = [tenant.id for tenant in db.query(models.Tenant.id).order_by(models.Tenant.id)]
+        for tenant_id in tenant_ids:
+            rfm.refresh_customer_rfm(db, tenant_id)
+    finally:
+        db.close()
+
+def benchmark_passwords(args):
+    """Measure bcrypt logins/sec on one core and through the hashing pool"""
+    stored = passwords.pwd_context.hash("benchmark-password")
+    
+    started, verified = time.perf_counter(), 0
+    while time.perf_counter() - started < args.seconds:
+        passwords.pwd_context.verify("benchmark-password", stored)
+        verified += 1
+    per_core = verified / (time.perf_counter() - started)
+    
+    hasher = passwords.hasher
+    hasher.verify("benchmark-password", stored)  # Start the pool outside the timing
+    started, verified = time.perf_counter(), 0
+    with ThreadPoolExecutor(max_workers=max(hasher.workers, 1) * 2) as threads:
+        while time.perf_counter() - started < args.seconds:
+            verified += sum(threads.map(lambda _: hasher.verify("benchmark-password", stored), range(32)))
+    pooled = verified / (time.perf_counter() - started)
+    hasher.shutdown()
+    
+    logger.info(
+        f"bcrypt rounds={passwords.BCRYPT_ROUNDS}: {per_core:.1f} logins/sec per core, "
+        f"{pooled:.1f} logins/sec through {hasher.workers} pool workers"
+    )
+
+def benchmark_auth(args):
+    """Measure the claims auth dependency per request with and without the decoded token cache"""
+    class BenchmarkRequest:
+        def __init__(self, token):
+            self.headers = {"authorization": f"Bearer {token}"}
+    
+    user_id = -1  # Synthetic user, known only to this process's version map
+    security.token_versions.refresh()
+    security.token_versions.set(user_id, 0)
+    request = BenchmarkRequest(security.create_access_token(data={
+        "sub": "benchmark@example.com", "uid": user_id, "tid": 0, "role": models.Role.TENANT_ADMIN.value, "ver": 0
+    }))
+    
+    original_cache = security.token_cache
+    try:
+        for label, cache in (("uncached", security.DecodedTokenCache(0)), ("cached", security.DecodedTokenCache(16))):
+            security.token_cache = cache
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                security.get_current_claims(request)
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"Auth dependency {label}: {elapsed / args.iterations * 1e6:.1f} us/request "
+                f"({cache.hits} hits, {cache.misses} misses)"
+            )
+    finally:
+        security.token_cache = original_cache
+        security.token_versions.set(user_id, None)
+
+@contextmanager
+def _scratch_tenant(customers: int = 1):
+    """
+    Create a throwaway tenant with the given number of customers and yield
+    (tenant_id, customer ids); on exit every row the tenant wrote is deleted.
+    """
+    marker = uuid.uuid4().hex[:12]
+    db = SessionLocal()
+    try:
+        tenant = crud.create_tenant(db, name=f"benchmark-{marker}", domain=f"benchmark-{marker}.invalid")
+        tenant_id = tenant.id
+        customer_rows = [
+            models.Customer(
+                email=f"benchmark-{marker}-{index}@example.com",
+                first_name="Benchmark",
+                last_name=str(index),
+                is_guest=True,
+                tenant_id=tenant_id
+            )
+            for index in range(customers)
+        ]
+        db.add_all(customer_rows)
+        db.commit()
+        customer_ids = [customer.id for customer in customer_rows]
+    finally:
+        db.close()
+    
+    try:
+        yield tenant_id, customer_ids
+    finally:
+        _drop_tenant(tenant_id)
+
+def _drop_tenant(tenant_id: int):
+    """Delete a tenant and everything that references it, children first"""
+    orders = sa.select(models.Order.id).where(models.Order.tenant_id == tenant_id)
+    customers = sa.select(models.Customer.id).where(models.Customer.tenant_id == tenant_id)
+    db = SessionLocal()
+    try:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            if table.name == models.Tenant.__tablename__:
+                db.execute(sa.delete(table).where(table.c.id == tenant_id))
+            elif "tenant_id" in table.c:
+                db.execute(sa.delete(table).where(table.c.tenant_id == tenant_id))
+            elif "order_id" in table.c:
+                db.execute(sa.delete(table).where(table.c.order_id.in_(orders)))
+            elif "customer_id" in table.c:
+                db.execute(sa.delete(table).where(table.c.customer_id.in_(customers)))
+        crud.drop_order_number_sequences(db, tenant_id)
+        db.commit()
+    finally:
+        db.close()
+
+BENCHMARK_ADDRESS = schemas.AddressCreate(
+    address_line1="1 Benchmark Way", city="Springfield", state="IL", postal_code="62701"
+)
+
+def _benchmark_hot_product(args, mode: str, cart_size: int) -> bool:
+    """
+    Run concurrent checkouts whose carts hold the hot product plus
+    cart_size - 1 other lines; logs throughput and returns whether stock stayed
+    consistent for every product.
+    """
+    with _scratch_tenant(customers=args.threads) as (tenant_id, customer_ids):
+        db = SessionLocal()
+        try:
+            stock = {}
+            for index in range(cart_size):
+                quantity = args.stock if index == 0 else args.orders  # Only the first product runs out
+                product = crud.create_product_for_tenant(db, schemas.ProductCreate(
+                    name=f"Benchmark product {index}", price=10.0, quantity=quantity
+                ), tenant_id)
+                stock[product.id] = quantity
+        finally:
+            db.close()
+        
+        cart = [schemas.OrderItemCreate(product_id=product_id, quantity=1) for product_id in stock]
+        
+        def buy(index):
+            """Place one order of the cart; returns (sold, seconds taken)"""
+            order = schemas.OrderCreate(items=cart, shipping_address=BENCHMARK_ADDRESS)
+            started = time.perf_counter()
+            db = SessionLocal()
+            try:
+                crud.create_order(db, order, customer_ids[index % len(customer_ids)], tenant_id)
+                sold = True
+            except crud.InsufficientInventoryError:
+                sold = False
+            finally:
+                db.close()
+            return sold, time.perf_counter() - started
+        
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as threads:
+            outcomes = list(threads.map(buy, range(args.orders)))
+        elapsed = time.perf_counter() - started
+        sold = sum(1 for was_sold, _ in outcomes if was_sold)
+        latencies = sorted(seconds for _, seconds in outcomes)
+        
+        db = SessionLocal()
+        try:
+            remaining = dict(db.query(models.Product.id, models.Product.quantity).filter(
+                models.Product.id.in_(stock)
+            ).all())
+            ordered = dict(db.query(models.OrderItem.product_id, sa.func.sum(models.OrderItem.quantity)).filter(
+                models.OrderItem.product_id.in_(stock)
+            ).group_by(models.OrderItem.product_id).all())
+        finally:
+            db.close()
+    
+    hot_product_id = next(iter(stock))
+    consistent = all(
+        remaining[product_id] >= 0
+        and ordered.get(product_id, 0) == sold
+        and sold + remaining[product_id] == quantity
+        for product_id, quantity in stock.items()
+    )
+    logger.info(
+        f"Inventory mode {mode}, {cart_size}-line carts: {args.orders} checkouts on {args.threads} threads "
+        f"in {elapsed:.2f}s ({args.orders / elapsed:.1f} orders/sec, {args.orders * cart_size / elapsed:.1f} lines/sec, "
+        f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms), "
+        f"{sold} sold, {remaining[hot_product_id]} left of {args.stock} - "
+        f"{'no oversell' if consistent else 'INCONSISTENT STOCK'}"
+    )
+    return consistent
+
+def benchmark_inventory(args):
+    """
+    Load one hot product with concurrent checkouts in each inventory mode and
+    cart size and report throughput and latency. Also checks that stock never
+    oversells: every order either commits with its stock taken or fails with
+    InsufficientInventoryError, so units sold plus units left must equal the
+    starting stock of every product.
+    """
+    modes = ["locked", "flash_sale"] if args.mode == "both" else [args.mode]
+    original_mode = crud.INVENTORY_MODE
+    failed = False
+    try:
+        for mode in modes:
+            crud.INVENTORY_MODE = mode
+            for cart_size in args.cart_sizes:
+                if not _benchmark_hot_product(args, mode, cart_size):
+                    failed = True
+    finally:
+        crud.INVENTORY_MODE = original_mode
+    
+    if failed:
+        sys.exit(1)
+
+def benchmark_checkout(args):
+    """
+    Measure how long each paid checkout holds a pooled database connection
+    against its wall time, with a simulated payment gateway round trip. The
+    payment is authorized between two short transactions, so the hold time
+    should stay flat however slow the gateway is. Each checkout goes through
+    the guest path (customer upsert, address and order) and also reports the
+    commits and statements it issued: two commits per order, one to reserve
+    and one to confirm.
+    """
+    held = []
+    checked_out_at = {}
+    round_trips = {"commits": 0, "statements": 0}
+    counter_lock = threading.Lock()
+    
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_out_at[id(connection_record)] = time.perf_counter()
+    
+    def on_checkin(dbapi_connection, connection_record):
+        started = checked_out_at.pop(id(connection_record), None)
+        if started is not None:
+            held.append(time.perf_counter() - started)
+    
+    def on_commit(conn):
+        with counter_lock:
+            round_trips["commits"] += 1
+    
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        with counter_lock:
+            round_trips["statements"] += 1
+    
+    card = schemas.PaymentRequest(
+        card_number=payment.TEST_CARDS["visa"],
+        expiry_month=12,
+        expiry_year=datetime.date.today().year + 1,
+        cvv="123",
+        cardholder_name="Benchmark",
+        amount=10
+    )
+    original_latency = payment.PAYMENT_GATEWAY_LATENCY_MS
+    payment.PAYMENT_GATEWAY_LATENCY_MS = args.gateway_ms
+    try:
+        with _scratch_tenant(customers=0) as (tenant_id, _):
+            db = SessionLocal()
+            try:
+                product = crud.create_product_for_tenant(db, schemas.ProductCreate(
+                    name="Benchmark product", price=10.0, quantity=args.orders
+                ), tenant_id)
+                product_id = product.id
+            finally:
+                db.close()
+            
+            def checkout(index):
+                """Place one paid guest order; returns its wall time in seconds"""
+                order = schemas.OrderCreateWithPayment(
+                    items=[schemas.OrderItemCreate(product_id=product_id, quantity=1)],
+                    shipping_address=BENCHMARK_ADDRESS,
+                    payment=card
+                )
+                guest = schemas.CustomerInfo(
+                    email=f"benchmark-{tenant_id}-guest-{index}@example.com",
+                    first_name="Benchmark",
+                    last_name="Guest"
+                )
+                started = time.perf_counter()
+                db = SessionLocal()
+                try:
+                    customer_id = crud.upsert_guest_customer(db, guest, tenant_id)
+                    result = crud.create_order_with_payment(db, order, customer_id, tenant_id)
+                finally:
+                    db.close()
+                if not result["success"]:
+                    raise RuntimeError(f"Benchmark checkout failed: {result['error']}")
+                return time.perf_counter() - started
+            
+            sa.event.listen(engine, "checkout", on_checkout)
+            sa.event.listen(engine, "checkin", on_checkin)
+            sa.event.listen(engine, "commit", on_commit)
+            sa.event.listen(engine, "before_cursor_execute", on_execute)
+            try:
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=args.threads) as threads:
+                    wall_times = sorted(threads.map(checkout, range(args.orders)))
+                elapsed = time.perf_counter() - started
+            finally:
+                sa.event.remove(engine, "checkout", on_checkout)
+                sa.event.remove(engine, "checkin", on_checkin)
+                sa.event.remove(engine, "commit", on_commit)
+                sa.event.remove(engine, "before_cursor_execute", on_execute)
+    finally:
+        payment.PAYMENT_GATEWAY_LATENCY_MS = original_latency
+    
+    wall_per_checkout = sum(wall_times) / args.orders
+    held_per_checkout = sum(held) / args.orders
+    logger.info(
+        f"{args.orders} paid checkouts on {args.threads} threads with a {args.gateway_ms} ms gateway in {elapsed:.2f}s "
+        f"({args.orders / elapsed:.1f}/sec): {wall_per_checkout * 1000:.1f} ms wall "
+        f"(p99 {wall_times[int(len(wall_times) * 0.99)] * 1000:.1f} ms), connection held "
+        f"{held_per_checkout * 1000:.1f} ms per checkout ({held_per_checkout / wall_per_checkout:.0%} of wall time), "
+        f"{round_trips['commits'] / args.orders:.1f} commits and "
+        f"{round_trips['statements'] / args.orders:.1f} statements per checkout"
+    )
+
+def benchmark_rfm(args):
+    """
+    Run the customer RFM refresh end to end on generated orders: the streamed
+    read, the scoring and the replacement of the stored scores in one
+    transaction. Exits non-zero unless every customer with a non-cancelled
+    order is scored exactly once.
+    """
+    with _scratch_tenant(customers=args.customers) as (tenant_id, customer_ids):
+        today = datetime.datetime.utcnow()
+        rows = [
+            {
+                "order_number": f"RFM-{tenant_id}-{index:07d}",
+                "customer_id": random.choice(customer_ids),
+                "tenant_id": tenant_id,
+                "status": random.choice(list(models.OrderStatus)),
+                "total_amount": round(random.uniform(5, 500), 2),
+                "created_at": today - datetime.timedelta(days=random.randint(0, 365))
+            }
+            for index in range(args.orders)
+        ]
+        expected = {row["customer_id"] for row in rows if row["status"] != models.OrderStatus.CANCELLED}
+        
+        db = SessionLocal()
+        try:
+            db.execute(sa.insert(models.Order), rows)
+            db.commit()
+            
+            started = time.perf_counter()
+            scored = rfm.refresh_customer_rfm(db, tenant_id)
+            refreshed = time.perf_counter() - started
+            # Refreshing again must replace the stored scores, not add to them
+            rfm.refresh_customer_rfm(db, tenant_id)
+            
+            stored = dict(db.query(models.CustomerRfmScore.customer_id, models.CustomerRfmScore.segment).filter(
+                models.CustomerRfmScore.tenant_id == tenant_id
+            ).all())
+        finally:
+            db.close()
+    
+    consistent = scored == len(expected) and set(stored) == expected and set(stored.values()) <= set(rfm.RFM_SEGMENTS)
+    logger.info(
+        f"RFM refresh of {args.orders} orders in {refreshed:.2f}s: {scored} customers scored, "
+        f"{len(stored)} stored, {len(expected)} expected - {'ok' if consistent else 'MISMATCH'}"
+    )
+    if not consistent:
+        sys.exit(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="E-commerce platform maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    dedupe = subparsers.add_parser("dedupe-addresses", help="Backfill address hashes and collapse duplicate addresses")
+    dedupe.add_argument("--batch-size", type=int, default=1000)
+    dedupe.set_defaults(handler=dedupe_addresses)
+    
+    rollups = subparsers.add_parser("backfill-rollups", help="Rebuild the daily sales rollups from existing orders")
+    rollups.add_argument("--tenant-id", type=int, default=None)
+    rollups.set_defaults(handler=backfill_rollups)
+    
+    exporter = subparsers.add_parser("export", help="Export a tenant's orders, order items and products")
+    exporter.add_argument("--tenant-id", type=int, required=True)
+    exporter.add_argument("--format", choices=list(export.EXPORT_FORMATS), default="parquet")
+    exporter.add_argument("--from", dest="date_from", type=datetime.datetime.fromisoformat, default=None)
+    exporter.add_argument("--to", dest="date_to", type=datetime.datetime.fromisoformat, default=None)
+    exporter.add_argument("--out", default=".", help="Output directory")
+    exporter.set_defaults(handler=export_tables)
+    
+    scoring = subparsers.add_parser("rfm", help="Recompute customer RFM scores and segments")
+    scoring.add_argument("--tenant-id", type=int, default=None)
+    scoring.set_defaults(handler=score_customers)
+    
+    benchmark = subparsers.add_parser("benchmark-passwords", help="Report password hashing throughput")
+    benchmark.add_argument("--seconds", type=float, default=5.0)
+    benchmark.set_defaults(handler=benchmark_passwords, needs_database=False)
+    
+    auth_benchmark = subparsers.add_parser("benchmark-auth", help="Report auth dependency overhead per request")
+    auth_benchmark.add_argument("--iterations", type=int, default=10000)
+    auth_benchmark.set_defaults(handler=benchmark_auth)
+    
+    inventory_benchmark = subparsers.add_parser(
+        "benchmark-inventory", help="Report hot-product checkout throughput and check stock never oversells"
+    )
+    inventory_benchmark.add_argument("--mode", choices=["locked", "flash_sale", "both"], default="both")
+    inventory_benchmark.add_argument("--stock", type=int, default=100)
+    inventory_benchmark.add_argument("--orders", type=int, default=500)
+    inventory_benchmark.add_argument("--threads", type=int, default=16)
+    inventory_benchmark.add_argument(
+        "--cart-sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1, 5, 20],
+        help="Comma-separated cart line counts to compare, e.g. 1,5,20"
+    )
+    inventory_benchmark.set_defaults(handler=benchmark_inventory)
+    
+    checkout_benchmark = subparsers.add_parser(
+        "benchmark-checkout", help="Report connection hold time and round trips per paid guest checkout"
+    )
+    checkout_benchmark.add_argument("--orders", type=int, default=200)
+    checkout_benchmark.add_argument("--threads", type=int, default=8)
+    checkout_benchmark.add_argument("--gateway-ms", type=int, default=500, help="Simulated payment gateway latency")
+    checkout_benchmark.set_defaults(handler=benchmark_checkout)
+    
+    rfm_benchmark = subparsers.add_parser(
+        "benchmark-rfm", help="Run the customer RFM refresh end to end on generated orders"
+    )
+    rfm_benchmark.add_argument("--customers", type=int, default=1000)
+    rfm_benchmark.add_argument("--orders", type=int, default=20000)
+    rfm_benchmark.set_defaults(handler=benchmark_rfm)
+    
+    args = parser.parse_args(argv)
+    configure_logging()
+    
+    if getattr(args, "needs_database", True):
+        # Make sure the columns the commands rely on exist
+        models.Base.metadata.create_all(bind=engine)
+        apply_schema_upgrades(engine)
+    args.handler(args)
+
+if __name__ == "__main__":
+    main()
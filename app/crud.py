@@ -1,7 +1,20 @@
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql
 import sqlalchemy as sa
-from typing import Optional
+from typing import Optional, List, Dict
+import hashlib
+import logging
+import os
 from . import models, schemas, security
+from .services import hll
+
+logger = logging.getLogger(__name__)
+
+# Inventory strategy for checkout:
+#   "locked"     - lock every line product (SELECT ... FOR UPDATE) for the whole order transaction
+#   "flash_sale" - no up-front locks; stock is taken with one conditional UPDATE per product
+#                  right before commit, after payment, so hot rows are locked only briefly
+INVENTORY_MODE = os.getenv("INVENTORY_MODE", "locked")
 
 # --- User and Tenant CRUD ---
 
@@ -43,10 +56,12 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.refresh(db_user)
     return db_user
 
-def update_user_password(db: Session, user_id: int, hashed_password: str):
+def update_user_password(db: Session, user_id: int, hashed_password: str, revoke_tokens: bool = True):
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if db_user:
         db_user.hashed_password = hashed_password  # type: ignore
+        if revoke_tokens:
+            db_user.token_version += 1  # type: ignore
         db.commit()
         db.refresh(db_user)
     return db_user
@@ -55,6 +70,7 @@ def update_user_email(db: Session, user_id: int, new_email: str):
     db_user = db.query(models.User).filter(models.User.id == user_id).first()
     if db_user:
         db_user.email = new_email  # type: ignore
+        db_user.token_version += 1  # type: ignore
         db.commit()
         db.refresh(db_user)
     return db_user
@@ -133,60 +149,163 @@ def get_products_with_filters(
     
     return query.offset(skip).limit(limit).all()
 
+PRODUCT_SUGGESTION_LIMIT = 5
+
 def get_product_analytics(db: Session, tenant_id: int):
-    """Get product analytics and smart suggestions"""
-    products = db.query(models.Product).filter(models.Product.tenant_id == tenant_id).all()
-    
-    if not products:
-        return {
-            "total_products": 0,
-            "suggestions": {
-                "low_stock": [],
-                "no_image": [],
-                "no_description": [],
-                "high_value": [],
-                "recently_added": []
-            }
-        }
+    """
+    Get product analytics and smart suggestions.
+    Totals come from one aggregate query and the suggestion lists from one
+    UNION ALL of top-N queries, so memory does not grow with the catalog.
+    """
+    product = models.Product
+    totals = db.query(
+        sa.func.count(product.id).label("total_products"),
+        sa.func.coalesce(sa.func.sum(product.price * product.quantity), 0).label("total_value"),
+        sa.func.coalesce(sa.func.avg(product.price), 0).label("avg_price"),
+        sa.func.count(product.id).filter(product.quantity > 10).label("in_stock"),
+        sa.func.count(product.id).filter(product.quantity.between(1, 10)).label("low_stock"),
+        sa.func.count(product.id).filter(product.quantity == 0).label("out_of_stock")
+    ).filter(product.tenant_id == tenant_id).one()
     
-    # Calculate analytics
-    total_products = len(products)
-    total_value = sum(p.price * p.quantity for p in products)
-    avg_price = sum(p.price for p in products) / total_products if total_products > 0 else 0
+    suggestions = {
+        "low_stock": [],
+        "no_image": [],
+        "no_description": [],
+        "high_value": [],
+        "recently_added": []
+    }
+    if not totals.total_products:
+        return {"total_products": 0, "suggestions": suggestions}
+    
+    def top(kind, condition, *order_by):
+        return sa.select(
+            sa.literal(kind).label("kind"),
+            product.id,
+            product.name,
+            product.quantity,
+            product.price,
+            product.created_at
+        ).where(product.tenant_id == tenant_id, condition).order_by(*order_by).limit(PRODUCT_SUGGESTION_LIMIT)
     
-    # Smart suggestions
-    low_stock = [p for p in products if 0 < p.quantity <= 5][:5]  # type: ignore
-    no_image = [p for p in products if not p.image_url][:5]  # type: ignore
-    no_description = [p for p in products if not p.description or len(p.description.strip()) < 10][:5]  # type: ignore
-    high_value = sorted([p for p in products if p.price > 100], key=lambda x: x.price, reverse=True)[:5]  # type: ignore
-    recently_added = sorted(products, key=lambda x: x.created_at, reverse=True)[:5]  # type: ignore
+    suggestion_rows = db.execute(sa.union_all(
+        top("low_stock", product.quantity.between(1, 5), product.id),
+        top("no_image", sa.func.coalesce(product.image_url, "") == "", product.id),
+        top("no_description", sa.func.length(sa.func.btrim(sa.func.coalesce(product.description, ""))) < 10, product.id),
+        top("high_value", product.price > 100, product.price.desc(), product.id),
+        top("recently_added", sa.true(), product.created_at.desc(), product.id.desc())
+    )).all()
     
-    # Stock distribution
-    in_stock = len([p for p in products if p.quantity > 10])  # type: ignore
-    low_stock_count = len([p for p in products if 0 < p.quantity <= 10])  # type: ignore
-    out_of_stock = len([p for p in products if p.quantity == 0])  # type: ignore
+    for row in suggestion_rows:
+        entry = {"id": row.id, "name": row.name}
+        if row.kind == "low_stock":
+            entry["quantity"] = row.quantity
+        elif row.kind == "high_value":
+            entry["price"] = float(row.price)
+        elif row.kind == "recently_added":
+            entry["created_at"] = row.created_at.isoformat()
+        suggestions[row.kind].append(entry)
     
     return {
-        "total_products": total_products,
-        "total_inventory_value": float(total_value),
-        "average_price": float(avg_price),
+        "total_products": totals.total_products,
+        "total_inventory_value": float(totals.total_value),
+        "average_price": float(totals.avg_price),
         "stock_distribution": {
-            "in_stock": in_stock,
-            "low_stock": low_stock_count,
-            "out_of_stock": out_of_stock
+            "in_stock": totals.in_stock,
+            "low_stock": totals.low_stock,
+            "out_of_stock": totals.out_of_stock
         },
-        "suggestions": {
-            "low_stock": [{"id": p.id, "name": p.name, "quantity": p.quantity} for p in low_stock],
-            "no_image": [{"id": p.id, "name": p.name} for p in no_image],
-            "no_description": [{"id": p.id, "name": p.name} for p in no_description],
-            "high_value": [{"id": p.id, "name": p.name, "price": float(p.price)} for p in high_value],
-            "recently_added": [{"id": p.id, "name": p.name, "created_at": p.created_at.isoformat()} for p in recently_added]
-        }
+        "suggestions": suggestions
     }
 
 def get_product_by_id(db: Session, product_id: int):
     return db.query(models.Product).filter(models.Product.id == product_id).first()
 
+def _id_array(ids):
+    """Bind a list of ids as a single Postgres array parameter for ``= ANY(...)``"""
+    return sa.any_(sa.literal(list(ids), type_=postgresql.ARRAY(sa.Integer)))
+
+def get_products_by_ids(db: Session, product_ids: List[int], tenant_id: int):
+    """Load several products of a tenant with one ``WHERE id = ANY(...)`` query"""
+    if not product_ids:
+        return []
+    return db.query(models.Product).filter(
+        models.Product.id == _id_array(product_ids),
+        models.Product.tenant_id == tenant_id
+    ).all()
+
+def _merge_line_quantities(items) -> Dict[int, int]:
+    """Sum requested quantities per product, keeping first-seen order"""
+    quantities: Dict[int, int] = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return quantities
+
+def _held_quantity(exclude_token: Optional[str] = None):
+    """Correlated subquery: units of the outer product held by active checkouts"""
+    hold = models.InventoryHold
+    query = sa.select(sa.func.coalesce(sa.func.sum(hold.quantity), 0)).where(
+        hold.product_id == models.Product.id,
+        hold.expires_at > sa.func.now()
+    )
+    if exclude_token:
+        query = query.where(hold.hold_token != exclude_token)
+    return query.correlate(models.Product).scalar_subquery()
+
+def quote_cart(db: Session, items: List[schemas.OrderItemCreate], tenant_id: int, hold_token: Optional[str] = None):
+    """Price a cart and check availability for every line in a single query"""
+    quantities = _merge_line_quantities(items)
+    products = {}
+    available_by_id = {}
+    if quantities:
+        rows = db.query(models.Product, _held_quantity(hold_token).label("held")).filter(
+            models.Product.id == _id_array(quantities),
+            models.Product.tenant_id == tenant_id
+        ).all()
+        for product, held in rows:
+            products[product.id] = product
+            available_by_id[product.id] = max(product.quantity - held, 0)
+    
+    lines = []
+    total_amount = 0.0
+    all_available = True
+    
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        if not product:
+            all_available = False
+            lines.append({
+                "product_id": product_id,
+                "quantity": quantity,
+                "available": False,
+                "error": "Product not found"
+            })
+            continue
+        
+        available_quantity = available_by_id[product_id]
+        available = quantity > 0 and available_quantity >= quantity
+        line_total = round(product.price * quantity, 2)
+        if available:
+            total_amount += line_total
+        else:
+            all_available = False
+        
+        lines.append({
+            "product_id": product_id,
+            "name": product.name,
+            "quantity": quantity,
+            "unit_price": float(product.price),
+            "line_total": line_total,
+            "available_quantity": available_quantity,
+            "available": available,
+            "error": None if available else f"Insufficient inventory for {product.name}. Available: {available_quantity}, Requested: {quantity}"
+        })
+    
+    return {
+        "items": lines,
+        "total_amount": round(total_amount, 2),
+        "all_available": all_available
+    }
+
 def create_product_for_tenant(db: Session, product: schemas.ProductCreate, tenant_id: int):
     db_product = models.Product(**product.model_dump(), tenant_id=tenant_id)
     db.add(db_product)
@@ -231,10 +350,27 @@ def get_all_users(db: Session, skip: int = 0, limit: int = 100):
 def get_user_by_id(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
+def revoke_user_tokens(db: Session, user_id: int) -> Optional[int]:
+    """Invalidate every access token issued to the user so far; returns the new token version"""
+    version = db.execute(
+        sa.update(models.User).where(models.User.id == user_id).values(
+            token_version=models.User.token_version + 1
+        ).returning(models.User.token_version)
+    ).scalar()
+    db.commit()
+    return version
+
+def get_user_token_versions(db: Session) -> Dict[int, int]:
+    return dict(db.query(models.User.id, models.User.token_version).all())
+
+def get_user_token_version(db: Session, user_id: int) -> Optional[int]:
+    return db.query(models.User.token_version).filter(models.User.id == user_id).scalar()
+
 def update_user_role(db: Session, user_id: int, new_role: models.Role):
     db_user = db.get(models.User, user_id)
     if db_user:
         db_user.role = new_role  # type: ignore
+        db_user.token_version += 1  # type: ignore
         db.commit()
         db.refresh(db_user)
     return db_user
@@ -367,19 +503,14 @@ def create_customer(db: Session, customer: schemas.CustomerCreate, tenant_id: in
     db.refresh(db_customer)
     return db_customer
 
-def get_or_create_guest_customer(db: Session, customer_info: schemas.CustomerInfo, tenant_id: int):
-    """Get existing customer or create new guest customer"""
-    # Check if customer already exists
-    existing_customer = db.query(models.Customer).filter(
-        models.Customer.email == customer_info.email,
-        models.Customer.tenant_id == tenant_id
-    ).first()
-    
-    if existing_customer:
-        return existing_customer
-    
-    # Create new guest customer
-    db_customer = models.Customer(
+def upsert_guest_customer(db: Session, customer_info: schemas.CustomerInfo, tenant_id: int) -> int:
+    """
+    Return the id of the tenant's customer with this email, creating a guest
+    customer if there is none, in a single INSERT ... ON CONFLICT statement.
+    Does not commit: the row becomes visible together with the guest's order.
+    """
+    table = models.Customer.__table__
+    insert_stmt = postgresql.insert(table).values(
         email=customer_info.email,
         first_name=customer_info.first_name,
         last_name=customer_info.last_name,
@@ -389,10 +520,18 @@ def get_or_create_guest_customer(db: Session, customer_info: schemas.CustomerInf
         email_verified=False,  # Guests haven't verified email
         tenant_id=tenant_id
     )
-    db.add(db_customer)
-    db.commit()
-    db.refresh(db_customer)
-    return db_customer
+    customer_id = db.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=[table.c.email],
+            # No-op update so RETURNING yields the existing row, but only for this tenant
+            set_={"email": insert_stmt.excluded.email},
+            where=table.c.tenant_id == insert_stmt.excluded.tenant_id
+        ).returning(table.c.id)
+    ).scalar()
+    
+    if customer_id is None:
+        raise ValueError("This email address is already registered with another store")
+    return customer_id
 
 def get_customer_by_id(db: Session, customer_id: int, tenant_id: int):
     return db.query(models.Customer).filter(
@@ -400,127 +539,368 @@ def get_customer_by_id(db: Session, customer_id: int, tenant_id: int):
         models.Customer.tenant_id == tenant_id
     ).first()
 
-def create_customer_address(db: Session, address: schemas.AddressCreate, customer_id: int):
-    db_address = models.CustomerAddress(**address.model_dump(), customer_id=customer_id)
-    db.add(db_address)
-    db.commit()
-    db.refresh(db_address)
+ADDRESS_HASH_FIELDS = ("address_line1", "address_line2", "city", "state", "postal_code", "country")
+
+def address_content_hash(address) -> str:
+    """Hash of an address normalized for case and whitespace (is_default is ignored)"""
+    normalized = [
+        " ".join((getattr(address, field) or "").split()).casefold()
+        for field in ADDRESS_HASH_FIELDS
+    ]
+    return hashlib.sha256("\x1f".join(normalized).encode()).hexdigest()
+
+def create_customer_address(db: Session, address: schemas.AddressCreate, customer_id: int, commit: bool = True):
+    """
+    Store a customer address, reusing the customer's existing row for the same
+    address via INSERT ... ON CONFLICT on (customer_id, content_hash).
+    """
+    insert_stmt = postgresql.insert(models.CustomerAddress).values(
+        **address.model_dump(),
+        customer_id=customer_id,
+        content_hash=address_content_hash(address)
+    )
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[models.CustomerAddress.customer_id, models.CustomerAddress.content_hash],
+        # No-op update so RETURNING yields the existing row
+        set_={"content_hash": insert_stmt.excluded.content_hash}
+    ).returning(models.CustomerAddress)
+    db_address = db.scalars(upsert_stmt, execution_options={"populate_existing": True}).one()
+    if commit:
+        db.commit()
+        db.refresh(db_address)
     return db_address
 
+def dedupe_customer_addresses(db: Session, batch_size: int = 1000):
+    """
+    Backfill content hashes for addresses created before deduplication and
+    collapse repeats: orders are moved to the surviving row and the duplicates
+    deleted. Returns (hashed, removed) counts.
+    """
+    address = models.CustomerAddress
+    hashed = removed = 0
+    
+    while True:
+        rows = db.query(address).filter(
+            address.content_hash.is_(None)
+        ).order_by(address.customer_id, address.id).limit(batch_size).all()
+        if not rows:
+            break
+        
+        # Rows of these customers that already carry a hash survive first
+        survivors = {
+            (customer_id, content_hash): address_id
+            for customer_id, content_hash, address_id in db.query(
+                address.customer_id, address.content_hash, address.id
+            ).filter(
+                address.customer_id == _id_array({r.customer_id for r in rows}),
+                address.content_hash.isnot(None)
+            )
+        }
+        
+        duplicates: Dict[int, int] = {}
+        for row in rows:
+            content_hash = address_content_hash(row)
+            key = (row.customer_id, content_hash)
+            if key in survivors:
+                duplicates[row.id] = survivors[key]
+            else:
+                survivors[key] = row.id
+                row.content_hash = content_hash
+                hashed += 1
+        
+        if duplicates:
+            db.execute(
+                sa.update(models.Order.__table__)
+                .where(models.Order.__table__.c.shipping_address_id == _id_array(duplicates))
+                .values(shipping_address_id=sa.case(duplicates, value=models.Order.__table__.c.shipping_address_id))
+            )
+            db.execute(sa.delete(address.__table__).where(address.__table__.c.id == _id_array(duplicates)))
+            for row in rows:
+                if row.id in duplicates:
+                    db.expunge(row)
+            removed += len(duplicates)
+        db.commit()
+    
+    return hashed, removed
+
 # --- Order CRUD ---
 
+# Advisory lock class serializing creation of a tenant's order number sequence
+ORDER_NUMBER_SEQUENCE_LOCK = 29
+
+def _order_number_sequence(tenant_id: int, year: int) -> str:
+    return f"order_number_seq_{tenant_id}_{year}"
+
 def generate_order_number(db: Session, tenant_id: int):
-    """Generate unique order number for tenant"""
+    """
+    Generate unique order number for tenant from a per-tenant, per-year
+    Postgres sequence. nextval() takes no row lock and is not rolled back, so
+    concurrent checkouts never wait on each other for a number (orders that
+    roll back leave gaps).
+    """
     import datetime
     year = datetime.datetime.now().year
+    sequence = _order_number_sequence(tenant_id, year)
     
-    # Count orders for this tenant this year
-    count = db.query(models.Order).filter(
-        models.Order.tenant_id == tenant_id,
-        sa.extract('year', models.Order.created_at) == year
-    ).count()
+    if db.execute(sa.select(sa.func.to_regclass(sequence))).scalar() is None:
+        # First order of the year for this tenant: create the sequence, seeded
+        # past the highest number already issued this year. The advisory lock
+        # (held to commit) makes concurrent first orders create it only once.
+        db.execute(sa.select(sa.func.pg_advisory_xact_lock(ORDER_NUMBER_SEQUENCE_LOCK, tenant_id)))
+        prefix = f"ORD-{year}-{tenant_id:03d}-"
+        issued = db.query(
+            sa.func.max(sa.cast(sa.func.split_part(models.Order.order_number, '-', 4), sa.Integer))
+        ).filter(
+            models.Order.tenant_id == tenant_id,
+            models.Order.order_number.like(f"{prefix}%")
+        ).scalar() or 0
+        db.execute(sa.text(f"CREATE SEQUENCE IF NOT EXISTS {sequence} START WITH {int(issued) + 1}"))
     
-    return f"ORD-{year}-{tenant_id:03d}-{count + 1:04d}"
+    next_value = db.execute(sa.select(sa.func.nextval(sequence))).scalar()
+    return f"ORD-{year}-{tenant_id:03d}-{next_value:04d}"
+
+def drop_order_number_sequences(db: Session, tenant_id: int):
+    """Drop every order number sequence of a tenant (when removing the tenant)"""
+    sequences = db.execute(sa.text(
+        "SELECT relname FROM pg_class WHERE relkind = 'S' AND relname ~ :pattern"
+    ), {"pattern": f"^order_number_seq_{int(tenant_id)}_[0-9]+$"}).scalars().all()
+    for sequence in sequences:
+        db.execute(sa.text(f"DROP SEQUENCE IF EXISTS {sequence}"))
+
+class InsufficientInventoryError(ValueError):
+    """Raised when a product no longer has enough stock for an order"""
+    pass
+
+def _flash_sale_mode() -> bool:
+    return INVENTORY_MODE == "flash_sale"
+
+def _load_order_products(
+    db: Session,
+    items: List[schemas.OrderItemCreate],
+    tenant_id: int,
+    lock: bool = True,
+    hold_token: Optional[str] = None
+):
+    """
+    Load every product of an order with one query and validate the requested stock.
+    Stock held by other active checkouts is not available; the caller's own
+    holds (hold_token) are. With lock=True the rows are taken with
+    SELECT ... FOR UPDATE in id order so concurrent checkouts that share
+    products always acquire their locks in the same sequence and cannot deadlock.
+    """
+    quantities = _merge_line_quantities(items)
+    query = db.query(models.Product, _held_quantity(hold_token).label("held")).filter(
+        models.Product.id == _id_array(quantities),
+        models.Product.tenant_id == tenant_id
+    ).order_by(models.Product.id)
+    if lock:
+        query = query.with_for_update(of=models.Product)
+    products_by_id = {}
+    available_by_id = {}
+    for product, held in query.all():
+        products_by_id[product.id] = product
+        available_by_id[product.id] = product.quantity - held
+    
+    for product_id, quantity in quantities.items():
+        product = products_by_id.get(product_id)
+        if not product:
+            raise ValueError(f"Product {product_id} not found")
+        if quantity <= 0:
+            raise ValueError(f"Invalid quantity for {product.name}: {quantity}")
+        if available_by_id[product_id] < quantity:
+            raise InsufficientInventoryError(f"Insufficient inventory for {product.name}. Available: {max(available_by_id[product_id], 0)}, Requested: {quantity}")
+    
+    return products_by_id, quantities
+
+def _price_order_items(items: List[schemas.OrderItemCreate], products_by_id: Dict[int, models.Product]):
+    """Build order item rows and the order total from already loaded products"""
+    total_amount = 0
+    order_items_data = []
+    
+    for item in items:
+        product = products_by_id[item.product_id]
+        item_total = product.price * item.quantity
+        total_amount += item_total
+        
+        order_items_data.append({
+            'product_id': item.product_id,
+            'quantity': item.quantity,
+            'unit_price': product.price,
+            'total_price': item_total
+        })
+    
+    return total_amount, order_items_data
+
+def _apply_inventory_deltas(db: Session, deltas: Dict[int, int]):
+    """Apply per-product quantity changes with a single set-based UPDATE"""
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    
+    db.execute(
+        sa.update(models.Product)
+        .where(models.Product.id == _id_array(deltas))
+        .values(quantity=models.Product.quantity + sa.case(deltas, value=models.Product.id))
+        .execution_options(synchronize_session=False)
+    )
+
+def _take_stock_conditionally(db: Session, quantities: Dict[int, int], hold_token: Optional[str] = None):
+    """
+    Decrement stock with one atomic conditional UPDATE per product.
+    Each row is locked only from its UPDATE until the surrounding commit, and
+    the statement matches nothing if a concurrent buyer took the last units.
+    """
+    for product_id in sorted(quantities):
+        remaining = db.execute(
+            sa.update(models.Product)
+            .where(
+                models.Product.id == product_id,
+                models.Product.quantity - _held_quantity(hold_token) >= quantities[product_id]
+            )
+            .values(quantity=models.Product.quantity - quantities[product_id])
+            .returning(models.Product.quantity)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        if remaining is None:
+            raise InsufficientInventoryError(f"Insufficient inventory for product {product_id}")
+
+def _take_stock(db: Session, quantities: Dict[int, int], tenant_id: int, hold_token: Optional[str] = None):
+    """
+    Remove ordered quantities from inventory using the configured strategy.
+    The checkout's own holds are converted into the real decrement.
+    Call this at the end of the transaction, followed only by the rollup
+    upserts and the commit: the decremented product rows stay locked until
+    the transaction ends, so nothing slow should run in between.
+    """
+    db.flush()  # Write the pending order rows now rather than at commit, after the lock is taken
+    if _flash_sale_mode():
+        _take_stock_conditionally(db, quantities, hold_token)
+    else:
+        _apply_inventory_deltas(db, {pid: -qty for pid, qty in quantities.items()})
+    if hold_token:
+        table = models.InventoryHold.__table__
+        db.execute(sa.delete(table).where(
+            table.c.hold_token == hold_token,
+            table.c.tenant_id == tenant_id
+        ))
+
+def _insert_order(
+    db: Session,
+    customer_id: int,
+    tenant_id: int,
+    shipping_address: models.CustomerAddress,
+    total_amount,
+    order_items_data: List[dict],
+    status: models.OrderStatus = models.OrderStatus.PENDING
+):
+    """Insert an order with its line items and return it flushed (id assigned)"""
+    db_order = models.Order(
+        order_number=generate_order_number(db, tenant_id),
+        customer_id=customer_id,
+        tenant_id=tenant_id,
+        total_amount=total_amount,
+        shipping_address=shipping_address,  # Inserted by the same flush if still pending
+        status=status
+    )
+    db.add(db_order)
+    db.flush()  # Get order ID
+    
+    db.add_all([
+        models.OrderItem(order_id=db_order.id, **item_data)
+        for item_data in order_items_data
+    ])
+    return db_order
 
 def create_order(db: Session, order_data: schemas.OrderCreate, customer_id: int, tenant_id: int):
-    """Create order and update inventory"""
+    """Create order and update inventory in a single transaction"""
     try:
+        shipping_address = create_customer_address(db, order_data.shipping_address, customer_id, commit=False)
         
-        # Create shipping address
-        shipping_address = create_customer_address(db, order_data.shipping_address, customer_id)
-        
-        # Calculate total and validate inventory
-        total_amount = 0
-        order_items_data = []
-        
-        for item in order_data.items:
-            product = get_product_by_id(db, item.product_id)
-            if not product or product.tenant_id != tenant_id:
-                raise ValueError(f"Product {item.product_id} not found")
-            
-            if product.quantity < item.quantity:
-                raise ValueError(f"Insufficient inventory for {product.name}. Available: {product.quantity}, Requested: {item.quantity}")
-            
-            item_total = product.price * item.quantity
-            total_amount += item_total
-            
-            order_items_data.append({
-                'product_id': item.product_id,
-                'quantity': item.quantity,
-                'unit_price': product.price,
-                'total_price': item_total,
-                'product': product
-            })
-        
-        # Create order
-        order_number = generate_order_number(db, tenant_id)
-        db_order = models.Order(
-            order_number=order_number,
-            customer_id=customer_id,
-            tenant_id=tenant_id,
-            total_amount=total_amount,
-            shipping_address_id=shipping_address.id
+        # Load the products, validate inventory and price the order
+        products_by_id, quantities = _load_order_products(
+            db, order_data.items, tenant_id,
+            lock=not _flash_sale_mode(), hold_token=order_data.hold_token
         )
-        db.add(db_order)
-        db.flush()  # Get order ID
+        total_amount, order_items_data = _price_order_items(order_data.items, products_by_id)
         
-        # Create order items and update inventory
-        for item_data in order_items_data:
-            # Create order item
-            db_order_item = models.OrderItem(
-                order_id=db_order.id,
-                product_id=item_data['product_id'],
-                quantity=item_data['quantity'],
-                unit_price=item_data['unit_price'],
-                total_price=item_data['total_price']
-            )
-            db.add(db_order_item)
-            
-            # Update product inventory
-            product = item_data['product']
-            product.quantity -= item_data['quantity']
-            db.add(product)
+        db_order = _insert_order(
+            db, customer_id, tenant_id, shipping_address, total_amount, order_items_data
+        )
+        add_outbox_event(db, tenant_id, "order.created", db_order.id, {
+            "order_number": db_order.order_number,
+            "status": models.OrderStatus.PENDING.value,
+            "total_amount": float(total_amount)
+        })
+        _take_stock(db, quantities, tenant_id, order_data.hold_token)
+        _record_orders_in_rollups(db, [db_order.id])  # Hot rollup rows are locked from here to the commit
         
         db.commit()
-        db.refresh(db_order)
-        return db_order
-        
-    except Exception as e:
-        raise e
+    except Exception:
+        db.rollback()
+        raise
+    
+    db.refresh(db_order)
+    return db_order
+
+def _payment_format_error(payment: schemas.PaymentRequest) -> Optional[str]:
+    """Run the gateway's card number, expiry and CVV format checks locally; returns the first error"""
+    from app.services.payment import MockPaymentGateway
+    
+    card = MockPaymentGateway.validate_credit_card(payment.card_number)
+    if not card["valid"]:
+        return card["error"]
+    for check in (
+        MockPaymentGateway.validate_expiry(payment.expiry_month, payment.expiry_year),
+        MockPaymentGateway.validate_cvv(payment.cvv, card["card_type"])
+    ):
+        if not check["valid"]:
+            return check["error"]
+    return None
 
 def create_order_with_payment(db: Session, order_data: schemas.OrderCreateWithPayment, customer_id: int, tenant_id: int):
-    """Create order with payment processing"""
+    """
+    Create order with payment processing in three short stages:
+      1. reserve inventory and write a PENDING order in one quick transaction
+      2. authorize the payment with no database connection or row lock held
+      3. confirm the order, or cancel it and put the stock back (compensate)
+    """
     from app.services.payment import MockPaymentGateway
     
+    # Reject malformed card details before any stock, order number or rollup is touched
+    format_error = _payment_format_error(order_data.payment)
+    if format_error:
+        db.rollback()  # Nothing the caller staged for this order is kept
+        return {"success": False, "error": format_error, "order": None}
+    
+    # Stage 1: reserve inventory and write the pending order (together with the
+    # shipping address and anything the caller added, such as a guest customer)
     try:
+        shipping_address = create_customer_address(db, order_data.shipping_address, customer_id, commit=False)
         
-        # Create shipping address
-        shipping_address = create_customer_address(db, order_data.shipping_address, customer_id)
-        
-        # Calculate total and validate inventory
-        total_amount = 0
-        order_items_data = []
-        
-        for item in order_data.items:
-            product = get_product_by_id(db, item.product_id)
-            if not product or product.tenant_id != tenant_id:
-                raise ValueError(f"Product {item.product_id} not found")
-            
-            if product.quantity < item.quantity:
-                raise ValueError(f"Insufficient inventory for {product.name}. Available: {product.quantity}, Requested: {item.quantity}")
-            
-            item_total = product.price * item.quantity
-            total_amount += item_total
-            
-            order_items_data.append({
-                'product_id': item.product_id,
-                'quantity': item.quantity,
-                'unit_price': product.price,
-                'total_price': item_total,
-                'product': product
-            })
+        products_by_id, quantities = _load_order_products(
+            db, order_data.items, tenant_id,
+            lock=not _flash_sale_mode(), hold_token=order_data.hold_token
+        )
+        total_amount, order_items_data = _price_order_items(order_data.items, products_by_id)
         
-        # Process payment
+        db_order = _insert_order(
+            db, customer_id, tenant_id, shipping_address, total_amount, order_items_data
+        )
+        add_outbox_event(db, tenant_id, "order.created", db_order.id, {
+            "order_number": db_order.order_number,
+            "status": models.OrderStatus.PENDING.value,
+            "total_amount": float(total_amount)
+        })
+        _take_stock(db, quantities, tenant_id, order_data.hold_token)
+        _record_orders_in_rollups(db, [db_order.id])  # Hot rollup rows are locked from here to the commit
+        order_id = db_order.id
+        db.commit()  # Returns the connection to the pool before the gateway call
+    except Exception:
+        db.rollback()
+        raise
+    
+    # Stage 2: authorize the payment - no database access until it returns
+    try:
         payment_result = MockPaymentGateway.process_payment({
             "card_number": order_data.payment.card_number,
             "expiry_month": order_data.payment.expiry_month,
@@ -529,51 +909,148 @@ def create_order_with_payment(db: Session, order_data: schemas.OrderCreateWithPa
             "amount": float(total_amount),
             "currency": "USD"
         })
-        
-        if not payment_result["success"]:
-            return {"success": False, "error": payment_result["error"], "order": None}
-        
-        # Create order
-        order_number = generate_order_number(db, tenant_id)
-        db_order = models.Order(
-            order_number=order_number,
-            customer_id=customer_id,
-            tenant_id=tenant_id,
-            total_amount=total_amount,
-            shipping_address_id=shipping_address.id,
-            status=models.OrderStatus.CONFIRMED  # Auto-confirm paid orders
+    except Exception as e:
+        payment_result = {"success": False, "error": f"Payment processing failed: {e}", "transaction_id": None}
+    
+    # Stage 3: confirm, or compensate by cancelling and restoring the stock
+    try:
+        if payment_result["success"]:
+            confirmed = _transition_pending_order(db, order_id, models.OrderStatus.CONFIRMED)  # Auto-confirm paid orders
+            if not confirmed:
+                current_status = db.query(models.Order.status).filter(models.Order.id == order_id).scalar()
+                if current_status == models.OrderStatus.CANCELLED:
+                    # The order was cancelled while the payment was in flight
+                    db.rollback()
+                    MockPaymentGateway.refund_payment(payment_result["transaction_id"], float(total_amount))
+                    return {"success": False, "error": "Order was cancelled during payment", "order": None}
+                # An admin already moved the order on (e.g. to processing): it is paid, keep the charge
+            add_outbox_event(db, tenant_id, "order.confirmed", order_id, {
+                "transaction_id": payment_result["transaction_id"],
+                "amount": float(total_amount)
+            })
+        else:
+            if _transition_pending_order(db, order_id, models.OrderStatus.CANCELLED):
+                _apply_inventory_deltas(db, quantities)
+            add_outbox_event(db, tenant_id, "order.payment_failed", order_id, {
+                "error": payment_result["error"]
+            })
+        db.commit()
+    except Exception:
+        db.rollback()
+        if payment_result["success"]:
+            MockPaymentGateway.refund_payment(payment_result["transaction_id"], float(total_amount))
+        raise
+    
+    if not payment_result["success"]:
+        return {"success": False, "error": payment_result["error"], "order": None}
+    
+    db.refresh(db_order)
+    
+    return {
+        "success": True,
+        "order": db_order,
+        "payment": payment_result
+    }
+
+def _transition_pending_order(db: Session, order_id: int, status: models.OrderStatus) -> bool:
+    """Move an order out of PENDING; False if something else already changed it"""
+    updated = db.execute(
+        sa.update(models.Order.__table__)
+        .where(
+            models.Order.__table__.c.id == order_id,
+            models.Order.__table__.c.status == models.OrderStatus.PENDING
         )
-        db.add(db_order)
-        db.flush()  # Get order ID
-        
-        # Create order items and update inventory
-        for item_data in order_items_data:
-            # Create order item
-            db_order_item = models.OrderItem(
-                order_id=db_order.id,
-                product_id=item_data['product_id'],
-                quantity=item_data['quantity'],
-                unit_price=item_data['unit_price'],
-                total_price=item_data['total_price']
+        .values(status=status, updated_at=sa.func.now())
+    ).rowcount
+    if updated != 1:
+        return False
+    _move_orders_in_rollups(db, [order_id], status, previous_status=models.OrderStatus.PENDING)
+    if status not in NON_BUYING_STATUSES:
+        _record_customers_in_sketches(db, models.Order.id == order_id)
+    return True
+
+# --- Inventory Hold CRUD ---
+
+INVENTORY_HOLD_TTL_MINUTES = int(os.getenv("INVENTORY_HOLD_TTL_MINUTES", 10))
+# Holds need no login, so cap what a single checkout can take off the shelf
+INVENTORY_HOLD_MAX_LINE_QUANTITY = int(os.getenv("INVENTORY_HOLD_MAX_LINE_QUANTITY", 10))
+INVENTORY_HOLD_MAX_QUANTITY = int(os.getenv("INVENTORY_HOLD_MAX_QUANTITY", 50))
+
+def create_inventory_holds(
+    db: Session,
+    items: List[schemas.OrderItemCreate],
+    tenant_id: int,
+    hold_token: Optional[str] = None
+):
+    """
+    Reserve stock for a checkout for INVENTORY_HOLD_TTL_MINUTES.
+    Passing an existing hold_token replaces that checkout's holds (e.g. after
+    the cart changed) and restarts the timer. A checkout may hold at most
+    INVENTORY_HOLD_MAX_LINE_QUANTITY units of a product and
+    INVENTORY_HOLD_MAX_QUANTITY units in total.
+    """
+    import datetime
+    import uuid
+    hold_token = hold_token or str(uuid.uuid4())
+    
+    requested = _merge_line_quantities(items)
+    for product_id, quantity in requested.items():
+        if quantity > INVENTORY_HOLD_MAX_LINE_QUANTITY:
+            raise ValueError(f"At most {INVENTORY_HOLD_MAX_LINE_QUANTITY} units of product {product_id} can be held")
+    if sum(requested.values()) > INVENTORY_HOLD_MAX_QUANTITY:
+        raise ValueError(f"At most {INVENTORY_HOLD_MAX_QUANTITY} units can be held per checkout")
+    
+    try:
+        # Locking the products serializes hold creation per product, so two
+        # checkouts cannot both hold the last units
+        products_by_id, quantities = _load_order_products(
+            db, items, tenant_id, lock=True, hold_token=hold_token
+        )
+        table = models.InventoryHold.__table__
+        db.execute(sa.delete(table).where(
+            table.c.hold_token == hold_token,
+            table.c.tenant_id == tenant_id
+        ))
+        # Expiry is taken from the database clock, which the sweeper compares against
+        expires_at = db.execute(
+            sa.select(sa.func.now() + datetime.timedelta(minutes=INVENTORY_HOLD_TTL_MINUTES))
+        ).scalar()
+        db.add_all([
+            models.InventoryHold(
+                hold_token=hold_token,
+                tenant_id=tenant_id,
+                product_id=product_id,
+                quantity=quantity,
+                expires_at=expires_at
             )
-            db.add(db_order_item)
-            
-            # Update product inventory
-            product = item_data['product']
-            product.quantity -= item_data['quantity']
-            db.add(product)
-        
+            for product_id, quantity in quantities.items()
+        ])
         db.commit()
-        db.refresh(db_order)
-        
-        return {
-            "success": True,
-            "order": db_order,
-            "payment": payment_result
-        }
-        
-    except Exception as e:
-        raise e
+    except Exception:
+        db.rollback()
+        raise
+    
+    return {
+        "hold_token": hold_token,
+        "expires_at": expires_at,
+        "items": [{"product_id": pid, "quantity": qty} for pid, qty in quantities.items()]
+    }
+
+def release_inventory_holds(db: Session, hold_token: str, tenant_id: int):
+    """Give held stock back before the hold expires (checkout abandoned)"""
+    table = models.InventoryHold.__table__
+    released = db.execute(sa.delete(table).where(
+        table.c.hold_token == hold_token,
+        table.c.tenant_id == tenant_id
+    )).rowcount
+    db.commit()
+    return released
+
+def purge_expired_inventory_holds(db: Session):
+    table = models.InventoryHold.__table__
+    purged = db.execute(sa.delete(table).where(table.c.expires_at <= sa.func.now())).rowcount
+    db.commit()
+    return purged
 
 def get_orders_by_tenant(db: Session, tenant_id: int, skip: int = 0, limit: int = 100):
     return db.query(models.Order).filter(
@@ -586,68 +1063,994 @@ def get_order_by_id(db: Session, order_id: int, tenant_id: int):
         models.Order.tenant_id == tenant_id
     ).first()
 
+# Statuses that take a cancelled order's stock out of inventory again
+REACTIVATING_STATUSES = {
+    models.OrderStatus.CONFIRMED,
+    models.OrderStatus.PROCESSING,
+    models.OrderStatus.SHIPPED
+}
+
+def bulk_update_order_status(db: Session, order_ids: List[int], status: models.OrderStatus, tenant_id: int):
+    """
+    Move many orders of a tenant to one status in a single transaction.
+    Inventory changes from cancellations (stock restored) and reactivations
+    (stock taken again) are summed per product and applied with one UPDATE.
+    Returns one outcome per requested order id: updated, unchanged, not_found,
+    or insufficient_inventory (a cancelled order whose stock is gone).
+    """
+    order_ids = list(dict.fromkeys(order_ids))
+    if not order_ids:
+        return []
+    
+    orders = db.query(models.Order).filter(
+        models.Order.id == _id_array(order_ids),
+        models.Order.tenant_id == tenant_id
+    ).order_by(models.Order.id).with_for_update().all()
+    orders_by_id = {o.id: o for o in orders}
+    
+    changing = [o for o in orders if o.status != status]
+    cancelling = [o.id for o in changing if status == models.OrderStatus.CANCELLED]
+    reactivating = [
+        o.id for o in changing
+        if o.status == models.OrderStatus.CANCELLED and status in REACTIVATING_STATUSES
+    ]
+    
+    # Line quantities per order and product for every order that moves stock
+    items_by_order: Dict[int, Dict[int, int]] = {}
+    if cancelling or reactivating:
+        rows = db.query(
+            models.OrderItem.order_id,
+            models.OrderItem.product_id,
+            sa.func.sum(models.OrderItem.quantity)
+        ).filter(
+            models.OrderItem.order_id == _id_array(cancelling + reactivating)
+        ).group_by(models.OrderItem.order_id, models.OrderItem.product_id).all()
+        for order_id, product_id, quantity in rows:
+            items_by_order.setdefault(order_id, {})[product_id] = int(quantity)
+    
+    deltas: Dict[int, int] = {}
+    for order_id in cancelling:
+        for product_id, quantity in items_by_order.get(order_id, {}).items():
+            deltas[product_id] = deltas.get(product_id, 0) + quantity
+    
+    rejected = set()
+    if reactivating:
+        # Reactivated orders take stock again, first come first served by order id.
+        # Like checkout, only stock not held by active checkouts is available.
+        product_ids = {pid for oid in reactivating for pid in items_by_order.get(oid, {})}
+        stock = dict(db.query(models.Product.id, models.Product.quantity - _held_quantity()).filter(
+            models.Product.id == _id_array(product_ids),
+            models.Product.tenant_id == tenant_id
+        ).order_by(models.Product.id).with_for_update(of=models.Product).all()) if product_ids else {}
+        
+        for order_id in reactivating:
+            needed = items_by_order.get(order_id, {})
+            if any(stock.get(pid, 0) + deltas.get(pid, 0) < qty for pid, qty in needed.items()):
+                rejected.add(order_id)
+                continue
+            for product_id, quantity in needed.items():
+                deltas[product_id] = deltas.get(product_id, 0) - quantity
+    
+    updated_ids = [o.id for o in changing if o.id not in rejected]
+    if updated_ids:
+        _apply_inventory_deltas(db, deltas)
+        _move_orders_in_rollups(db, updated_ids, status)
+        confirming = [o.id for o in changing if o.id not in rejected and o.status in NON_BUYING_STATUSES]
+        if confirming and status not in NON_BUYING_STATUSES:
+            _record_customers_in_sketches(db, models.Order.id == _id_array(confirming))
+        db.execute(
+            sa.update(models.Order.__table__)
+            .where(models.Order.__table__.c.id == _id_array(updated_ids))
+            .values(status=status, updated_at=sa.func.now())
+        )
+        for order in changing:
+            if order.id not in rejected:
+                add_outbox_event(db, tenant_id, "order.status_changed", order.id, {
+                    "order_number": order.order_number,
+                    "previous_status": order.status.value,
+                    "status": status.value
+                })
+    db.commit()
+    
+    if updated_ids:
+        logger.info(f"Tenant {tenant_id}: {len(updated_ids)} orders moved to {status.value}, inventory adjusted for {len(deltas)} products")
+    
+    results = []
+    for order_id in order_ids:
+        order = orders_by_id.get(order_id)
+        if not order:
+            outcome = "not_found"
+        elif order_id in rejected:
+            outcome = "insufficient_inventory"
+        elif order_id in updated_ids:
+            outcome = "updated"
+        else:
+            outcome = "unchanged"
+        results.append({"order_id": order_id, "outcome": outcome})
+    return results
+
 def update_order_status(db: Session, order_id: int, status: models.OrderStatus, tenant_id: int):
-    db_order = get_order_by_id(db, order_id, tenant_id)
-    if not db_order:
+    """Change one order's status, restoring or re-taking inventory as needed"""
+    result = bulk_update_order_status(db, [order_id], status, tenant_id)[0]
+    if result["outcome"] == "not_found":
         return None
+    if result["outcome"] == "insufficient_inventory":
+        raise InsufficientInventoryError("Insufficient inventory to reactivate this order")
+    return get_order_by_id(db, order_id, tenant_id)
+
+# --- Sales Rollup CRUD ---
+
+# "rollup" reads analytics from the daily rollup tables; "raw" aggregates
+# orders and order_items directly (e.g. before backfill-rollups has run)
+ANALYTICS_SOURCE = os.getenv("ANALYTICS_SOURCE", "rollup")
+
+def _rollup_day():
+    return sa.cast(models.Order.created_at, sa.Date)
+
+def _apply_sales_rollups(db: Session, order_filter, moves):
+    """
+    Apply the contribution of the orders matching order_filter to the daily
+    rollups. moves is a list of (sign, status) pairs: sign 1 adds and -1
+    removes, status None uses each order's current status. A status change is
+    one statement per table (remove at the old status, add at the new one),
+    upserted in key order so concurrent writers lock rows consistently.
+    """
+    day = _rollup_day().label("day")
     
-    # Store the previous status to determine if inventory needs to be restored
-    previous_status = db_order.status
-    
-    # Prevent unnecessary updates
-    if previous_status == status:
-        return db_order
+    def status_for(status):
+        if status is None:
+            return models.Order.status
+        return sa.cast(sa.literal(status.name), models.Order.status.type)
     
-    print(f"📋 Order {db_order.order_number}: {previous_status.value} → {status.value}")
+    # Orders and order revenue per (tenant, day, status)
+    order_parts = []
+    for sign, status in moves:
+        status_column = status_for(status)
+        keys = [models.Order.tenant_id, day] + ([status_column] if status is None else [])
+        order_parts.append(sa.select(
+            models.Order.tenant_id,
+            day,
+            status_column.label("status"),
+            (sign * sa.func.count(models.Order.id)).label("order_count"),
+            (sign * sa.func.sum(models.Order.total_amount)).label("revenue")
+        ).where(order_filter).group_by(*keys))
+    orders = sa.union_all(*order_parts).subquery()
+    order_keys = [orders.c.tenant_id, orders.c.day, orders.c.status]
+    order_rows = sa.select(
+        *order_keys, sa.func.sum(orders.c.order_count), sa.func.sum(orders.c.revenue)
+    ).group_by(*order_keys).order_by(*order_keys)
     
-    # Update the order status
-    db_order.status = status  # type: ignore
+    order_insert = postgresql.insert(models.DailyOrderRollup).from_select(
+        ["tenant_id", "day", "status", "order_count", "revenue"], order_rows
+    )
+    order_rollup = models.DailyOrderRollup.__table__
+    db.execute(order_insert.on_conflict_do_update(
+        index_elements=["tenant_id", "day", "status"],
+        set_={
+            "order_count": order_rollup.c.order_count + order_insert.excluded.order_count,
+            "revenue": order_rollup.c.revenue + order_insert.excluded.revenue
+        }
+    ))
     
-    # Handle inventory restoration when order is cancelled
-    if status == models.OrderStatus.CANCELLED and previous_status != models.OrderStatus.CANCELLED:
-        print(f"❌ Cancelling order {db_order.order_number} - restoring inventory...")
+    # Each line counts under the category stamped on it when the order was
+    # recorded, so recategorising a product never moves its past sales
+    line_parts = []
+    for sign, status in moves:
+        lines = sa.select(
+            models.Order.tenant_id,
+            day,
+            status_for(status).label("status"),
+            sa.func.coalesce(models.OrderItem.category_id, 0).label("category_id"),
+            models.OrderItem.product_id,
+            models.OrderItem.order_id,
+            models.OrderItem.id.label("line_id"),
+            models.OrderItem.quantity,
+            models.OrderItem.total_price
+        ).select_from(models.OrderItem).join(
+            models.Order, models.OrderItem.order_id == models.Order.id
+        ).where(order_filter).subquery()
         
-        # Restore inventory for all items in the cancelled order
-        for order_item in db_order.order_items:
-            product = get_product_by_id(db, order_item.product_id)
-            if product and product.tenant_id == tenant_id:
-                # Store original quantity for logging
-                original_quantity = product.quantity
-                
-                # Add back the quantity that was reserved for this order
-                product.quantity += order_item.quantity
-                db.add(product)
-                
-                print(f"🔄 Product '{product.name}' (ID: {product.id}): {original_quantity} + {order_item.quantity} = {product.quantity}")
-            else:
-                print(f"⚠️  Warning: Could not restore inventory for product ID {order_item.product_id} - product not found or tenant mismatch")
+        # ROLLUP(product_id) adds a per-category subtotal row (product_id NULL -> 0)
+        category_subtotal = sa.func.grouping(lines.c.product_id) == 1
+        line_parts.append(sa.select(
+            lines.c.tenant_id,
+            lines.c.day,
+            lines.c.status,
+            lines.c.category_id,
+            sa.func.coalesce(lines.c.product_id, 0).label("product_id"),
+            (sign * sa.func.sum(lines.c.total_price)).label("revenue"),
+            (sign * sa.func.sum(lines.c.quantity)).label("units"),
+            (sign * sa.case(
+                (category_subtotal, sa.func.count(sa.distinct(lines.c.order_id))),
+                else_=sa.func.count(lines.c.line_id)
+            )).label("order_count")
+        ).group_by(
+            lines.c.tenant_id, lines.c.day, lines.c.status, lines.c.category_id,
+            sa.func.rollup(lines.c.product_id)
+        ))
+    sales = sa.union_all(*line_parts).subquery()
+    sales_keys = [sales.c.tenant_id, sales.c.day, sales.c.status, sales.c.category_id, sales.c.product_id]
+    sales_rows = sa.select(
+        *sales_keys,
+        sa.func.sum(sales.c.revenue),
+        sa.func.sum(sales.c.units),
+        sa.func.sum(sales.c.order_count)
+    ).group_by(*sales_keys).order_by(*sales_keys)
+    
+    sales_insert = postgresql.insert(models.DailySalesRollup).from_select(
+        ["tenant_id", "day", "status", "category_id", "product_id", "revenue", "units", "order_count"], sales_rows
+    )
+    sales_rollup = models.DailySalesRollup.__table__
+    db.execute(sales_insert.on_conflict_do_update(
+        index_elements=["tenant_id", "day", "status", "category_id", "product_id"],
+        set_={
+            "revenue": sales_rollup.c.revenue + sales_insert.excluded.revenue,
+            "units": sales_rollup.c.units + sales_insert.excluded.units,
+            "order_count": sales_rollup.c.order_count + sales_insert.excluded.order_count
+        }
+    ))
+    
+    # All-time product totals only count non-cancelled orders, so moves
+    # between two active statuses cancel out and are skipped
+    active = sales.c.status != models.OrderStatus.CANCELLED
+    def active_sum(column):
+        return sa.func.sum(sa.case((active, column), else_=0))
+    total_keys = [sales.c.tenant_id, sales.c.product_id]
+    total_rows = sa.select(
+        *total_keys,
+        active_sum(sales.c.revenue),
+        active_sum(sales.c.units),
+        active_sum(sales.c.order_count)
+    ).where(sales.c.product_id != 0).group_by(*total_keys).having(sa.or_(
+        active_sum(sales.c.units) != 0,
+        active_sum(sales.c.order_count) != 0
+    )).order_by(*total_keys)
+    
+    totals_insert = postgresql.insert(models.ProductSalesTotal).from_select(
+        ["tenant_id", "product_id", "revenue", "units", "order_count"], total_rows
+    )
+    product_totals = models.ProductSalesTotal.__table__
+    db.execute(totals_insert.on_conflict_do_update(
+        index_elements=["tenant_id", "product_id"],
+        set_={
+            "revenue": product_totals.c.revenue + totals_insert.excluded.revenue,
+            "units": product_totals.c.units + totals_insert.excluded.units,
+            "order_count": product_totals.c.order_count + totals_insert.excluded.order_count
+        }
+    ))
+
+def _stamp_line_categories(db: Session, order_filter):
+    """
+    Fix the rollup category of the unstamped lines of the matching orders:
+    the product's category_id, else the tenant category matching its legacy
+    category name, else 0 (uncategorised). Later status moves reuse it.
+    """
+    category_by_name = sa.select(models.Category.id).where(
+        models.Category.tenant_id == models.Order.tenant_id,
+        models.Category.name == models.Product.category
+    ).limit(1).scalar_subquery()
+    db.execute(
+        sa.update(models.OrderItem)
+        .where(
+            models.OrderItem.category_id.is_(None),
+            models.OrderItem.order_id == models.Order.id,
+            models.OrderItem.product_id == models.Product.id,
+            order_filter
+        )
+        .values(category_id=sa.func.coalesce(models.Product.category_id, category_by_name, 0))
+        .execution_options(synchronize_session=False)
+    )
+
+def _record_orders_in_rollups(db: Session, order_ids: List[int]):
+    """Count new orders in the daily rollups within the caller's transaction"""
+    db.flush()  # Line items are added to the session but not yet flushed
+    order_filter = models.Order.id == _id_array(order_ids)
+    _stamp_line_categories(db, order_filter)
+    _apply_sales_rollups(db, order_filter, [(1, None)])
+
+# Orders in these statuses don't make their customer a buyer: payment is
+# still pending, or the order was cancelled
+NON_BUYING_STATUSES = (models.OrderStatus.PENDING, models.OrderStatus.CANCELLED)
+
+def _record_customers_in_sketches(db: Session, order_filter):
+    """
+    Add the customers of newly confirmed orders to the daily customer
+    sketches (on the day the order was placed). Each register is raised in SQL
+    with set_byte/GREATEST, so concurrent orders never overwrite each other's
+    registers. Sketches cannot remove a customer again, so cancelling a
+    confirmed order leaves them counted until the next backfill-rollups.
+    """
+    positions = {}
+    for tenant_id, day, customer_id in db.query(
+        models.Order.tenant_id, _rollup_day(), models.Order.customer_id
+    ).filter(order_filter, models.Order.customer_id.is_not(None)):
+        index, rank = hll.register_position(customer_id)
+        key = (tenant_id, day, index)
+        positions[key] = max(rank, positions.get(key, 0))
+    
+    sketch = models.DailyCustomerSketch.__table__
+    for (tenant_id, day, index), rank in sorted(positions.items()):  # Key order avoids deadlocks
+        registers = hll.empty_registers()
+        registers[index] = rank
+        insert = postgresql.insert(sketch).values(tenant_id=tenant_id, day=day, registers=bytes(registers))
+        db.execute(insert.on_conflict_do_update(
+            index_elements=["tenant_id", "day"],
+            set_={"registers": sa.func.set_byte(sketch.c.registers, index, rank)},
+            where=sa.func.get_byte(sketch.c.registers, index) < rank
+        ))
+
+def _rebuild_customer_sketches(db: Session, order_filter, batch_size: int = 1000):
+    """Recompute the daily customer sketches of the matching orders from scratch"""
+    day = _rollup_day()
+    rows = db.query(models.Order.tenant_id, day, models.Order.customer_id).filter(
+        order_filter,
+        models.Order.customer_id.is_not(None),
+        models.Order.status.not_in(NON_BUYING_STATUSES)
+    ).distinct().order_by(models.Order.tenant_id, day).yield_per(10000)
+    
+    pending, current_key, registers = [], None, None
+    for tenant_id, order_day, customer_id in rows:
+        if (tenant_id, order_day) != current_key:
+            if current_key:
+                pending.append({"tenant_id": current_key[0], "day": current_key[1], "registers": bytes(registers)})
+            current_key, registers = (tenant_id, order_day), hll.empty_registers()
+            if len(pending) >= batch_size:
+                db.execute(sa.insert(models.DailyCustomerSketch), pending)
+                pending = []
+        hll.add(registers, customer_id)
+    if current_key:
+        pending.append({"tenant_id": current_key[0], "day": current_key[1], "registers": bytes(registers)})
+    if pending:
+        db.execute(sa.insert(models.DailyCustomerSketch), pending)
+
+def _move_orders_in_rollups(
+    db: Session,
+    order_ids: List[int],
+    status: models.OrderStatus,
+    previous_status: Optional[models.OrderStatus] = None
+):
+    """
+    Move orders between statuses in the daily rollups. Without previous_status
+    the orders' stored status is used, so call it before updating them.
+    """
+    if order_ids:
+        _apply_sales_rollups(db, models.Order.id == _id_array(order_ids), [(-1, previous_status), (1, status)])
+
+def rebuild_sales_rollups(db: Session, tenant_id: Optional[int] = None):
+    """
+    Recompute the daily rollups from orders, for one tenant or all of them.
+    The rollup tables are locked against concurrent writers until commit, so
+    orders placed while the rebuild runs are counted exactly once.
+    """
+    db.execute(sa.text(
+        "LOCK TABLE daily_order_rollups, daily_sales_rollups, product_sales_totals, daily_customer_sketches "
+        "IN EXCLUSIVE MODE"
+    ))
+    for table in (
+        models.DailyOrderRollup.__table__,
+        models.DailySalesRollup.__table__,
+        models.ProductSalesTotal.__table__,
+        models.DailyCustomerSketch.__table__
+    ):
+        delete = sa.delete(table)
+        if tenant_id is not None:
+            delete = delete.where(table.c.tenant_id == tenant_id)
+        db.execute(delete)
+    
+    order_filter = models.Order.tenant_id == tenant_id if tenant_id is not None else sa.true()
+    _stamp_line_categories(db, order_filter)
+    _apply_sales_rollups(db, order_filter, [(1, None)])
+    _rebuild_customer_sketches(db, order_filter)
+    db.commit()
+
+def _analytics_category(db: Session, tenant_id: int, category_id: Optional[int]):
+    return db.query(models.Category).filter(
+        models.Category.id == category_id,
+        models.Category.tenant_id == tenant_id
+    ).first()
+
+def _summarize_sales_overview(rows, days: int):
+    """Fold per-status (count, revenue, previous_revenue) rows into the overview response"""
+    total_revenue = prev_revenue = 0.0
+    total_orders = 0
+    status_distribution = []
+    for row in rows:
+        count = int(row.count or 0)
+        if count:
+            status_distribution.append({
+                "status": row.status,
+                "count": count,
+                "total_value": float(row.revenue or 0)
+            })
+        if row.status != models.OrderStatus.CANCELLED:
+            total_revenue += float(row.revenue or 0)
+            total_orders += count
+            prev_revenue += float(row.previous_revenue or 0)
+    
+    return {
+        "total_revenue": total_revenue,
+        "total_orders": total_orders,
+        "average_order_value": total_revenue / total_orders if total_orders > 0 else 0,
+        "revenue_growth_percentage": ((total_revenue - prev_revenue) / prev_revenue * 100) if prev_revenue > 0 else 0,
+        "status_distribution": status_distribution,
+        "period_days": days
+    }
+
+def _add_customer_metrics(db: Session, overview: dict, tenant_id: int, days: int, category_id: Optional[int]):
+    """
+    Add estimated unique customers and repeat rate (share of orders placed by
+    customers who already ordered in the period). Sketches are per tenant, so
+    category overviews leave both unset.
+    """
+    unique_customers = repeat_rate = None
+    if not category_id:
+        # Sketches only count customers of confirmed orders, so compare against those
+        buying_orders = sum(
+            status["count"] for status in overview["status_distribution"]
+            if status["status"] not in NON_BUYING_STATUSES
+        )
+        unique_customers = min(estimate_unique_customers(db, tenant_id, days), buying_orders)
+        repeat_rate = 1 - unique_customers / buying_orders if buying_orders else 0
+    overview.update({
+        "unique_customers": unique_customers,
+        "repeat_rate": repeat_rate,
+        "unique_customers_relative_error": hll.HLL_RELATIVE_ERROR
+    })
+    return overview
+
+def get_sales_overview(db: Session, tenant_id: int, days: int = 30, category_id: Optional[int] = None):
+    """
+    Revenue, order count, growth versus the previous period and status
+    distribution, computed in one grouped query over both periods.
+    """
+    if ANALYTICS_SOURCE == "raw":
+        return _add_customer_metrics(db, _get_sales_overview_raw(db, tenant_id, days, category_id), tenant_id, days, category_id)
+    
+    if category_id:
+        # An unknown category has no rollup rows, so it yields an empty overview
+        rollup = models.DailySalesRollup
+        source_filter = [rollup.category_id == category_id, rollup.product_id == 0]
+    else:
+        rollup = models.DailyOrderRollup
+        source_filter = []
+    
+    from_day = sa.func.current_date() - days
+    current_period = rollup.day > from_day
+    rows = db.query(
+        rollup.status,
+        sa.func.sum(rollup.order_count).filter(current_period).label("count"),
+        sa.func.sum(rollup.revenue).filter(current_period).label("revenue"),
+        sa.func.sum(rollup.revenue).filter(~current_period).label("previous_revenue")
+    ).filter(
+        rollup.tenant_id == tenant_id,
+        rollup.day > from_day - days,
+        *source_filter
+    ).group_by(rollup.status).all()
+    
+    return _add_customer_metrics(db, _summarize_sales_overview(rows, days), tenant_id, days, category_id)
+
+TREND_GRANULARITIES = ("hour", "day", "week", "month")
+
+def _trend_buckets(granularity: str, tz: str, days: int):
+    """
+    Return (bucket function for UTC timestamps, first bucket, series of bucket starts) for
+    a trend over the last `days` days in time zone tz. Buckets are whole
+    units of the granularity, so the first week or month may start before
+    the window does. Order timestamps are stored in UTC.
+    """
+    import datetime
+    # granularity is validated against TREND_GRANULARITIES, so it is safe to inline
+    unit = sa.literal_column(f"'{granularity}'")
+    step = sa.literal_column(f"interval '1 {granularity}'")
+    if granularity == "hour":
+        base, offset = "hour", datetime.timedelta(hours=days * 24 - 1)
+    else:
+        base, offset = "day", datetime.timedelta(days=days - 1)
+    
+    local_now = sa.func.timezone(tz, sa.func.now())
+    first_bucket = sa.func.date_trunc(unit, sa.func.date_trunc(sa.literal_column(f"'{base}'"), local_now)
+        - sa.literal(offset, sa.Interval()))
+    series = sa.select(
+        sa.func.generate_series(first_bucket, sa.func.date_trunc(unit, local_now), step).label("bucket")
+    ).subquery("buckets")
+    
+    def local_bucket(utc_timestamp):
+        return sa.func.date_trunc(unit, sa.func.timezone(tz, sa.func.timezone("UTC", utc_timestamp)))
+    
+    return local_bucket, first_bucket, series
+
+def get_revenue_trend(
+    db: Session,
+    tenant_id: int,
+    days: int = 30,
+    category_id: Optional[int] = None,
+    granularity: str = "day",
+    tz: str = "UTC"
+):
+    """
+    Revenue and order count of non-cancelled orders per hour, day, week or
+    month in time zone tz, one row per bucket including empty ones. Daily and
+    coarser UTC trends are read from the rollups; others aggregate orders.
+    """
+    if granularity not in TREND_GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(TREND_GRANULARITIES)}")
+    
+    local_bucket, first_bucket, series = _trend_buckets(granularity, tz, days)
+    if ANALYTICS_SOURCE == "raw" or granularity == "hour" or tz not in ("UTC", "Etc/UTC"):
+        totals = _revenue_trend_raw_totals(db, tenant_id, category_id, tz, local_bucket, first_bucket)
+    else:
+        if category_id:
+            # An unknown category has no rollup rows, so it yields an empty trend
+            rollup = models.DailySalesRollup
+            source_filter = [rollup.category_id == category_id, rollup.product_id == 0]
+        else:
+            rollup = models.DailyOrderRollup
+            source_filter = []
+        bucket = sa.func.date_trunc(sa.literal_column(f"'{granularity}'"), sa.cast(rollup.day, sa.DateTime))
+        totals = sa.select(
+            bucket.label("bucket"),
+            sa.func.sum(rollup.revenue).label("revenue"),
+            sa.func.sum(rollup.order_count).label("order_count")
+        ).where(
+            rollup.tenant_id == tenant_id,
+            rollup.day >= sa.cast(first_bucket, sa.Date),
+            rollup.status != models.OrderStatus.CANCELLED,
+            *source_filter
+        ).group_by(bucket).subquery("totals")
+    
+    query = sa.select(
+        series.c.bucket,
+        sa.func.coalesce(totals.c.revenue, 0).label("revenue"),
+        sa.func.coalesce(totals.c.order_count, 0).label("order_count")
+    ).select_from(series).outerjoin(totals, totals.c.bucket == series.c.bucket).order_by(series.c.bucket)
+    try:
+        rows = db.execute(query).all()
+    except sa.exc.DataError as e:
+        db.rollback()
+        raise ValueError(f"Unknown time zone: {tz}") from e
+    
+    return [
+        {
+            "date": (row.bucket if granularity == "hour" else row.bucket.date()).isoformat(),
+            "revenue": float(row.revenue or 0),
+            "order_count": int(row.order_count)
+        }
+        for row in rows
+    ]
+
+def estimate_unique_customers(db: Session, tenant_id: int, days: int) -> int:
+    """Approximate number of distinct customers who ordered in the last `days` days"""
+    sketch = models.DailyCustomerSketch
+    sketches = db.query(sketch.registers).filter(
+        sketch.tenant_id == tenant_id,
+        sketch.day > sa.func.current_date() - days
+    )
+    return hll.estimate(hll.merge(row.registers for row in sketches))
+
+UNIQUE_CUSTOMER_GRANULARITIES = ("day", "week", "month")
+
+def get_unique_customer_trend(db: Session, tenant_id: int, days: int = 30, granularity: str = "day"):
+    """Approximate distinct customers per UTC day, week or month, merged from the daily sketches"""
+    import datetime
+    if granularity not in UNIQUE_CUSTOMER_GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(UNIQUE_CUSTOMER_GRANULARITIES)}")
+    
+    def bucket_start(day):
+        if granularity == "week":
+            return day - datetime.timedelta(days=day.weekday())
+        if granularity == "month":
+            return day.replace(day=1)
+        return day
+    
+    def next_bucket(day):
+        if granularity == "week":
+            return day + datetime.timedelta(days=7)
+        if granularity == "month":
+            return (day + datetime.timedelta(days=32)).replace(day=1)
+        return day + datetime.timedelta(days=1)
+    
+    today = datetime.datetime.utcnow().date()
+    first_bucket = bucket_start(today - datetime.timedelta(days=days - 1))
+    sketch = models.DailyCustomerSketch
+    sketches_by_bucket = {}
+    for day, registers in db.query(sketch.day, sketch.registers).filter(
+        sketch.tenant_id == tenant_id,
+        sketch.day >= first_bucket
+    ):
+        sketches_by_bucket.setdefault(bucket_start(day), []).append(registers)
+    
+    buckets = []
+    bucket = first_bucket
+    while bucket <= today:
+        buckets.append({
+            "date": bucket.isoformat(),
+            "unique_customers": hll.estimate(hll.merge(sketches_by_bucket.get(bucket, [])))
+        })
+        bucket = next_bucket(bucket)
+    
+    return {"granularity": granularity, "relative_error": hll.HLL_RELATIVE_ERROR, "buckets": buckets}
+
+TOP_PRODUCT_RANKINGS = ("revenue", "units")
+
+def get_top_products(
+    db: Session,
+    tenant_id: int,
+    days: int = 30,
+    limit: int = 10,
+    category_id: Optional[int] = None,
+    rank_by: str = "revenue",
+    all_time: bool = False
+):
+    """
+    Best-selling products over the period, ranked by revenue or units sold.
+    all_time reads the maintained per-product totals: an index scan of the
+    top N rows instead of an aggregate over the daily rollups.
+    """
+    if ANALYTICS_SOURCE == "raw":
+        return _get_top_products_raw(db, tenant_id, days, limit, category_id, rank_by, all_time)
+    
+    category = _analytics_category(db, tenant_id, category_id) if category_id else None
+    
+    if all_time:
+        totals = models.ProductSalesTotal
+        query = db.query(
+            models.Product.id,
+            models.Product.name,
+            totals.revenue.label("total_revenue"),
+            totals.units.label("total_quantity"),
+            totals.order_count
+        ).join(
+            models.Product, totals.product_id == models.Product.id
+        ).filter(
+            totals.tenant_id == tenant_id,
+            totals.units > 0
+        )
+        if category:
+            query = query.filter(sa.or_(
+                models.Product.category_id == category.id,
+                models.Product.category == category.name
+            ))
+        rank_column = totals.units if rank_by == "units" else totals.revenue
+        top_products = query.order_by(rank_column.desc(), totals.product_id).limit(limit).all()
+    else:
+        rollup = models.DailySalesRollup
+        query = db.query(
+            rollup.product_id,
+            sa.func.sum(rollup.revenue).label("total_revenue"),
+            sa.func.sum(rollup.units).label("total_quantity"),
+            sa.func.sum(rollup.order_count).label("order_count")
+        ).filter(
+            rollup.tenant_id == tenant_id,
+            rollup.day > sa.func.current_date() - days,
+            rollup.status != models.OrderStatus.CANCELLED,
+            rollup.product_id != 0
+        )
+        if category:
+            query = query.filter(rollup.category_id == category.id)
         
-        print(f"✅ Inventory restoration completed for order {db_order.order_number}")
-    
-    # Handle case where cancelled order is being reactivated (edge case)
-    elif previous_status == models.OrderStatus.CANCELLED and status in [
-        models.OrderStatus.CONFIRMED, 
-        models.OrderStatus.PROCESSING, 
-        models.OrderStatus.SHIPPED
-    ]:
-        print(f"🔄 Reactivating cancelled order {db_order.order_number} - reducing inventory again...")
+        window = query.group_by(rollup.product_id).having(
+            sa.func.sum(rollup.units) > 0
+        ).subquery()
+        rank_column = window.c.total_quantity if rank_by == "units" else window.c.total_revenue
+        top_products = db.query(
+            models.Product.id,
+            models.Product.name,
+            window.c.total_revenue,
+            window.c.total_quantity,
+            window.c.order_count
+        ).join(
+            window, window.c.product_id == models.Product.id
+        ).order_by(rank_column.desc(), models.Product.id).limit(limit).all()
+    
+    return [
+        {
+            "product_id": product.id,
+            "product_name": product.name,
+            "total_revenue": float(product.total_revenue or 0),
+            "total_quantity": int(product.total_quantity),
+            "order_count": int(product.order_count),
+            "average_price": float(product.total_revenue / product.total_quantity) if product.total_quantity > 0 else 0
+        }
+        for product in top_products
+    ]
+
+def _get_sales_overview_raw(db: Session, tenant_id: int, days: int, category_id: Optional[int]):
+    """
+    Aggregate orders directly (ANALYTICS_SOURCE=raw): one scan of both periods,
+    split with FILTER clauses and grouped by status.
+    """
+    import datetime
+    from_date = datetime.datetime.now() - datetime.timedelta(days=days)
+    prev_from_date = from_date - datetime.timedelta(days=days)
+    current_period = models.Order.created_at >= from_date
+    
+    if category_id:
+        # Match on category_id or, for older products, the category name.
+        # Revenue is the category's line totals, counting each order once.
+        category_name = sa.select(models.Category.name).where(
+            models.Category.id == category_id,
+            models.Category.tenant_id == tenant_id
+        ).scalar_subquery()
+        revenue = models.OrderItem.total_price
+        query = db.query(
+            models.Order.status,
+            sa.func.count(sa.distinct(models.Order.id)).filter(current_period).label("count"),
+            sa.func.sum(revenue).filter(current_period).label("revenue"),
+            sa.func.sum(revenue).filter(~current_period).label("previous_revenue")
+        ).join(
+            models.OrderItem, models.Order.id == models.OrderItem.order_id
+        ).join(
+            models.Product, models.OrderItem.product_id == models.Product.id
+        ).filter(
+            sa.or_(
+                models.Product.category_id == category_id,
+                models.Product.category == category_name
+            )
+        )
+    else:
+        revenue = models.Order.total_amount
+        query = db.query(
+            models.Order.status,
+            sa.func.count(models.Order.id).filter(current_period).label("count"),
+            sa.func.sum(revenue).filter(current_period).label("revenue"),
+            sa.func.sum(revenue).filter(~current_period).label("previous_revenue")
+        )
+    
+    rows = query.filter(
+        models.Order.tenant_id == tenant_id,
+        models.Order.created_at >= prev_from_date
+    ).group_by(models.Order.status).all()
+    
+    return _summarize_sales_overview(rows, days)
+
+def _revenue_trend_raw_totals(db: Session, tenant_id: int, category_id: Optional[int], tz: str, local_bucket, first_bucket):
+    """Per-bucket totals aggregated from orders (ANALYTICS_SOURCE=raw, hourly or non-UTC trends)"""
+    bucket = local_bucket(models.Order.created_at)
+    conditions = [
+        models.Order.tenant_id == tenant_id,
+        models.Order.status != models.OrderStatus.CANCELLED,
+        # First bucket converted back to UTC so the created_at index stays usable
+        models.Order.created_at >= sa.func.timezone("UTC", sa.func.timezone(tz, first_bucket))
+    ]
+    
+    if category_id:
+        # Category trends count matching line revenue once per order; an
+        # unknown category matches no lines, so it yields an empty trend
+        category = _analytics_category(db, tenant_id, category_id)
+        return sa.select(
+            bucket.label("bucket"),
+            sa.func.sum(models.OrderItem.total_price).label("revenue"),
+            sa.func.count(sa.distinct(models.Order.id)).label("order_count")
+        ).select_from(models.Order).join(
+            models.OrderItem, models.OrderItem.order_id == models.Order.id
+        ).join(
+            models.Product, models.OrderItem.product_id == models.Product.id
+        ).where(
+            *conditions,
+            sa.or_(
+                models.Product.category_id == category_id,
+                models.Product.category == category.name
+            ) if category else sa.false()
+        ).group_by(bucket).subquery("totals")
+    
+    return sa.select(
+        bucket.label("bucket"),
+        sa.func.sum(models.Order.total_amount).label("revenue"),
+        sa.func.count(models.Order.id).label("order_count")
+    ).where(*conditions).group_by(bucket).subquery("totals")
+
+def _get_top_products_raw(
+    db: Session,
+    tenant_id: int,
+    days: int,
+    limit: int,
+    category_id: Optional[int],
+    rank_by: str = "revenue",
+    all_time: bool = False
+):
+    """Aggregate orders directly (ANALYTICS_SOURCE=raw)"""
+    import datetime
+    from_date = datetime.datetime.now() - datetime.timedelta(days=days)
+    
+    # Base query for top products
+    query = db.query(
+        models.Product.id,
+        models.Product.name,
+        sa.func.sum(models.OrderItem.total_price).label('total_revenue'),
+        sa.func.sum(models.OrderItem.quantity).label('total_quantity'),
+        sa.func.count(models.OrderItem.id).label('order_count')
+    ).join(
+        models.OrderItem, models.Product.id == models.OrderItem.product_id
+    ).join(
+        models.Order, models.OrderItem.order_id == models.Order.id
+    ).filter(
+        models.Product.tenant_id == tenant_id,
+        models.Order.status != models.OrderStatus.CANCELLED
+    )
+    if not all_time:
+        query = query.filter(models.Order.created_at >= from_date)
+    
+    # Add category filter if specified
+    if category_id:
+        # Get category name for fallback filtering
+        category = db.query(models.Category).filter(
+            models.Category.id == category_id,
+            models.Category.tenant_id == tenant_id
+        ).first()
         
-        # Re-reduce inventory for reactivated order
-        for order_item in db_order.order_items:
-            product = get_product_by_id(db, order_item.product_id)
-            if product and product.tenant_id == tenant_id:
-                if product.quantity >= order_item.quantity:
-                    original_quantity = product.quantity
-                    product.quantity -= order_item.quantity
-                    db.add(product)
-                    print(f"🔄 Product '{product.name}' (ID: {product.id}): {original_quantity} - {order_item.quantity} = {product.quantity}")
-                else:
-                    print(f"⚠️  Warning: Insufficient inventory for product '{product.name}' (ID: {product.id}). Available: {product.quantity}, Required: {order_item.quantity}")
-                    # You might want to raise an exception here or handle this case differently
+        if category:
+            query = query.filter(
+                sa.or_(
+                    models.Product.category_id == category_id,
+                    models.Product.category == category.name
+                )
+            )
+    
+    top_products = query.group_by(
+        models.Product.id, models.Product.name
+    ).order_by(
+        sa.desc('total_quantity' if rank_by == "units" else 'total_revenue')
+    ).limit(limit).all()
+    
+    return [
+        {
+            "product_id": product.id,
+            "product_name": product.name,
+            "total_revenue": float(product.total_revenue or 0),
+            "total_quantity": product.total_quantity,
+            "order_count": product.order_count,
+            "average_price": float(product.total_revenue / product.total_quantity) if product.total_quantity > 0 else 0
+        }
+        for product in top_products
+    ]
+
+# --- Customer RFM CRUD ---
+
+def get_customer_rfm_scores(db: Session, tenant_id: int, segment: Optional[str] = None, skip: int = 0, limit: int = 50):
+    """
+    One page of a tenant's RFM scores, highest spend first, with customer
+    names and the customer count of every segment.
+    """
+    score = models.CustomerRfmScore
+    segment_counts = dict(db.query(score.segment, sa.func.count()).filter(
+        score.tenant_id == tenant_id
+    ).group_by(score.segment).all())
+    
+    query = db.query(score, models.Customer).join(
+        models.Customer, score.customer_id == models.Customer.id
+    ).filter(score.tenant_id == tenant_id)
+    if segment:
+        query = query.filter(score.segment == segment)
+    rows = query.order_by(score.monetary.desc(), score.customer_id).offset(skip).limit(limit).all()
+    
+    return {
+        "total": segment_counts.get(segment, 0) if segment else sum(segment_counts.values()),
+        "segments": segment_counts,
+        "computed_at": rows[0][0].computed_at if rows else None,
+        "items": [
+            {
+                "customer_id": customer.id,
+                "email": customer.email,
+                "name": f"{customer.first_name} {customer.last_name}",
+                "segment": row.segment,
+                "recency_days": row.recency_days,
+                "frequency": row.frequency,
+                "monetary": float(row.monetary),
+                "r_score": row.r_score,
+                "f_score": row.f_score,
+                "m_score": row.m_score
+            }
+            for row, customer in rows
+        ]
+    }
+
+# --- Idempotency Key CRUD ---
+
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", 24))
+
+def _idempotency_key_filter(tenant_id: int, scope: str, key: str):
+    table = models.IdempotencyKey.__table__
+    return sa.and_(table.c.tenant_id == tenant_id, table.c.scope == scope, table.c.key == key)
+
+def get_idempotency_key(db: Session, tenant_id: int, scope: str, key: str):
+    return db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.tenant_id == tenant_id,
+        models.IdempotencyKey.scope == scope,
+        models.IdempotencyKey.key == key,
+        models.IdempotencyKey.expires_at > sa.func.now()
+    ).populate_existing().first()
+
+def claim_idempotency_key(db: Session, tenant_id: int, scope: str, key: str, request_hash: str):
+    """
+    Try to take ownership of an idempotency key for a new request.
+    Returns (True, None) when the caller now owns the key, otherwise (False, record)
+    with the existing record - completed, or still in flight for a concurrent
+    duplicate. The record is None if it was released or expired in the meantime.
+    """
+    import datetime
+    table = models.IdempotencyKey.__table__
     
+    # Expired keys may be reused
+    db.execute(sa.delete(table).where(
+        _idempotency_key_filter(tenant_id, scope, key),
+        table.c.expires_at <= sa.func.now()
+    ))
+    claimed_id = db.execute(
+        postgresql.insert(table).values(
+            tenant_id=tenant_id,
+            scope=scope,
+            key=key,
+            request_hash=request_hash,
+            expires_at=sa.func.now() + datetime.timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+        ).on_conflict_do_nothing(
+            index_elements=[table.c.tenant_id, table.c.scope, table.c.key]
+        ).returning(table.c.id)
+    ).scalar()
     db.commit()
-    db.refresh(db_order)
-    return db_order
+    
+    if claimed_id is not None:
+        return True, None
+    return False, get_idempotency_key(db, tenant_id, scope, key)
+
+def complete_idempotency_key(db: Session, tenant_id: int, scope: str, key: str, status_code: int, response_body):
+    """Store the final response so replays of this key can return it"""
+    db.execute(
+        sa.update(models.IdempotencyKey.__table__)
+        .where(_idempotency_key_filter(tenant_id, scope, key))
+        .values(status_code=status_code, response_body=response_body)
+    )
+    db.commit()
+
+def release_idempotency_key(db: Session, tenant_id: int, scope: str, key: str):
+    """Drop an unfinished key so the client can retry the request"""
+    db.rollback()
+    db.execute(sa.delete(models.IdempotencyKey.__table__).where(
+        _idempotency_key_filter(tenant_id, scope, key)
+    ))
+    db.commit()
+
+def purge_expired_idempotency_keys(db: Session):
+    table = models.IdempotencyKey.__table__
+    purged = db.execute(sa.delete(table).where(table.c.expires_at <= sa.func.now())).rowcount
+    db.commit()
+    return purged
+
+# --- Outbox CRUD ---
+
+def add_outbox_event(db: Session, tenant_id: int, event_type: str, aggregate_id: int, payload: dict):
+    """
+    Record a domain event in the same transaction as the change that caused it.
+    The outbox worker delivers it after commit; nothing is written on rollback.
+    Connected admin dashboards receive it live once the transaction commits.
+    """
+    from .services.order_events import stage_order_event
+    
+    db_event = models.OutboxEvent(
+        tenant_id=tenant_id,
+        event_type=event_type,
+        aggregate_id=aggregate_id,
+        payload=payload
+    )
+    db.add(db_event)
+    stage_order_event(db, tenant_id, event_type, aggregate_id, payload)
+    return db_event
+
+def purge_processed_outbox_events(db: Session, retention_hours: float, limit: int = 1000):
+    """Delete up to limit events delivered (or given up on) more than retention_hours ago"""
+    import datetime
+    table = models.OutboxEvent.__table__
+    expired = sa.select(table.c.id).where(
+        table.c.processed_at < sa.func.now() - datetime.timedelta(hours=retention_hours)
+    ).order_by(table.c.processed_at).limit(limit)
+    purged = db.execute(sa.delete(table).where(table.c.id.in_(expired))).rowcount
+    db.commit()
+    return purged
+
+def get_pending_outbox_events(db: Session, limit: int = 100):
+    """Lock a batch of undelivered events; concurrent workers skip each other's rows"""
+    return db.query(models.OutboxEvent).filter(
+        models.OutboxEvent.processed_at.is_(None)
+    ).order_by(models.OutboxEvent.id).limit(limit).with_for_update(skip_locked=True).all()
 
 # --- Hero Banner CRUD ---
 
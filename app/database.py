@@ -1,19 +1,47 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import logging
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Per-route-class statement timeouts (ms) for the heavy read endpoints
+STATEMENT_TIMEOUTS_MS = {
+    "analytics": int(os.getenv("ANALYTICS_STATEMENT_TIMEOUT_MS", 15000)),
+    "search": int(os.getenv("SEARCH_STATEMENT_TIMEOUT_MS", 5000)),
+}
+STATEMENT_TIMEOUT_RETRY_AFTER_SECONDS = int(os.getenv("STATEMENT_TIMEOUT_RETRY_AFTER_SECONDS", 30))
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", 0.5))
+
 engine = create_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+@event.listens_for(SessionLocal, "after_begin")
+def _apply_statement_timeout(session, transaction, connection):
+    """Scope the session's statement timeout to each transaction and remember the connection for cancellation"""
+    timeout_ms = session.info.get("statement_timeout_ms")
+    if timeout_ms:
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+        session.info["dbapi_connection"] = connection.connection.dbapi_connection
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def _forget_connection(session, transaction):
+    # The connection goes back to the pool; never cancel another request's query on it
+    if transaction.parent is None:
+        session.info.pop("dbapi_connection", None)
+
 # Dependency to get the DB session
 def get_db():
     db = SessionLocal()
@@ -21,3 +49,36 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def _cancel_on_disconnect(request: Request, db):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+    dbapi_connection = db.info.get("dbapi_connection")
+    if dbapi_connection is not None:
+        logger.info(f"Client disconnected, cancelling query on {request.url.path}")
+        # psycopg2's cancel() opens a connection to the server and waits for the reply
+        await run_in_threadpool(dbapi_connection.cancel)
+
+def get_db_with_timeout(route_class: str):
+    """
+    Dependency factory for heavy read routes: statements time out after the
+    route class's limit (surfacing as 504, see main.py) and the running query
+    is cancelled when the client disconnects.
+    """
+    timeout_ms = STATEMENT_TIMEOUTS_MS[route_class]
+    
+    async def dependency(request: Request):
+        db = SessionLocal()
+        db.info["statement_timeout_ms"] = timeout_ms
+        watcher = asyncio.create_task(_cancel_on_disconnect(request, db))
+        try:
+            yield db
+        finally:
+            watcher.cancel()
+            db.info.pop("dbapi_connection", None)
+            await run_in_threadpool(db.close)
+    
+    return dependency
+
+get_analytics_db = get_db_with_timeout("analytics")
+get_search_db = get_db_with_timeout("search")
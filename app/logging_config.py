@@ -0,0 +1,146 @@
+"""
+Logging Setup
+Records are formatted as JSON lines in the calling thread and handed to a
+QueueListener, so request threads never block on stdout. Every record carries
+the request id and tenant id of the request that produced it.
+
+Environment:
+    LOG_LEVEL              root level (default INFO)
+    LOG_LEVELS             per-module levels, e.g. "app.crud=DEBUG,sqlalchemy.engine=WARNING"
+    LOG_FORMAT             "json" (default) or "text"
+    LOG_DEBUG_SAMPLE_RATE  fraction of DEBUG records kept (default 0.01) from modules
+                           not listed in LOG_LEVELS
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.01))
+
+# One mutable dict per request: worker threads run with a copy of the request's
+# context, so binding the tenant mutates the shared dict instead of the variable
+_log_context: ContextVar[Optional[dict]] = ContextVar("log_context", default=None)
+
+# Attributes every LogRecord has; anything else was passed via extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def bind_log_context(**fields):
+    """Attach fields (e.g. tenant_id) to all further log records of the current request"""
+    context = _log_context.get()
+    if context is not None:
+        context.update(fields)
+
+class ContextFilter(logging.Filter):
+    """Stamps request_id and tenant_id onto each record"""
+
+    def filter(self, record):
+        context = _log_context.get() or {}
+        record.request_id = context.get("request_id")
+        record.tenant_id = context.get("tenant_id")
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """
+    Keeps a random sample of DEBUG records; higher levels always pass, as do
+    records from loggers (or their children) given a level in LOG_LEVELS
+    """
+
+    def __init__(self, rate: float, exempt: Iterable[str] = ()):
+        super().__init__()
+        self.rate = rate
+        self.exempt = tuple(exempt)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or random.random() < self.rate:
+            return True
+        return any(record.name == name or record.name.startswith(name + ".") for name in self.exempt)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "tenant_id": getattr(record, "tenant_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+def configure_logging():
+    """Route all logging through a background QueueListener (idempotent)"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s %(tenant_id)s] %(message)s")
+
+    module_levels = {}
+    for entry in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        name, _, level = entry.partition("=")
+        module_levels[name.strip()] = level.strip().upper()
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(formatter)  # Formatted here so the listener only writes
+    # Modules switched to DEBUG on purpose keep every record
+    queue_handler.addFilter(DebugSamplingFilter(LOG_DEBUG_SAMPLE_RATE, exempt=module_levels))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for name, level in module_levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+class RequestContextMiddleware:
+    """ASGI middleware that opens a log context per request and echoes X-Request-ID"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex
+        token = _log_context.set({"request_id": request_id, "tenant_id": None})
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            _log_context.reset(token)
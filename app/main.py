@@ -1,9 +1,11 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from contextlib import asynccontextmanager
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware # Import CORSMiddleware
 import logging
+from sqlalchemy.exc import OperationalError
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -12,20 +14,47 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+from .logging_config import configure_logging, RequestContextMiddleware
+configure_logging()
 logger = logging.getLogger(__name__)
 
-from .database import engine, Base
+from .database import engine, Base, STATEMENT_TIMEOUT_RETRY_AFTER_SECONDS
 from . import models
+from .migrations import apply_schema_upgrades
 from .routers import auth, products, ai, admin, profile, orders, store, payment, categories, branding, hero_banners
+from .services.background import reservation_sweeper
+from .services.outbox import outbox_worker
+from .services.order_events import notification_listener
+from .services.analytics import cache as analytics_cache, precomputer
+from .services.passwords import hasher, PasswordHashingBusyError
+from .services.token_versions import token_version_refresher
 
 # Create all database tables
 models.Base.metadata.create_all(bind=engine)
+apply_schema_upgrades(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start background workers
+    reservation_sweeper.start()
+    outbox_worker.start()
+    notification_listener.start()
+    precomputer.start()
+    token_version_refresher.start()
+    yield
+    token_version_refresher.stop()
+    precomputer.stop()
+    analytics_cache.shutdown()
+    hasher.shutdown()
+    notification_listener.stop()
+    outbox_worker.stop()
+    reservation_sweeper.stop()
 
 app = FastAPI(
     title="Multi-Tenant E-Commerce Platform",
     description="A whitelabel e-commerce solution using FastAPI and PostgreSQL.",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 # Environment-specific CORS configuration
@@ -98,11 +127,30 @@ else:
             "X-Auth-Token",
             "X-User-Token",
             "X-API-Key",
-            "X-Requested-With"
+            "X-Requested-With",
+            "Idempotency-Key"
         ],
     )
 
-# Debug logging middleware removed
+# Request and tenant ids for log records
+app.add_middleware(RequestContextMiddleware)
+
+# Statement timeouts (and queries cancelled on disconnect) surface as 504
+@app.exception_handler(OperationalError)
+async def statement_timeout_handler(request: Request, exc: OperationalError):
+    if getattr(exc.orig, "pgcode", None) != "57014":  # query_canceled
+        raise exc
+    logger.warning(f"Query cancelled or timed out on {request.url.path}")
+    return JSONResponse(
+        status_code=504,
+        content={"detail": "The query took too long. Try a shorter date range or a narrower search."},
+        headers={"Retry-After": str(STATEMENT_TIMEOUT_RETRY_AFTER_SECONDS)}
+    )
+
+# Login storms are shed instead of queueing behind the password hashing pool
+@app.exception_handler(PasswordHashingBusyError)
+async def password_hashing_busy_handler(request: Request, exc: PasswordHashingBusyError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 # Mount static files BEFORE routers to prevent route conflicts
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
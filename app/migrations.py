@@ -0,0 +1,37 @@
+"""
+Schema upgrades for existing databases.
+Base.metadata.create_all() only creates missing tables, so columns and indexes
+added to tables that already exist are applied here. Every statement must be
+idempotent because this runs on each startup.
+"""
+
+import sqlalchemy as sa
+
+SCHEMA_UPGRADES = [
+    # Deduplicated customer addresses
+    "ALTER TABLE customer_addresses ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_customer_addresses_customer_hash "
+    "ON customer_addresses (customer_id, content_hash)",
+    # Tenant-scoped product analytics
+    "CREATE INDEX IF NOT EXISTS ix_products_tenant_created ON products (tenant_id, created_at)",
+    # Revocable access tokens
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0",
+    # Order numbers come from per-tenant sequences (crud.generate_order_number)
+    "DROP TABLE IF EXISTS order_number_counters",
+    # Outbox retention
+    "CREATE INDEX IF NOT EXISTS ix_outbox_events_processed ON outbox_events (processed_at) "
+    "WHERE processed_at IS NOT NULL",
+    # Rollup category fixed per order line (crud._stamp_line_categories)
+    "ALTER TABLE order_items ADD COLUMN IF NOT EXISTS category_id INTEGER",
+    "UPDATE order_items SET category_id = COALESCE(products.category_id, ("
+    "SELECT categories.id FROM categories "
+    "WHERE categories.tenant_id = orders.tenant_id AND categories.name = products.category LIMIT 1"
+    "), 0) FROM orders, products "
+    "WHERE order_items.category_id IS NULL AND orders.id = order_items.order_id "
+    "AND products.id = order_items.product_id",
+]
+
+def apply_schema_upgrades(engine):
+    with engine.begin() as connection:
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(sa.text(statement))
@@ -46,6 +46,7 @@ class User(Base):
     hashed_password = Column(String, nullable=False)
     role = Column(PyEnum(Role), nullable=False)
     tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")  # Bumped to revoke issued tokens
 
     created_at = Column(DateTime, server_default=sa.text('now()'), nullable=False)
     updated_at = Column(DateTime, server_default=sa.text('now()'), onupdate=sa.text('now()'), nullable=False)
@@ -54,7 +55,10 @@ class User(Base):
 
 class Product(Base):
     __tablename__ = "products"
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        sa.Index("ix_products_tenant_created", "tenant_id", "created_at"),
+        {'extend_existing': True},
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True, nullable=False)
@@ -96,6 +100,9 @@ class Customer(Base):
 
 class CustomerAddress(Base):
     __tablename__ = "customer_addresses"
+    __table_args__ = (
+        sa.Index("uq_customer_addresses_customer_hash", "customer_id", "content_hash", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
@@ -106,6 +113,7 @@ class CustomerAddress(Base):
     postal_code = Column(String(20), nullable=False)
     country = Column(String(100), nullable=False, default="United States")
     is_default = Column(sa.Boolean, default=False)
+    content_hash = Column(String(64), nullable=True)  # SHA-256 of the normalized address, see crud.address_content_hash
 
     created_at = Column(DateTime, server_default=sa.text('now()'), nullable=False)
 
@@ -138,6 +146,56 @@ class Order(Base):
     shipping_address = relationship("CustomerAddress")
     order_items = relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
 
+class InventoryHold(Base):
+    __tablename__ = "inventory_holds"
+    __table_args__ = (
+        sa.Index("ix_inventory_holds_product_expires", "product_id", "expires_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    hold_token = Column(String(36), nullable=False, index=True)  # Groups the holds of one checkout
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+    created_at = Column(DateTime, server_default=sa.text('now()'), nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+    __table_args__ = (
+        sa.Index("ix_outbox_events_pending", "id", postgresql_where=sa.text("processed_at IS NULL")),
+        sa.Index("ix_outbox_events_processed", "processed_at", postgresql_where=sa.text("processed_at IS NOT NULL")),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    event_type = Column(String(50), nullable=False)  # e.g. order.created, order.confirmed
+    aggregate_id = Column(Integer, nullable=False)  # ID of the order the event is about
+    payload = Column(sa.JSON, nullable=False, default=dict)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String(500), nullable=True)
+
+    created_at = Column(DateTime, server_default=sa.text('now()'), nullable=False)
+    processed_at = Column(DateTime, nullable=True)  # Set once delivered (or given up on)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        sa.UniqueConstraint("tenant_id", "scope", "key", name="uq_idempotency_keys_tenant_scope_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), nullable=False)
+    scope = Column(String(50), nullable=False)  # Endpoint the key was used on
+    key = Column(String(255), nullable=False)  # Client supplied Idempotency-Key header
+    request_hash = Column(String(64), nullable=False)  # SHA-256 of the request payload
+    status_code = Column(Integer, nullable=True)  # Null while the first request is in flight
+    response_body = Column(sa.JSON, nullable=True)
+
+    created_at = Column(DateTime, server_default=sa.text('now()'), nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
 class OrderItem(Base):
     __tablename__ = "order_items"
 
@@ -147,10 +205,81 @@ class OrderItem(Base):
     quantity = Column(Integer, nullable=False)
     unit_price = Column(sa.Numeric(10, 2), nullable=False)
     total_price = Column(sa.Numeric(10, 2), nullable=False)
+    # Category the line is counted under in the sales rollups, fixed when the
+    # order is recorded; no FK for the same reasons as DailySalesRollup
+    category_id = Column(Integer, nullable=True)
 
     order = relationship("Order", back_populates="order_items")
     product = relationship("Product", back_populates="order_items")
 
+class DailyOrderRollup(Base):
+    """Orders and order revenue per tenant, day and status, maintained by the order write paths"""
+    __tablename__ = "daily_order_rollups"
+
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    day = Column(sa.Date, primary_key=True)
+    status = Column(PyEnum(OrderStatus), primary_key=True)
+    order_count = Column(Integer, nullable=False, default=0)
+    revenue = Column(sa.Numeric(14, 2), nullable=False, default=0)  # Sum of order total_amount
+
+class DailySalesRollup(Base):
+    """
+    Line item sales per tenant, day, status, category and product.
+    category_id 0 means uncategorised. Rows with product_id 0 are category
+    subtotals whose order_count counts distinct orders; on product rows it
+    counts order lines.
+    """
+    __tablename__ = "daily_sales_rollups"
+
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    day = Column(sa.Date, primary_key=True)
+    status = Column(PyEnum(OrderStatus), primary_key=True)
+    category_id = Column(Integer, primary_key=True)  # No FK: 0 is a sentinel and categories may be deleted
+    product_id = Column(Integer, primary_key=True)
+    revenue = Column(sa.Numeric(14, 2), nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    order_count = Column(Integer, nullable=False, default=0)
+
+class ProductSalesTotal(Base):
+    """All-time sales of each product over non-cancelled orders, maintained with the daily rollups"""
+    __tablename__ = "product_sales_totals"
+    __table_args__ = (
+        sa.Index("ix_product_sales_totals_revenue", "tenant_id", "revenue"),
+        sa.Index("ix_product_sales_totals_units", "tenant_id", "units"),
+    )
+
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    revenue = Column(sa.Numeric(14, 2), nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    order_count = Column(Integer, nullable=False, default=0)  # Order lines
+
+class DailyCustomerSketch(Base):
+    """HyperLogLog sketch of the customers who ordered per tenant and day, see services/hll.py"""
+    __tablename__ = "daily_customer_sketches"
+
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    day = Column(sa.Date, primary_key=True)
+    registers = Column(sa.LargeBinary, nullable=False)
+
+class CustomerRfmScore(Base):
+    """Latest recency/frequency/monetary scores of each customer, rebuilt per tenant by the RFM job"""
+    __tablename__ = "customer_rfm_scores"
+    __table_args__ = (
+        sa.Index("ix_customer_rfm_scores_segment", "tenant_id", "segment", "monetary"),
+    )
+
+    tenant_id = Column(Integer, ForeignKey("tenants.id"), primary_key=True)
+    customer_id = Column(Integer, ForeignKey("customers.id", ondelete="CASCADE"), primary_key=True)
+    recency_days = Column(Integer, nullable=False)
+    frequency = Column(Integer, nullable=False)
+    monetary = Column(sa.Numeric(14, 2), nullable=False)
+    r_score = Column(sa.SmallInteger, nullable=False)  # 1-5, 5 = most recent
+    f_score = Column(sa.SmallInteger, nullable=False)
+    m_score = Column(sa.SmallInteger, nullable=False)
+    segment = Column(String(20), nullable=False)
+    computed_at = Column(DateTime, server_default=sa.text('now()'), nullable=False)
+
 class Category(Base):
     __tablename__ = "categories"
 
@@ -4,6 +4,7 @@ from typing import List
 
 from .. import crud, schemas, security, models
 from ..database import get_db
+from ..services import analytics
 
 router = APIRouter()
 
@@ -75,4 +76,26 @@ def update_user_role(user_id: int, role_update: schemas.UserRoleUpdate, db: Sess
     db_user = crud.update_user_role(db, user_id=user_id, new_role=role_update.role)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    security.remember_token_version(db_user)  # Tokens carrying the old role stop working now
     return db_user
+
+@router.get("/analytics/freshness")
+def read_analytics_freshness(db: Session = Depends(get_super_admin_db)):
+    """
+    Report when each tenant's dashboard analytics were last precomputed,
+    whether this worker runs the precompute, and its cache statistics.
+    Accessible only by Super Admins.
+    """
+    return {
+        "tenants": analytics.precomputer.freshness_report(),
+        "precompute_leader": analytics.precomputer.is_leader,
+        "cache": analytics.cache.stats()
+    }
+
+@router.get("/auth/token-cache")
+def read_token_cache_stats(db: Session = Depends(get_super_admin_db)):
+    """
+    Report hit and miss counts of the decoded access token cache.
+    Accessible only by Super Admins.
+    """
+    return security.token_cache.stats()
@@ -11,7 +11,7 @@ logger = logging.getLogger(__name__)
 def get_ai_description(
     description_request: schemas.DescriptionRequest,
     request: Request,
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Generates a product description using the AI service.
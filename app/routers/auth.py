@@ -17,13 +17,25 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
 @router.post("/auth/token", response_model=schemas.Token)
 def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = crud.get_user_by_email(db, email=form_data.username)
-    if not user or not security.verify_password(form_data.password, user.hashed_password):
+    valid, new_hash = security.verify_and_update_password(form_data.password, user.hashed_password) if user else (False, None)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = security.create_access_token(
-        data={"sub": user.email}
-    )
+    if new_hash:
+        # Stored hash used an older cost factor
+        crud.update_user_password(db, user.id, new_hash, revoke_tokens=False)
+    access_token = security.create_user_access_token(user)
     return {"access_token": access_token, "token_type": "bearer"}
+
+@router.post("/auth/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(
+    db: Session = Depends(get_db),
+    claims: schemas.TokenClaims = Depends(security.get_current_claims)
+):
+    """Revoke all of the caller's access tokens"""
+    version = crud.revoke_user_tokens(db, claims.id)
+    if version is not None:
+        security.token_versions.set(claims.id, version)
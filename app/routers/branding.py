@@ -12,7 +12,7 @@ router = APIRouter()
 def get_tenant_branding(
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """Get current tenant's branding information"""
     tenant = crud.get_tenant_branding(db, tenant_id=current_user.tenant_id)
@@ -25,7 +25,7 @@ def update_tenant_branding(
     branding_data: schemas.TenantBrandingUpdate,
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """Update tenant branding information"""
     updated_tenant = crud.update_tenant_branding(
@@ -41,7 +41,7 @@ def update_tenant_branding(
 async def upload_company_logo(
     file: UploadFile = File(...),
     request: Request = None,
-    current_user: models.User = Depends(security.get_current_user_alternative),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims),
     db: Session = Depends(get_db)
 ):
     """Upload company logo"""
@@ -81,7 +81,7 @@ async def upload_company_logo(
 def remove_company_logo(
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """Remove company logo"""
     branding_data = schemas.TenantBrandingUpdate(
@@ -9,7 +9,7 @@ from ..services.file_upload import FileUploadService
 router = APIRouter()
 
 # Dependency for tenant admin access
-def get_tenant_admin_db(request: Request, db: Session = Depends(get_db), current_user: models.User = Depends(security.get_current_user_alternative)):
+def get_tenant_admin_db(request: Request, db: Session = Depends(get_db), current_user: schemas.TokenClaims = Depends(security.get_current_claims)):
     return db, current_user
 
 # Dependency for public store access
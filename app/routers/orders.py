@@ -1,15 +1,24 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import func, extract, desc, or_
 import sqlalchemy as sa
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
+import asyncio
+import json
+import os
 
 from .. import crud, schemas, security, models
-from ..database import get_db
+from ..database import get_db, get_analytics_db, get_search_db, SessionLocal
+from ..services import analytics, export, order_events, rfm
 
 router = APIRouter()
 
+ORDER_STREAM_HEARTBEAT_SECONDS = float(os.getenv("ORDER_STREAM_HEARTBEAT_SECONDS", 15))
+ORDER_STREAM_RETRY_MS = int(os.getenv("ORDER_STREAM_RETRY_MS", 3000))
+
 @router.get("/", response_model=List[schemas.Order])
 def get_orders(
     request: Request,
@@ -19,8 +28,8 @@ def get_orders(
     search: Optional[str] = None,
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    db: Session = Depends(get_search_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Get all orders for the current user's tenant with pagination and filtering.
@@ -71,8 +80,8 @@ def get_orders_count(
     search: Optional[str] = None,
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    db: Session = Depends(get_search_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Get total count of orders for the current tenant for pagination.
@@ -114,203 +123,101 @@ def get_orders_count(
     total_count = query.count()
     return {"total": total_count}
 
+@router.post("/stream-ticket")
+def create_stream_ticket(current_user: schemas.TokenClaims = Depends(security.get_current_claims)):
+    """Issue a short-lived ticket for opening the order event stream"""
+    return {"ticket": security.create_stream_ticket(current_user), "expires_in": security.STREAM_TICKET_EXPIRE_SECONDS}
+
+@router.get("/stream")
+async def stream_orders(request: Request, ticket: Optional[str] = None):
+    """
+    Server-Sent Events stream of order events for the current user's tenant.
+    EventSource cannot send headers, so browsers pass a ticket from
+    POST /orders/stream-ticket as ?ticket=; other clients may send their
+    access token in a header. Access tokens are never accepted in the URL,
+    where they would end up in access logs.
+    No database connection is held while the stream is open.
+    """
+    auth_header = request.headers.get("authorization", "")
+    token = request.headers.get("x-auth-token") or (auth_header[7:] if auth_header.startswith("Bearer ") else None)
+    if not ticket and not token:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    
+    def authenticate():
+        if ticket:
+            return security.verify_stream_ticket(ticket)
+        db = SessionLocal()
+        try:
+            user = security.get_user_from_token(db, token)
+            return user.tenant_id if user else None
+        finally:
+            db.close()
+    
+    tenant_id = await run_in_threadpool(authenticate)
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    
+    queue = order_events.broker.subscribe(tenant_id)
+    
+    async def event_stream():
+        try:
+            yield f"retry: {ORDER_STREAM_RETRY_MS}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=ORDER_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"  # Keeps proxies from closing an idle stream
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+        finally:
+            order_events.broker.unsubscribe(tenant_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Disable NGINX response buffering
+        }
+    )
+
 @router.get("/analytics/overview")
 def get_sales_overview(
     request: Request,
     days: int = 30,
     category_id: Optional[int] = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    db: Session = Depends(get_analytics_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Get sales overview analytics for the dashboard.
     Only accessible to authenticated admin users.
     """
-    from_date = datetime.now() - timedelta(days=days)
-    
-    if category_id:
-        # Get category name for fallback to string-based filtering
-        category = db.query(models.Category).filter(
-            models.Category.id == category_id,
-            models.Category.tenant_id == current_user.tenant_id
-        ).first()
-        
-        if not category:
-            # Invalid category ID
-            return {
-                "total_revenue": 0.0,
-                "total_orders": 0,
-                "average_order_value": 0.0,
-                "revenue_growth_percentage": 0.0,
-                "status_distribution": [],
-                "period_days": days
-            }
-        
-        # Category-specific analytics using both category_id and category name
-        revenue_query = db.query(
-            func.sum(models.Order.total_amount).label('total_revenue'),
-            func.count(models.Order.id).label('total_orders')
-        ).join(
-            models.OrderItem, models.Order.id == models.OrderItem.order_id
-        ).join(
-            models.Product, models.OrderItem.product_id == models.Product.id
-        ).filter(
-            models.Order.tenant_id == current_user.tenant_id,
-            models.Order.status != models.OrderStatus.CANCELLED,
-            models.Order.created_at >= from_date,
-            or_(
-                models.Product.category_id == category_id,
-                models.Product.category == category.name
-            )
-        ).first()
-        
-        total_revenue = float(revenue_query.total_revenue or 0)
-        total_orders = revenue_query.total_orders or 0
-        
-        # Status distribution for category
-        status_distribution = db.query(
-            models.Order.status,
-            func.count(models.Order.id).label('count'),
-            func.sum(models.Order.total_amount).label('total_value')
-        ).join(
-            models.OrderItem, models.Order.id == models.OrderItem.order_id
-        ).join(
-            models.Product, models.OrderItem.product_id == models.Product.id
-        ).filter(
-            models.Order.tenant_id == current_user.tenant_id,
-            models.Order.created_at >= from_date,
-            or_(
-                models.Product.category_id == category_id,
-                models.Product.category == category.name
-            )
-        ).group_by(models.Order.status).all()
-        
-        # Previous period for category
-        prev_from_date = from_date - timedelta(days=days)
-        prev_revenue_query = db.query(
-            func.sum(models.Order.total_amount)
-        ).join(
-            models.OrderItem, models.Order.id == models.OrderItem.order_id
-        ).join(
-            models.Product, models.OrderItem.product_id == models.Product.id
-        ).filter(
-            models.Order.tenant_id == current_user.tenant_id,
-            models.Order.status != models.OrderStatus.CANCELLED,
-            models.Order.created_at >= prev_from_date,
-            models.Order.created_at < from_date,
-            or_(
-                models.Product.category_id == category_id,
-                models.Product.category == category.name
-            )
-        ).scalar()
-        
-    else:
-        # All categories analytics
-        revenue_query = db.query(
-            func.sum(models.Order.total_amount).label('total_revenue'),
-            func.count(models.Order.id).label('total_orders')
-        ).filter(
-            models.Order.tenant_id == current_user.tenant_id,
-            models.Order.status != models.OrderStatus.CANCELLED,
-            models.Order.created_at >= from_date
-        ).first()
-        
-        total_revenue = float(revenue_query.total_revenue or 0)
-        total_orders = revenue_query.total_orders or 0
-        
-        # Status distribution for all
-        status_distribution = db.query(
-            models.Order.status,
-            func.count(models.Order.id).label('count'),
-            func.sum(models.Order.total_amount).label('total_value')
-        ).filter(
-            models.Order.tenant_id == current_user.tenant_id,
-            models.Order.created_at >= from_date
-        ).group_by(models.Order.status).all()
-        
-        # Previous period for all
-        prev_from_date = from_date - timedelta(days=days)
-        prev_revenue_query = db.query(
-            func.sum(models.Order.total_amount)
-        ).filter(
-            models.Order.tenant_id == current_user.tenant_id,
-            models.Order.status != models.OrderStatus.CANCELLED,
-            models.Order.created_at >= prev_from_date,
-            models.Order.created_at < from_date
-        ).scalar()
-    
-    # Calculate metrics
-    avg_order_value = float(total_revenue / total_orders) if total_orders > 0 else 0
-    prev_revenue = float(prev_revenue_query or 0)
-    revenue_growth = ((total_revenue - prev_revenue) / prev_revenue * 100) if prev_revenue > 0 else 0
-    
-    return {
-        "total_revenue": float(total_revenue),
-        "total_orders": total_orders,
-        "average_order_value": avg_order_value,
-        "revenue_growth_percentage": revenue_growth,
-        "status_distribution": [
-            {
-                "status": status.status,
-                "count": status.count,
-                "total_value": float(status.total_value or 0)
-            }
-            for status in status_distribution
-        ],
-        "period_days": days
-    }
+    return analytics.sales_overview(db, current_user.tenant_id, days=days, category_id=category_id)
 
 @router.get("/analytics/revenue-trend")
 def get_revenue_trend(
     request: Request,
     days: int = 30,
     category_id: Optional[int] = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    granularity: str = "day",
+    tz: str = "UTC",
+    db: Session = Depends(get_analytics_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
-    Get daily revenue trend data for charts.
+    Get revenue trend data for charts, bucketed by hour, day, week or month
+    in the given IANA time zone. Empty buckets are included with zero values.
     Only accessible to authenticated admin users.
     """
-    from_date = datetime.now() - timedelta(days=days)
-    
-    # Base query
-    query = db.query(
-        func.date(models.Order.created_at).label('date'),
-        func.sum(models.Order.total_amount).label('revenue'),
-        func.count(models.Order.id).label('order_count')
-    ).filter(
-        models.Order.tenant_id == current_user.tenant_id,
-        models.Order.status != models.OrderStatus.CANCELLED,
-        models.Order.created_at >= from_date
-    )
-    
-    # Add category filter if specified
-    if category_id:
-        # Get category name for fallback filtering
-        category = db.query(models.Category).filter(
-            models.Category.id == category_id,
-            models.Category.tenant_id == current_user.tenant_id
-        ).first()
-        
-        if category:
-            query = query.join(models.OrderItem).join(models.Product).filter(
-                or_(
-                    models.Product.category_id == category_id,
-                    models.Product.category == category.name
-                )
-            )
-    
-    daily_revenue = query.group_by(func.date(models.Order.created_at)).order_by('date').all()
-    
-    return [
-        {
-            "date": day.date.isoformat(),
-            "revenue": float(day.revenue or 0),
-            "order_count": day.order_count
-        }
-        for day in daily_revenue
-    ]
+    if granularity not in crud.TREND_GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(crud.TREND_GRANULARITIES)}")
+    try:
+        return analytics.revenue_trend(
+            db, current_user.tenant_id, days=days, category_id=category_id, granularity=granularity, tz=tz
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @router.get("/analytics/top-products")
 def get_top_products(
@@ -318,65 +225,128 @@ def get_top_products(
     limit: int = 10,
     days: int = 30,
     category_id: Optional[int] = None,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    rank_by: str = "revenue",
+    all_time: bool = False,
+    db: Session = Depends(get_analytics_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
-    Get top-selling products by revenue and quantity.
+    Get top-selling products ranked by revenue or units (rank_by), over the
+    last `days` days or all time.
     Only accessible to authenticated admin users.
     """
-    from_date = datetime.now() - timedelta(days=days)
-    
-    # Base query for top products
-    query = db.query(
-        models.Product.id,
-        models.Product.name,
-        func.sum(models.OrderItem.total_price).label('total_revenue'),
-        func.sum(models.OrderItem.quantity).label('total_quantity'),
-        func.count(models.OrderItem.id).label('order_count')
-    ).join(
-        models.OrderItem, models.Product.id == models.OrderItem.product_id
-    ).join(
-        models.Order, models.OrderItem.order_id == models.Order.id
-    ).filter(
-        models.Product.tenant_id == current_user.tenant_id,
-        models.Order.status != models.OrderStatus.CANCELLED,
-        models.Order.created_at >= from_date
+    if rank_by not in crud.TOP_PRODUCT_RANKINGS:
+        raise HTTPException(status_code=400, detail=f"rank_by must be one of: {', '.join(crud.TOP_PRODUCT_RANKINGS)}")
+    return analytics.top_products(
+        db, current_user.tenant_id,
+        days=days, limit=limit, category_id=category_id, rank_by=rank_by, all_time=all_time
     )
+
+@router.get("/analytics/unique-customers")
+def get_unique_customers(
+    request: Request,
+    days: int = 30,
+    granularity: str = "day",
+    db: Session = Depends(get_analytics_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
+):
+    """
+    Get approximate unique customers with confirmed orders per day, week or
+    month (UTC), estimated from HyperLogLog sketches.
+    Only accessible to authenticated admin users.
+    """
+    if granularity not in crud.UNIQUE_CUSTOMER_GRANULARITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"granularity must be one of: {', '.join(crud.UNIQUE_CUSTOMER_GRANULARITIES)}"
+        )
+    return analytics.unique_customers(db, current_user.tenant_id, days=days, granularity=granularity)
+
+@router.get("/analytics/customers")
+def get_customer_segments(
+    request: Request,
+    segment: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50,
+    db: Session = Depends(get_analytics_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
+):
+    """
+    Get customers with their RFM (recency, frequency, monetary) scores and
+    segment, paginated and optionally filtered by segment.
+    Only accessible to authenticated admin users.
+    """
+    if segment and segment not in rfm.RFM_SEGMENTS:
+        raise HTTPException(status_code=400, detail=f"segment must be one of: {', '.join(rfm.RFM_SEGMENTS)}")
+    return crud.get_customer_rfm_scores(db, current_user.tenant_id, segment=segment, skip=skip, limit=min(limit, 500))
+
+@router.post("/analytics/customers/refresh")
+def refresh_customer_segments(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
+):
+    """
+    Recompute the RFM scores of all customers.
+    Only accessible to authenticated admin users.
+    """
+    return {"customers_scored": rfm.refresh_customer_rfm(db, current_user.tenant_id)}
+
+@router.get("/export")
+def export_orders(
+    request: Request,
+    table: str = "orders",
+    format: str = "parquet",
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
+):
+    """
+    Export the tenant's orders, order_items or products as Parquet or an Arrow
+    IPC stream, optionally limited to orders created in [date_from, date_to).
+    The file is streamed as it is written.
+    Only accessible to authenticated admin users.
+    """
+    if table not in export.EXPORT_TABLES:
+        raise HTTPException(status_code=400, detail=f"table must be one of: {', '.join(export.EXPORT_TABLES)}")
+    if format not in export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(export.EXPORT_FORMATS)}")
     
-    # Add category filter if specified
-    if category_id:
-        # Get category name for fallback filtering
-        category = db.query(models.Category).filter(
-            models.Category.id == category_id,
-            models.Category.tenant_id == current_user.tenant_id
-        ).first()
-        
-        if category:
-            query = query.filter(
-                or_(
-                    models.Product.category_id == category_id,
-                    models.Product.category == category.name
-                )
-            )
-    
-    top_products = query.group_by(
-        models.Product.id, models.Product.name
-    ).order_by(
-        desc('total_revenue')
-    ).limit(limit).all()
+    try:
+        chunks = export.stream_export(table, current_user.tenant_id, format, date_from, date_to)
+    except export.ExportUnavailableError as e:
+        raise HTTPException(status_code=501, detail=str(e))
     
-    return [
-        {
-            "product_id": product.id,
-            "product_name": product.name,
-            "total_revenue": float(product.total_revenue or 0),
-            "total_quantity": product.total_quantity,
-            "order_count": product.order_count,
-            "average_price": float(product.total_revenue / product.total_quantity) if product.total_quantity > 0 else 0
-        }
-        for product in top_products
-    ]
+    extension, media_type = export.EXPORT_FORMATS[format]
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{table}.{extension}"'}
+    )
+
+@router.post("/status:batch", response_model=schemas.OrderStatusBatchResult)
+def update_order_status_batch(
+    batch_update: schemas.OrderStatusBatchUpdate,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
+):
+    """
+    Move many orders to one status in a single transaction.
+    Inventory for cancelled or reactivated orders is adjusted per product in one update.
+    Only accessible to authenticated admin users; orders of other tenants are reported as not found.
+    """
+    results = crud.bulk_update_order_status(
+        db,
+        order_ids=batch_update.order_ids,
+        status=batch_update.status,
+        tenant_id=current_user.tenant_id
+    )
+    return {
+        "status": batch_update.status,
+        "updated": sum(1 for result in results if result["outcome"] == "updated"),
+        "results": results
+    }
 
 @router.put("/{order_id}/status", response_model=schemas.Order)
 def update_order_status(
@@ -384,18 +354,21 @@ def update_order_status(
     status_update: schemas.OrderStatusUpdate,
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Update order status.
     Only accessible to authenticated admin users who own the order.
     """
-    order = crud.update_order_status(
-        db, 
-        order_id=order_id, 
-        status=status_update.status, 
-        tenant_id=current_user.tenant_id
-    )
+    try:
+        order = crud.update_order_status(
+            db, 
+            order_id=order_id, 
+            status=status_update.status, 
+            tenant_id=current_user.tenant_id
+        )
+    except crud.InsufficientInventoryError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     return order
@@ -405,7 +378,7 @@ def get_order(
     order_id: int,
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Get a specific order by ID.
@@ -13,7 +13,7 @@ def create_product(
     product: schemas.ProductCreate, 
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Create a new product for the current user's tenant.
@@ -34,7 +34,7 @@ def read_products(
     sort_by: Optional[str] = "name",  # name, price, stock, date
     sort_order: Optional[str] = "asc",  # asc, desc
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Retrieve products for the current user's tenant with advanced filtering and search.
@@ -59,7 +59,7 @@ def read_products(
 def get_product_analytics(
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Get product analytics and smart suggestions for the admin dashboard.
@@ -73,7 +73,7 @@ def update_product(
     product_update: schemas.ProductUpdate,
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Update an existing product for the current user's tenant.
@@ -91,7 +91,7 @@ def delete_product(
     product_id: int,
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Delete a product for the current user's tenant.
@@ -108,7 +108,7 @@ def delete_product(
 def get_categories(
     request: Request,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Get all unique categories for the current user's tenant.
@@ -128,7 +128,7 @@ def get_category_suggestions():
 async def upload_product_image(
     request: Request,
     file: UploadFile = File(...),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Upload a product image.
@@ -146,7 +146,7 @@ async def upload_product_image(
 async def upload_product_image_from_url(
     request: Request,
     image_url: str = Form(...),
-    current_user: models.User = Depends(security.get_current_user_alternative)
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims)
 ):
     """
     Download and save a product image from URL.
@@ -169,7 +169,7 @@ async def create_product_with_image(
     quantity: int = Form(...),
     category: str = Form("General"),
     image: Optional[UploadFile] = File(None),
-    current_user: models.User = Depends(security.get_current_user_alternative),
+    current_user: schemas.TokenClaims = Depends(security.get_current_claims),
     db: Session = Depends(get_db)
 ):
     """
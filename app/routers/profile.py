@@ -21,6 +21,7 @@ def update_password(
     
     hashed_password = security.get_password_hash(password_update.new_password)
     updated_user = crud.update_user_password(db, current_user.id, hashed_password)
+    security.remember_token_version(updated_user)
     return updated_user
 
 @router.put("/email", response_model=schemas.User)
@@ -37,6 +38,7 @@ def update_email(
         )
     
     updated_user = crud.update_user_email(db, current_user.id, email_update.new_email)
+    security.remember_token_version(updated_user)
     return updated_user
 
 @router.get("/me", response_model=schemas.UserWithTenant)
@@ -55,4 +57,5 @@ def delete_account(
     current_user: models.User = Depends(security.get_current_user_alternative)
 ):
     crud.delete_user_account(db, current_user.id)
+    security.token_versions.set(current_user.id, None)  # Deleted users' tokens are revoked
     return
@@ -1,14 +1,132 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable
 from pydantic import BaseModel
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import uuid
 
 from .. import crud, schemas, security, models
 from ..database import get_db
+from ..logging_config import bind_log_context
+from ..services.rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Retry-After sent to a duplicate request while the first one with the same
+# Idempotency-Key is still running
+IDEMPOTENCY_RETRY_AFTER_SECONDS = int(os.getenv("IDEMPOTENCY_RETRY_AFTER_SECONDS", 1))
+
+# Inventory holds need no login: limit hold requests per client address and store
+INVENTORY_HOLD_RATE_LIMIT = int(os.getenv("INVENTORY_HOLD_RATE_LIMIT", 20))
+INVENTORY_HOLD_RATE_WINDOW_SECONDS = float(os.getenv("INVENTORY_HOLD_RATE_WINDOW_SECONDS", 60))
+hold_rate_limiter = RateLimiter(INVENTORY_HOLD_RATE_LIMIT, INVENTORY_HOLD_RATE_WINDOW_SECONDS)
+
+def _redact_card_data(value):
+    """Drop CVVs and reduce card numbers to their last four digits, at any depth"""
+    if isinstance(value, dict):
+        return {
+            key: (item[-4:] if key == "card_number" and isinstance(item, str) else _redact_card_data(item))
+            for key, item in value.items()
+            if key != "cvv"
+        }
+    if isinstance(value, list):
+        return [_redact_card_data(item) for item in value]
+    return value
+
+def _request_hash(payload: Dict[str, Any]) -> str:
+    """
+    Fingerprint of a request for detecting Idempotency-Key reuse. Stored for
+    IDEMPOTENCY_KEY_TTL_HOURS, so card data is redacted first and the digest
+    is an HMAC keyed with the server secret rather than a plain hash.
+    """
+    body = json.dumps(_redact_card_data(jsonable_encoder(payload)), sort_keys=True).encode()
+    return hmac.new(security.SECRET_KEY.encode(), body, hashlib.sha256).hexdigest()
+
+def _run_idempotent(
+    db: Session,
+    tenant_id: int,
+    scope: str,
+    idempotency_key: Optional[str],
+    payload: Dict[str, Any],
+    handler: Callable[[], Dict[str, Any]]
+):
+    """
+    Run handler at most once per Idempotency-Key.
+    Replays return the stored response without touching products or payment.
+    A duplicate that arrives while the first request is still running gets
+    409 with Retry-After instead of holding a worker thread while it waits.
+    """
+    if not idempotency_key:
+        return handler()
+    
+    request_hash = _request_hash(payload)
+    
+    # A second attempt covers a key released or expired between the insert and the lookup
+    for _ in range(2):
+        claimed, existing = crud.claim_idempotency_key(db, tenant_id, scope, idempotency_key, request_hash)
+        if claimed or existing is not None:
+            break
+    if not claimed:
+        if existing is not None and existing.request_hash != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        if existing is not None and existing.status_code is not None:
+            return JSONResponse(
+                status_code=existing.status_code,
+                content=existing.response_body,
+                headers={"Idempotent-Replayed": "true"}
+            )
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this Idempotency-Key is still being processed",
+            headers={"Retry-After": str(IDEMPOTENCY_RETRY_AFTER_SECONDS)}
+        )
+    
+    try:
+        response = handler()
+    except HTTPException as e:
+        if e.status_code >= 500:
+            crud.release_idempotency_key(db, tenant_id, scope, idempotency_key)
+            raise
+        # Client errors (declined card, insufficient stock) are final for this key
+        db.rollback()
+        crud.complete_idempotency_key(db, tenant_id, scope, idempotency_key, e.status_code, {"detail": e.detail})
+        raise
+    except Exception:
+        crud.release_idempotency_key(db, tenant_id, scope, idempotency_key)
+        raise
+    
+    crud.complete_idempotency_key(db, tenant_id, scope, idempotency_key, 200, jsonable_encoder(response))
+    return response
+
+def _order_response(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a successful create_order_with_payment result for JSON serialization"""
+    order = result["order"]
+    return {
+        "success": True,
+        "order": {
+            "id": order.id,
+            "order_number": order.order_number,
+            "customer_id": order.customer_id,
+            "tenant_id": order.tenant_id,
+            "status": order.status.value,
+            "total_amount": float(order.total_amount),
+            "created_at": order.created_at.isoformat(),
+            "updated_at": order.updated_at.isoformat()
+        },
+        "payment": result["payment"],
+        "message": "Order placed successfully!"
+    }
+
 # Customer authentication
 @router.post("/auth/register", response_model=schemas.Customer)
 def register_customer(
@@ -43,12 +161,17 @@ def login_customer(
     
     # Authenticate customer
     customer = crud.get_customer_by_email(db, email=form_data.username, tenant_id=tenant.id)
-    if not customer or not security.verify_password(form_data.password, customer.hashed_password):
+    valid, new_hash = security.verify_and_update_password(form_data.password, customer.hashed_password) if customer else (False, None)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # Stored hash used an older cost factor
+        customer.hashed_password = new_hash
+        db.commit()
     
     # Create token (you might want to create a separate customer token system)
     access_token = security.create_access_token(
@@ -101,6 +224,63 @@ def get_store_product(
     
     return product
 
+@router.post("/{tenant_domain}/cart/quote", response_model=schemas.CartQuote)
+def quote_cart(
+    tenant_domain: str,
+    quote_request: schemas.CartQuoteRequest,
+    db: Session = Depends(get_db)
+):
+    """Get current prices, availability and totals for every cart line in one call"""
+    tenant = crud.get_tenant_by_name(db, name=tenant_domain)
+    if not tenant:
+        raise HTTPException(status_code=404, detail="Store not found")
+    
+    return crud.quote_cart(db, items=quote_request.items, tenant_id=tenant.id, hold_token=quote_request.hold_token)
+
+@router.post("/{tenant_domain}/checkout/holds", response_model=schemas.InventoryHold)
+def create_inventory_hold(
+    tenant_domain: str,
+    hold_request: schemas.InventoryHoldRequest,
+    request: Request,
+    db: Session = Depends(get_db)
+):
+    """Hold stock for the cart while the shopper completes checkout"""
+    tenant = crud.get_tenant_by_name(db, name=tenant_domain)
+    if not tenant:
+        raise HTTPException(status_code=404, detail="Store not found")
+    
+    client_host = request.client.host if request.client else "unknown"
+    retry_after = hold_rate_limiter.hit(f"{tenant.id}:{client_host}")
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many checkout holds, please retry shortly",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+    
+    try:
+        return crud.create_inventory_holds(
+            db, items=hold_request.items, tenant_id=tenant.id, hold_token=hold_request.hold_token
+        )
+    except crud.InsufficientInventoryError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.delete("/{tenant_domain}/checkout/holds/{hold_token}", status_code=status.HTTP_204_NO_CONTENT)
+def release_inventory_hold(
+    tenant_domain: str,
+    hold_token: uuid.UUID,
+    db: Session = Depends(get_db)
+):
+    """Release held stock when the shopper leaves checkout"""
+    tenant = crud.get_tenant_by_name(db, name=tenant_domain)
+    if not tenant:
+        raise HTTPException(status_code=404, detail="Store not found")
+    
+    crud.release_inventory_holds(db, hold_token=str(hold_token), tenant_id=tenant.id)
+    return
+
 @router.get("/{tenant_domain}/categories", response_model=List[str])
 def get_store_categories(
     tenant_domain: str,
@@ -226,7 +406,8 @@ def create_customer_order(
     tenant_domain: str,
     order: schemas.OrderCreateWithPayment,
     db: Session = Depends(get_db),
-    current_customer: models.Customer = Depends(security.get_current_customer)
+    current_customer: models.Customer = Depends(security.get_current_customer),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Create a new order for authenticated customer"""
     tenant = crud.get_tenant_by_name(db, name=tenant_domain)
@@ -237,108 +418,90 @@ def create_customer_order(
     if current_customer.tenant_id != tenant.id:
         raise HTTPException(status_code=403, detail="Customer not authorized for this store")
     
-    try:
-        result = crud.create_order_with_payment(
-            db=db, 
-            order_data=order, 
-            customer_id=current_customer.id, 
-            tenant_id=tenant.id
-        )
-        
-        if result["success"]:
-            # Convert SQLAlchemy model to dict for JSON serialization
-            order_dict = {
-                "id": result["order"].id,
-                "order_number": result["order"].order_number,
-                "customer_id": result["order"].customer_id,
-                "tenant_id": result["order"].tenant_id,
-                "status": result["order"].status.value,
-                "total_amount": float(result["order"].total_amount),
-                "created_at": result["order"].created_at.isoformat(),
-                "updated_at": result["order"].updated_at.isoformat()
-            }
-            return {
-                "success": True,
-                "order": order_dict,
-                "payment": result["payment"],
-                "message": "Order placed successfully!"
-            }
-        else:
-            raise HTTPException(status_code=400, detail=result["error"])
+    customer_id = current_customer.id
+    
+    def place_order():
+        try:
+            result = crud.create_order_with_payment(
+                db=db, 
+                order_data=order, 
+                customer_id=customer_id, 
+                tenant_id=tenant.id
+            )
             
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+            if result["success"]:
+                return _order_response(result)
+            else:
+                raise HTTPException(status_code=400, detail=result["error"])
+                
+        except ValueError as e:
+            # Invalid items or insufficient stock; anything else is a server
+            # error and propagates so the Idempotency-Key is released
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    return _run_idempotent(
+        db, tenant.id, "orders", idempotency_key,
+        {"customer_id": customer_id, "order": order.model_dump()},
+        place_order
+    )
 
 class GuestOrderRequest(BaseModel):
     items: List[schemas.OrderItemCreate]
     shipping_address: schemas.AddressCreate
     payment: schemas.PaymentRequest
     customer_info: schemas.CustomerInfo
+    hold_token: Optional[schemas.HoldToken] = None
 
 @router.post("/{tenant_domain}/orders/guest", response_model=Dict[str, Any])
 def create_guest_order(
     tenant_domain: str,
     request: GuestOrderRequest,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Create order for guest customer (with registration)"""
-    print(f"🛒 Guest order request for tenant: {tenant_domain}")
-    print(f"📦 Items: {len(request.items)}")
-    print(f"👤 Customer: {request.customer_info.email}")
-    
     tenant = crud.get_tenant_by_name(db, name=tenant_domain)
     if not tenant:
-        print(f"❌ Tenant not found: {tenant_domain}")
+        logger.info(f"Guest order for unknown store {tenant_domain}")
         raise HTTPException(status_code=404, detail="Store not found")
-    
-    # Get or create guest customer
-    customer = crud.get_or_create_guest_customer(db, request.customer_info, tenant.id)
-    customer_id = customer.id
-    
-    # Create order data
-    order_data = schemas.OrderCreateWithPayment(
-        items=request.items,
-        shipping_address=request.shipping_address,
-        payment=request.payment
-    )
-    
-    try:
-        print(f"💳 Processing order with payment...")
-        result = crud.create_order_with_payment(
-            db=db, 
-            order_data=order_data, 
-            customer_id=customer_id, 
-            tenant_id=tenant.id
+    tenant_id = tenant.id
+    bind_log_context(tenant_id=tenant_id)
+    logger.debug("Guest order request", extra={"items": len(request.items)})
+    
+    def place_order():
+        # Create order data
+        order_data = schemas.OrderCreateWithPayment(
+            items=request.items,
+            shipping_address=request.shipping_address,
+            payment=request.payment,
+            hold_token=request.hold_token
         )
         
-        if result["success"]:
-            print(f"✅ Order created successfully: {result['order'].order_number}")
-            # Convert SQLAlchemy model to dict for JSON serialization
-            order_dict = {
-                "id": result["order"].id,
-                "order_number": result["order"].order_number,
-                "customer_id": result["order"].customer_id,
-                "tenant_id": result["order"].tenant_id,
-                "status": result["order"].status.value,
-                "total_amount": float(result["order"].total_amount),
-                "created_at": result["order"].created_at.isoformat(),
-                "updated_at": result["order"].updated_at.isoformat()
-            }
-            return {
-                "success": True,
-                "order": order_dict,
-                "payment": result["payment"],
-                "message": "Order placed successfully!"
-            }
-        else:
-            print(f"❌ Order creation failed: {result['error']}")
-            raise HTTPException(status_code=400, detail=result["error"])
+        try:
+            # Upsert the guest customer; it is committed together with the order
+            customer_id = crud.upsert_guest_customer(db, request.customer_info, tenant_id)
             
-    except Exception as e:
-        print(f"💥 Exception during order creation: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=400, detail=str(e))
+            result = crud.create_order_with_payment(
+                db=db, 
+                order_data=order_data, 
+                customer_id=customer_id, 
+                tenant_id=tenant_id
+            )
+            
+            if result["success"]:
+                logger.info("Guest order created", extra={"order_number": result["order"].order_number})
+                return _order_response(result)
+            else:
+                logger.info("Guest order failed", extra={"error": result["error"]})
+                raise HTTPException(status_code=400, detail=result["error"])
+                
+        except ValueError as e:
+            # Invalid items, insufficient stock or an email owned by another store;
+            # anything else propagates so the Idempotency-Key is released
+            logger.info("Guest order rejected", extra={"error": str(e)})
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    return _run_idempotent(db, tenant_id, "orders/guest", idempotency_key, request.model_dump(), place_order)
 
 # Search endpoints
 @router.get("/{tenant_domain}/search", response_model=List[schemas.Product])
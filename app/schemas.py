@@ -1,9 +1,16 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import AfterValidator, BaseModel, Field
+from typing import Annotated, Optional, List
 from datetime import datetime
 from decimal import Decimal
+import uuid
 from .models import Role, OrderStatus
 
+def _canonical_uuid(value: str) -> str:
+    return str(uuid.UUID(value))
+
+# Inventory hold tokens are UUIDs issued by create_inventory_holds
+HoldToken = Annotated[str, AfterValidator(_canonical_uuid)]
+
 # Schema for token data
 class Token(BaseModel):
     access_token: str
@@ -12,6 +19,14 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     email: Optional[str] = None
 
+class TokenClaims(BaseModel):
+    """Identity carried by an admin access token; attribute names mirror models.User"""
+    id: int
+    tenant_id: int
+    role: Role
+    email: str
+    token_version: int
+
 # --- Product Schemas ---
 class ProductBase(BaseModel):
     name: str
@@ -184,6 +199,7 @@ class OrderBase(BaseModel):
 class OrderCreate(BaseModel):
     items: List[OrderItemCreate]
     shipping_address: AddressCreate
+    hold_token: Optional[HoldToken] = None  # Inventory hold taken when checkout started
 
 class Order(OrderBase):
     id: int
@@ -203,6 +219,19 @@ class Order(OrderBase):
 class OrderStatusUpdate(BaseModel):
     status: OrderStatus
 
+class OrderStatusBatchUpdate(BaseModel):
+    order_ids: List[int] = Field(..., min_length=1, max_length=5000)
+    status: OrderStatus
+
+class OrderStatusBatchOutcome(BaseModel):
+    order_id: int
+    outcome: str  # updated, unchanged, not_found, insufficient_inventory
+
+class OrderStatusBatchResult(BaseModel):
+    status: OrderStatus
+    updated: int
+    results: List[OrderStatusBatchOutcome]
+
 # --- Payment Schemas ---
 class PaymentRequest(BaseModel):
     card_number: str
@@ -226,6 +255,37 @@ class OrderCreateWithPayment(BaseModel):
     items: List[OrderItemCreate]
     shipping_address: AddressCreate
     payment: PaymentRequest
+    hold_token: Optional[HoldToken] = None  # Inventory hold taken when checkout started
+
+# --- Cart Quote Schemas ---
+class CartQuoteRequest(BaseModel):
+    items: List[OrderItemCreate]
+    hold_token: Optional[HoldToken] = None  # Count this checkout's own holds as available
+
+class CartQuoteLine(BaseModel):
+    product_id: int
+    name: Optional[str] = None
+    quantity: int
+    unit_price: Optional[float] = None
+    line_total: float = 0.0
+    available_quantity: int = 0
+    available: bool = False
+    error: Optional[str] = None
+
+class CartQuote(BaseModel):
+    items: List[CartQuoteLine]
+    total_amount: float
+    all_available: bool
+
+# --- Inventory Hold Schemas ---
+class InventoryHoldRequest(BaseModel):
+    items: List[OrderItemCreate]
+    hold_token: Optional[HoldToken] = None  # Replace the holds of an existing checkout
+
+class InventoryHold(BaseModel):
+    hold_token: str
+    expires_at: datetime
+    items: List[OrderItemCreate]
 
 # --- Category Schemas ---
 class CategoryBase(BaseModel):
@@ -1,8 +1,12 @@
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from typing import Optional
+import hashlib
 import os
+import logging
+import threading
+import time
 from dotenv import load_dotenv
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
@@ -10,24 +14,79 @@ from sqlalchemy.orm import Session
 
 from . import crud, models, schemas
 from .database import get_db
+from .logging_config import bind_log_context
+from .services.passwords import hasher
+from .services.token_versions import token_versions
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 SECRET_KEY = os.getenv("SECRET_KEY", "default_secret_key_for_dev")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+STREAM_TICKET_EXPIRE_SECONDS = int(os.getenv("STREAM_TICKET_EXPIRE_SECONDS", 60))
+STREAM_TICKET_PURPOSE = "order-stream"
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
-# Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+class DecodedTokenCache:
+    """
+    Bounded LRU of verified token payloads keyed by the token's SHA-256, so a
+    token is parsed and HMAC-checked once rather than on every request. An
+    entry is served only until the token's exp; revocation is still checked
+    per request against the token version.
+    """
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def decode(self, token: str) -> dict:
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])  # Raises JWTError
+        expires_at = payload.get("exp")
+        if self.max_size > 0 and isinstance(expires_at, (int, float)):
+            with self._lock:
+                self._entries[key] = (expires_at, payload)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return payload
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+token_cache = DecodedTokenCache(TOKEN_CACHE_SIZE)
+
+def decode_token(token: str) -> dict:
+    """Verified payload of a JWT (cached until it expires); raises JWTError if invalid"""
+    return token_cache.decode(token)
 
+# Password hashing runs in a process pool, see services/passwords.py
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return hasher.verify(plain_password, hashed_password)
+
+def verify_and_update_password(plain_password, hashed_password):
+    """Return (valid, new hash or None); a new hash means the stored one should be replaced"""
+    return hasher.verify_and_update(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -39,6 +98,54 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_user_access_token(user: models.User):
+    """
+    Admin access token carrying everything tenant-scoped routes need: user id,
+    tenant id, role and the token version that revocation checks against.
+    """
+    return create_access_token(data={
+        "sub": user.email,
+        "uid": user.id,
+        "tid": user.tenant_id,
+        "role": user.role.value,
+        "ver": user.token_version
+    })
+
+def create_stream_ticket(claims: schemas.TokenClaims) -> str:
+    """
+    Short-lived token that can only open the order event stream. EventSource
+    cannot send headers, so this goes in the URL instead of the access token;
+    it carries no subject and is rejected by every other auth dependency.
+    """
+    return create_access_token(data={
+        "purpose": STREAM_TICKET_PURPOSE,
+        "uid": claims.id,
+        "tid": claims.tenant_id,
+        "ver": claims.token_version
+    }, expires_delta=timedelta(seconds=STREAM_TICKET_EXPIRE_SECONDS))
+
+def verify_stream_ticket(ticket: str) -> Optional[int]:
+    """Tenant id of a valid, unexpired and unrevoked stream ticket, else None"""
+    try:
+        payload = decode_token(ticket)
+    except JWTError:
+        return None
+    if payload.get("purpose") != STREAM_TICKET_PURPOSE or not _token_version_valid(payload):
+        return None
+    return payload.get("tid")
+
+def remember_token_version(user: models.User):
+    """Apply a token version bump to this process's revocation check immediately"""
+    token_versions.set(user.id, user.token_version)
+
+def _token_version_valid(payload: dict, user: Optional[models.User] = None) -> bool:
+    """Tokens issued before the user's current version are revoked; tokens without "ver" predate versioning"""
+    if "ver" not in payload:
+        return True
+    if user is not None:
+        return payload["ver"] == user.token_version
+    return payload["ver"] == token_versions.current(payload.get("uid"))
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -46,7 +153,7 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
@@ -54,8 +161,9 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
     user = crud.get_user_by_email(db, email=token_data.email)
-    if user is None:
+    if user is None or not _token_version_valid(payload, user):
         raise credentials_exception
+    bind_log_context(tenant_id=user.tenant_id)
     return user
 
 def get_super_admin_user(current_user: models.User = Depends(get_current_user)):
@@ -63,48 +171,84 @@ def get_super_admin_user(current_user: models.User = Depends(get_current_user)):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this resource.")
     return current_user
 
-def get_current_user_alternative(request: Request, db: Session = Depends(get_db)):
+def _request_token(request: Request):
+    """Return (token, source header), checking custom headers before Authorization for Cloudflare compatibility"""
+    # Check custom headers first (less likely to be stripped by Cloudflare)
+    for header_name in ['x-auth-token', 'x-user-token', 'x-api-key']:
+        if header_name in request.headers:
+            logger.debug(f"Token source: {header_name}")
+            return request.headers[header_name], header_name
+    
+    # Fallback to Authorization header
+    auth_header = request.headers.get('authorization', '')
+    if auth_header.startswith('Bearer '):
+        logger.debug("Token source: Authorization")
+        return auth_header[7:], "Authorization"  # Remove 'Bearer ' prefix
+    return None, None
+
+def get_current_claims(request: Request):
     """
-    Alternative authentication method that checks multiple headers for Cloudflare compatibility.
-    Checks X-Auth-Token, X-User-Token, X-API-Key, and Authorization headers.
+    Authorize from the token alone: returns the caller's TokenClaims without
+    touching the database, for routes that only need the user's tenant, id,
+    role or email. Revoked tokens are rejected via the in-memory version map.
     """
-    from fastapi import Request
-    import logging
-    
-    logger = logging.getLogger(__name__)
-    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    # Try multiple header sources
-    token = None
-    token_source = None
+    token, _ = _request_token(request)
+    if not token:
+        raise credentials_exception
+    try:
+        payload = decode_token(token)
+    except JWTError:
+        raise credentials_exception
+    if "purpose" in payload:
+        raise credentials_exception  # Single-purpose tickets are not access tokens
     
-    # Check custom headers first (less likely to be stripped by Cloudflare)
-    for header_name in ['x-auth-token', 'x-user-token', 'x-api-key']:
-        if header_name in request.headers:
-            token = request.headers[header_name]
-            token_source = header_name
-            logger.debug(f"Token source: {header_name}, Token found: {token is not None}")
-            break
+    if "uid" not in payload:
+        # Token issued before claims were added: resolve the user once
+        from .database import SessionLocal
+        db = SessionLocal()
+        try:
+            user = crud.get_user_by_email(db, email=payload.get("sub")) if payload.get("sub") else None
+            if user is None:
+                raise credentials_exception
+            claims = schemas.TokenClaims(
+                id=user.id, tenant_id=user.tenant_id, role=user.role, email=user.email, token_version=user.token_version
+            )
+        finally:
+            db.close()
+    else:
+        if not _token_version_valid(payload):
+            raise credentials_exception
+        claims = schemas.TokenClaims(
+            id=payload["uid"], tenant_id=payload["tid"], role=payload["role"], email=payload["sub"], token_version=payload["ver"]
+        )
     
-    # Fallback to Authorization header
-    if not token and 'authorization' in request.headers:
-        auth_header = request.headers['authorization']
-        if auth_header.startswith('Bearer '):
-            token = auth_header[7:]  # Remove 'Bearer ' prefix
-            token_source = "Authorization"
-            logger.debug(f"Token source: Authorization, Token found: {token is not None}")
+    bind_log_context(tenant_id=claims.tenant_id)
+    return claims
+
+def get_current_user_alternative(request: Request, db: Session = Depends(get_db)):
+    """
+    Alternative authentication method that checks multiple headers for Cloudflare compatibility.
+    Checks X-Auth-Token, X-User-Token, X-API-Key, and Authorization headers.
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
     
+    token, token_source = _request_token(request)
     if not token:
         logger.debug("No token found in any header")
         raise credentials_exception
     
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         email: str = payload.get("sub")
         if email is None:
             logger.debug("No email found in token payload")
@@ -119,8 +263,26 @@ def get_current_user_alternative(request: Request, db: Session = Depends(get_db)
     if user is None:
         logger.debug(f"User not found for email: {token_data.email}")
         raise credentials_exception
+    if not _token_version_valid(payload, user):
+        logger.debug(f"Revoked token for user: {user.email}")
+        raise credentials_exception
     
     logger.debug(f"Authentication successful for user: {user.email} via {token_source}")
+    bind_log_context(tenant_id=user.tenant_id)
+    return user
+
+def get_user_from_token(db: Session, token: str):
+    """Resolve a bearer token to its user, or None if it is invalid"""
+    try:
+        payload = decode_token(token)
+    except JWTError:
+        return None
+    email = payload.get("sub")
+    if email is None:
+        return None
+    user = crud.get_user_by_email(db, email=email)
+    if user is None or not _token_version_valid(payload, user):
+        return None
     return user
 
 def get_current_customer(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
@@ -131,7 +293,7 @@ def get_current_customer(token: str = Depends(oauth2_scheme), db: Session = Depe
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         customer_id: int = payload.get("customer_id")
         tenant_id: int = payload.get("tenant_id")
         if customer_id is None or tenant_id is None:
@@ -142,6 +304,7 @@ def get_current_customer(token: str = Depends(oauth2_scheme), db: Session = Depe
     customer = crud.get_customer_by_id(db, customer_id=customer_id, tenant_id=tenant_id)
     if customer is None:
         raise credentials_exception
+    bind_log_context(tenant_id=tenant_id)
     return customer
 
 def get_current_customer_alternative(request: Request, db: Session = Depends(get_db)):
@@ -169,7 +332,7 @@ def get_current_customer_alternative(request: Request, db: Session = Depends(get
         raise credentials_exception
     
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         customer_id: int = payload.get("customer_id")
         tenant_id: int = payload.get("tenant_id")
         if customer_id is None or tenant_id is None:
@@ -180,4 +343,5 @@ def get_current_customer_alternative(request: Request, db: Session = Depends(get
     customer = crud.get_customer_by_id(db, customer_id=customer_id, tenant_id=tenant_id)
     if customer is None:
         raise credentials_exception
+    bind_log_context(tenant_id=tenant_id)
     return customer
@@ -0,0 +1,391 @@
+"""
+Analytics Cache and Precompute Scheduler
+Dashboard analytics are served from an in-process cache. A background
+scheduler keeps the common views (overview, revenue trend and top products for
+7, 30 and 90 days) warm for every tenant with recent orders, spreading tenants
+evenly across each cycle and capping how many refresh at once.
+
+Order events mark the affected tenant's entries stale rather than dropping
+them: stale entries keep being served while they are recomputed in the
+background, so a tenant with a steady stream of orders never sees a cold
+dashboard. Each worker process has its own cache, and only receives events
+for orders written by other processes when ORDER_EVENTS_PG_NOTIFY=true;
+without it, entries in the other workers can serve pre-change numbers for up
+to ANALYTICS_CACHE_TTL_SECONDS. Run with a single worker or enable
+ORDER_EVENTS_PG_NOTIFY (docker-compose does).
+
+Only one process runs the precompute scheduler: the one holding the
+ANALYTICS_PRECOMPUTE_LOCK advisory lock. The other workers fill their caches
+on demand.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+import sqlalchemy as sa
+
+from .. import crud, models
+from ..database import STATEMENT_TIMEOUTS_MS, SessionLocal, engine
+from .order_events import broker
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_CACHE_TTL_SECONDS = float(os.getenv("ANALYTICS_CACHE_TTL_SECONDS", 600))
+ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_CACHE_MAX_ENTRIES", 5000))
+ANALYTICS_CACHE_REVALIDATE_SECONDS = float(os.getenv("ANALYTICS_CACHE_REVALIDATE_SECONDS", 10))
+ANALYTICS_CACHE_REVALIDATE_CONCURRENCY = int(os.getenv("ANALYTICS_CACHE_REVALIDATE_CONCURRENCY", 2))
+ANALYTICS_PRECOMPUTE_ENABLED = os.getenv("ANALYTICS_PRECOMPUTE_ENABLED", "true").lower() == "true"
+ANALYTICS_PRECOMPUTE_SECONDS = float(os.getenv("ANALYTICS_PRECOMPUTE_SECONDS", 300))
+ANALYTICS_PRECOMPUTE_CONCURRENCY = int(os.getenv("ANALYTICS_PRECOMPUTE_CONCURRENCY", 2))
+ANALYTICS_PRECOMPUTE_DAYS = [int(d) for d in os.getenv("ANALYTICS_PRECOMPUTE_DAYS", "7,30,90").split(",")]
+ANALYTICS_ACTIVE_TENANT_DAYS = int(os.getenv("ANALYTICS_ACTIVE_TENANT_DAYS", 90))
+
+# Session-level advisory lock held by the one process that runs the precompute scheduler
+ANALYTICS_PRECOMPUTE_LOCK = 43
+
+CacheKey = Tuple[int, str, tuple]
+
+class AnalyticsCache:
+    """
+    Thread-safe TTL cache of analytics results keyed by tenant, view and
+    parameters. Each tenant has a generation counter bumped on every order
+    event; an entry computed under an older generation is stale. Stale entries
+    are still served until their TTL runs out, while one background task per
+    key recomputes them, at most once every revalidate_seconds per key.
+    Keys include client-chosen parameters, so the cache holds at most
+    max_entries: when full, expired entries are swept and then the least
+    recently used ones evicted.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = ANALYTICS_CACHE_TTL_SECONDS,
+        max_entries: int = ANALYTICS_CACHE_MAX_ENTRIES,
+        revalidate_seconds: float = ANALYTICS_CACHE_REVALIDATE_SECONDS,
+        revalidate_concurrency: int = ANALYTICS_CACHE_REVALIDATE_CONCURRENCY
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.revalidate_seconds = revalidate_seconds
+        self.revalidate_concurrency = revalidate_concurrency
+        self._entries: "OrderedDict[CacheKey, Tuple[float, int, Any]]" = OrderedDict()  # key -> (stored at, generation, value)
+        self._generations: Dict[int, int] = {}
+        self._revalidating: Set[CacheKey] = set()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key: CacheKey, db, compute: Callable[[Any], Any], refresh: bool = False):
+        """
+        Return the cached value, computing it with db on a miss (or always,
+        with refresh). A stale value is returned as is and recomputed in the
+        background on a session of its own.
+        """
+        tenant_id = key[0]
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generations.get(tenant_id, 0)
+            entry = self._entries.get(key)
+            if not refresh and entry and now - entry[0] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                if entry[1] == generation:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    if key not in self._revalidating and now - entry[0] >= self.revalidate_seconds:
+                        self._revalidating.add(key)
+                        self._revalidation_executor().submit(self._revalidate, key, compute)
+                return entry[2]
+            if not refresh:
+                self.misses += 1
+
+        value = compute(db)
+        self._store(key, generation, value)
+        return value
+
+    def _store(self, key: CacheKey, generation: int, value):
+        """Store a value computed under generation, unless a newer one is already cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > generation:
+                return
+            self._entries[key] = (time.monotonic(), generation, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _revalidation_executor(self) -> ThreadPoolExecutor:
+        """Started on first use (lock held)"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.revalidate_concurrency, thread_name_prefix="analytics-revalidate"
+            )
+        return self._executor
+
+    def _revalidate(self, key: CacheKey, compute: Callable[[Any], Any]):
+        with self._lock:
+            generation = self._generations.get(key[0], 0)
+        db = SessionLocal()
+        db.info["statement_timeout_ms"] = STATEMENT_TIMEOUTS_MS["analytics"]
+        try:
+            self._store(key, generation, compute(db))
+        except Exception:
+            logger.exception(f"Analytics revalidation failed for {key[1]} of tenant {key[0]}")
+        finally:
+            db.close()
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def _evict(self):
+        """Drop expired entries, then least recently used ones until within max_entries (lock held)"""
+        expired_before = time.monotonic() - self.ttl_seconds
+        for key in [k for k, (stored_at, _, _) in self._entries.items() if stored_at <= expired_before]:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def mark_tenant_stale(self, tenant_id: int):
+        with self._lock:
+            self._generations[tenant_id] = self._generations.get(tenant_id, 0) + 1
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "revalidating": len(self._revalidating),
+                "ttl_seconds": self.ttl_seconds,
+                "revalidate_seconds": self.revalidate_seconds
+            }
+
+cache = AnalyticsCache()
+
+broker.add_listener(lambda event: cache.mark_tenant_stale(event["tenant_id"]))
+
+def sales_overview(db, tenant_id: int, days: int = 30, category_id: Optional[int] = None, refresh: bool = False):
+    return cache.get_or_compute(
+        (tenant_id, "overview", (days, category_id)),
+        db,
+        lambda session: crud.get_sales_overview(session, tenant_id, days=days, category_id=category_id),
+        refresh
+    )
+
+def revenue_trend(
+    db,
+    tenant_id: int,
+    days: int = 30,
+    category_id: Optional[int] = None,
+    granularity: str = "day",
+    tz: str = "UTC",
+    refresh: bool = False
+):
+    return cache.get_or_compute(
+        (tenant_id, "revenue_trend", (days, category_id, granularity, tz)),
+        db,
+        lambda session: crud.get_revenue_trend(
+            session, tenant_id, days=days, category_id=category_id, granularity=granularity, tz=tz
+        ),
+        refresh
+    )
+
+def unique_customers(db, tenant_id: int, days: int = 30, granularity: str = "day", refresh: bool = False):
+    return cache.get_or_compute(
+        (tenant_id, "unique_customers", (days, granularity)),
+        db,
+        lambda session: crud.get_unique_customer_trend(session, tenant_id, days=days, granularity=granularity),
+        refresh
+    )
+
+def top_products(
+    db,
+    tenant_id: int,
+    days: int = 30,
+    limit: int = 10,
+    category_id: Optional[int] = None,
+    rank_by: str = "revenue",
+    all_time: bool = False,
+    refresh: bool = False
+):
+    return cache.get_or_compute(
+        (tenant_id, "top_products", (days, limit, category_id, rank_by, all_time)),
+        db,
+        lambda session: crud.get_top_products(
+            session, tenant_id, days=days, limit=limit, category_id=category_id, rank_by=rank_by, all_time=all_time
+        ),
+        refresh
+    )
+
+def _refresh_tenant(db, tenant_id: int):
+    """Recompute the default dashboard views of one tenant, replacing cached entries in place"""
+    for days in ANALYTICS_PRECOMPUTE_DAYS:
+        sales_overview(db, tenant_id, days=days, refresh=True)
+        revenue_trend(db, tenant_id, days=days, refresh=True)
+        top_products(db, tenant_id, days=days, refresh=True)
+
+def get_active_tenant_ids(db):
+    """Tenants with orders in the last ANALYTICS_ACTIVE_TENANT_DAYS days"""
+    rollup = models.DailyOrderRollup
+    return [row[0] for row in db.query(rollup.tenant_id).filter(
+        rollup.day > sa.func.current_date() - ANALYTICS_ACTIVE_TENANT_DAYS
+    ).distinct().order_by(rollup.tenant_id)]
+
+class AnalyticsPrecomputer:
+    """
+    Refreshes every active tenant once per interval. Tenants are started at
+    evenly spaced offsets within the cycle, at most `concurrency` refresh at a
+    time, and a tenant still refreshing from the previous cycle is skipped.
+    Every worker process starts one, but only the process holding the
+    ANALYTICS_PRECOMPUTE_LOCK advisory lock runs cycles; the others retry the
+    lock each interval, so a new leader takes over if the current one exits.
+    The lock is held on a dedicated pooled connection for as long as the
+    process leads.
+    """
+
+    def __init__(self, interval_seconds: float, concurrency: int):
+        self.interval_seconds = interval_seconds
+        self.concurrency = concurrency
+        self.freshness: Dict[int, dict] = {}
+        self._in_flight: Set[int] = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._leader_connection: Optional[sa.engine.Connection] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader_connection is not None
+
+    def start(self):
+        if not ANALYTICS_PRECOMPUTE_ENABLED or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="analytics-precompute")
+        self._thread = threading.Thread(target=self._run, name="analytics-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"Started analytics precompute every {self.interval_seconds}s (concurrency {self.concurrency})")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._resign()
+
+    def _elect(self) -> bool:
+        """Take or confirm the precompute lock; True while this process is the leader"""
+        if self._leader_connection is not None:
+            try:
+                self._leader_connection.execute(sa.select(1))
+                self._leader_connection.commit()
+                return True
+            except Exception:
+                logger.warning("Lost the analytics precompute lock connection")
+                self._resign()
+
+        connection = engine.connect()
+        try:
+            acquired = connection.execute(sa.select(sa.func.pg_try_advisory_lock(ANALYTICS_PRECOMPUTE_LOCK))).scalar()
+            connection.commit()  # The lock is session-level; don't sit idle in a transaction
+        except Exception:
+            connection.close()
+            raise
+        if not acquired:
+            connection.close()
+            return False
+        self._leader_connection = connection
+        logger.info("Elected to run analytics precompute")
+        return True
+
+    def _resign(self):
+        """Release the precompute lock by discarding its connection rather than returning it to the pool"""
+        connection, self._leader_connection = self._leader_connection, None
+        if connection is not None:
+            connection.invalidate()
+            connection.close()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            cycle_start = time.monotonic()
+            try:
+                if self._elect():
+                    self._run_cycle(cycle_start)
+            except Exception:
+                logger.exception("Analytics precompute cycle failed")
+            self._stop_event.wait(max(0.0, cycle_start + self.interval_seconds - time.monotonic()))
+
+    def _run_cycle(self, cycle_start: float):
+        db = SessionLocal()
+        try:
+            tenant_ids = get_active_tenant_ids(db)
+        finally:
+            db.close()
+        if not tenant_ids:
+            return
+
+        spacing = self.interval_seconds / len(tenant_ids)
+        for index, tenant_id in enumerate(tenant_ids):
+            if self._stop_event.wait(max(0.0, cycle_start + index * spacing - time.monotonic())):
+                return
+            with self._lock:
+                if tenant_id in self._in_flight:
+                    continue
+                self._in_flight.add(tenant_id)
+            self._executor.submit(self._refresh, tenant_id)
+
+    def _refresh(self, tenant_id: int):
+        started = time.monotonic()
+        error = None
+        db = SessionLocal()
+        try:
+            _refresh_tenant(db, tenant_id)
+        except Exception as e:
+            error = str(e)[:500]
+            logger.exception(f"Analytics precompute failed for tenant {tenant_id}")
+        finally:
+            db.close()
+            with self._lock:
+                self._in_flight.discard(tenant_id)
+                previous = self.freshness.get(tenant_id, {})
+                self.freshness[tenant_id] = {
+                    "refreshed_at": previous.get("refreshed_at") if error else datetime.utcnow(),
+                    "duration_ms": round((time.monotonic() - started) * 1000, 1),
+                    "last_error": error
+                }
+
+    def freshness_report(self) -> list:
+        now = datetime.utcnow()
+        with self._lock:
+            return [
+                {
+                    "tenant_id": tenant_id,
+                    "refreshed_at": state["refreshed_at"],
+                    "age_seconds": round((now - state["refreshed_at"]).total_seconds(), 1) if state["refreshed_at"] else None,
+                    "duration_ms": state["duration_ms"],
+                    "last_error": state["last_error"],
+                    "refreshing": tenant_id in self._in_flight
+                }
+                for tenant_id, state in sorted(self.freshness.items())
+            ]
+
+precomputer = AnalyticsPrecomputer(ANALYTICS_PRECOMPUTE_SECONDS, ANALYTICS_PRECOMPUTE_CONCURRENCY)
@@ -0,0 +1,63 @@
+"""
+Background Workers
+Small in-process helpers for periodic maintenance jobs that run alongside
+the API (expired hold sweeping, queue draining, etc.).
+"""
+
+import logging
+import os
+import threading
+from typing import Callable, Optional
+
+from .. import crud
+from ..database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+class PeriodicWorker:
+    """Run a function every interval_seconds in a daemon thread until stopped"""
+    
+    def __init__(self, name: str, interval_seconds: float, target: Callable[[], None]):
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.target = target
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info(f"Started background worker {self.name} (every {self.interval_seconds}s)")
+    
+    def stop(self, timeout: float = 5.0):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+    
+    def _run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                self.target()
+            except Exception:
+                logger.exception(f"Background worker {self.name} failed")
+
+def sweep_expired_reservations():
+    """Reclaim stock from expired inventory holds and drop expired idempotency keys"""
+    db = SessionLocal()
+    try:
+        holds = crud.purge_expired_inventory_holds(db)
+        keys = crud.purge_expired_idempotency_keys(db)
+        if holds or keys:
+            logger.info(f"Swept {holds} expired inventory holds and {keys} expired idempotency keys")
+    finally:
+        db.close()
+
+INVENTORY_HOLD_SWEEP_SECONDS = float(os.getenv("INVENTORY_HOLD_SWEEP_SECONDS", 60))
+
+reservation_sweeper = PeriodicWorker(
+    "reservation-sweeper", INVENTORY_HOLD_SWEEP_SECONDS, sweep_expired_reservations
+)
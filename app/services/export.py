@@ -0,0 +1,198 @@
+"""
+Columnar Analytics Export
+Writes a tenant's orders, order items or products as Parquet or an Arrow IPC
+stream. Rows are read from a server-side cursor and converted one record batch
+at a time, so memory stays flat however large the tenant is. Status and
+category columns are dictionary encoded.
+
+pyarrow is imported lazily; without it exports raise ExportUnavailableError.
+"""
+
+import datetime
+import os
+from typing import Iterator, Optional
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..database import SessionLocal
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 10000))
+
+EXPORT_TABLES = ("orders", "order_items", "products")
+
+EXPORT_FORMATS = {
+    # format: (file extension, media type)
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "arrow": ("arrows", "application/vnd.apache.arrow.stream"),
+}
+
+class ExportUnavailableError(RuntimeError):
+    """pyarrow is not installed"""
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ExportUnavailableError("Columnar export requires the pyarrow package") from e
+    return pyarrow
+
+def _order_date_filter(date_from: Optional[datetime.datetime], date_to: Optional[datetime.datetime]):
+    conditions = []
+    if date_from:
+        conditions.append(models.Order.created_at >= date_from)
+    if date_to:
+        conditions.append(models.Order.created_at < date_to)
+    return conditions
+
+def _export_query(table: str, tenant_id: int, date_from=None, date_to=None):
+    """Return (select statement, [(column name, arrow type name)]) for an export table"""
+    if table == "orders":
+        columns = [
+            ("id", models.Order.id, "int64"),
+            ("order_number", models.Order.order_number, "string"),
+            ("customer_id", models.Order.customer_id, "int64"),
+            ("status", sa.func.lower(sa.cast(models.Order.status, sa.String)), "dictionary"),
+            ("total_amount", models.Order.total_amount, "decimal"),
+            ("shipping_address_id", models.Order.shipping_address_id, "int64"),
+            ("created_at", models.Order.created_at, "timestamp"),
+            ("updated_at", models.Order.updated_at, "timestamp"),
+        ]
+        query = sa.select(*[c[1] for c in columns]).where(
+            models.Order.tenant_id == tenant_id,
+            *_order_date_filter(date_from, date_to)
+        ).order_by(models.Order.id)
+    elif table == "order_items":
+        columns = [
+            ("id", models.OrderItem.id, "int64"),
+            ("order_id", models.OrderItem.order_id, "int64"),
+            ("product_id", models.OrderItem.product_id, "int64"),
+            ("quantity", models.OrderItem.quantity, "int64"),
+            ("unit_price", models.OrderItem.unit_price, "decimal"),
+            ("total_price", models.OrderItem.total_price, "decimal"),
+            ("order_status", sa.func.lower(sa.cast(models.Order.status, sa.String)), "dictionary"),
+            ("order_created_at", models.Order.created_at, "timestamp"),
+        ]
+        query = sa.select(*[c[1] for c in columns]).join(
+            models.Order, models.OrderItem.order_id == models.Order.id
+        ).where(
+            models.Order.tenant_id == tenant_id,
+            *_order_date_filter(date_from, date_to)
+        ).order_by(models.OrderItem.id)
+    elif table == "products":
+        columns = [
+            ("id", models.Product.id, "int64"),
+            ("name", models.Product.name, "string"),
+            ("category", sa.func.coalesce(models.Category.name, models.Product.category), "dictionary"),
+            ("category_id", models.Product.category_id, "int64"),
+            ("price", models.Product.price, "float64"),
+            ("quantity", models.Product.quantity, "int64"),
+            ("created_at", models.Product.created_at, "timestamp"),
+        ]
+        query = sa.select(*[c[1] for c in columns]).outerjoin(
+            models.Category, models.Product.category_id == models.Category.id
+        ).where(models.Product.tenant_id == tenant_id).order_by(models.Product.id)
+    else:
+        raise ValueError(f"Unknown export table: {table}")
+
+    return query, [(name, type_name) for name, _, type_name in columns]
+
+def _arrow_schema(pa, columns):
+    types = {
+        "int64": pa.int64(),
+        "string": pa.string(),
+        "dictionary": pa.dictionary(pa.int32(), pa.string()),
+        "decimal": pa.decimal128(14, 2),
+        "float64": pa.float64(),
+        "timestamp": pa.timestamp("us"),
+    }
+    return pa.schema([(name, types[type_name]) for name, type_name in columns])
+
+def write_export(
+    db: Session,
+    sink,
+    table: str,
+    tenant_id: int,
+    export_format: str = "parquet",
+    date_from: Optional[datetime.datetime] = None,
+    date_to: Optional[datetime.datetime] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> Iterator[int]:
+    """
+    Write one export table to a binary file-like sink, yielding the row count
+    after each record batch so callers can forward the bytes written so far.
+    """
+    pa = _pyarrow()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+
+    query, columns = _export_query(table, tenant_id, date_from, date_to)
+    schema = _arrow_schema(pa, columns)
+    if export_format == "parquet":
+        writer = pa.parquet.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    # Server-side cursor for this statement only: rows arrive batch_size at a time
+    result = db.execute(query, execution_options={"stream_results": True, "yield_per": batch_size})
+    try:
+        for rows in result.partitions():
+            arrays = [
+                pa.array([row[i] for row in rows], type=field.type)
+                for i, field in enumerate(schema)
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield len(rows)
+    finally:
+        result.close()
+        writer.close()
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self._chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+def stream_export(
+    table: str,
+    tenant_id: int,
+    export_format: str = "parquet",
+    date_from: Optional[datetime.datetime] = None,
+    date_to: Optional[datetime.datetime] = None
+) -> Iterator[bytes]:
+    """Yield an export file in chunks for a streaming HTTP response; uses its own session"""
+    _pyarrow()  # Fail before the response starts if pyarrow is missing
+
+    def chunks():
+        db = SessionLocal()
+        sink = _ChunkSink()
+        try:
+            for _ in write_export(db, sink, table, tenant_id, export_format, date_from, date_to):
+                data = sink.drain()
+                if data:
+                    yield data
+            data = sink.drain()  # Footer written on close
+            if data:
+                yield data
+        finally:
+            db.close()
+
+    return chunks()
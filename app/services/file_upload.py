@@ -8,6 +8,9 @@ import aiohttp
 import asyncio
 from urllib.parse import urlparse
 import re
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 UPLOAD_DIR = Path("app/static/uploads/products")
@@ -130,7 +133,7 @@ class FileUploadService:
                 return True
             
         except Exception as e:
-            print(f"Error deleting image: {e}")
+            logger.warning(f"Error deleting image: {e}")
         
         return False
     
@@ -158,7 +161,7 @@ class FileUploadService:
                     }
             
         except Exception as e:
-            print(f"Error getting image info: {e}")
+            logger.warning(f"Error getting image info: {e}")
         
         return {"exists": False}
     
@@ -239,7 +242,7 @@ class FileUploadService:
                 return True
             
         except Exception as e:
-            print(f"Error deleting logo: {e}")
+            logger.warning(f"Error deleting logo: {e}")
         
         return False
     
@@ -308,7 +311,7 @@ class FileUploadService:
                 return True
             
         except Exception as e:
-            print(f"Error deleting banner: {e}")
+            logger.warning(f"Error deleting banner: {e}")
         
         return False
 
@@ -0,0 +1,51 @@
+"""
+HyperLogLog Sketches
+Fixed-size (4 KiB) distinct-count sketches. A sketch holds one byte register
+per bucket; adding a value keeps the largest rank seen in its bucket, so
+sketches merge by taking the register-wise maximum and the union of any
+number of days estimates in constant time with a relative standard error of
+about 1.6%.
+"""
+
+import hashlib
+import math
+from typing import Iterable, Tuple
+
+import numpy as np
+
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_RELATIVE_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+
+_RANK_BITS = 64 - HLL_PRECISION
+_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+
+def register_position(value) -> Tuple[int, int]:
+    """Return (register index, rank) of a value: rank is 1 + leading zeros of the remaining hash bits"""
+    digest = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+    remainder = digest & ((1 << _RANK_BITS) - 1)
+    return digest >> _RANK_BITS, _RANK_BITS - remainder.bit_length() + 1
+
+def empty_registers() -> bytearray:
+    return bytearray(HLL_REGISTERS)
+
+def add(registers: bytearray, value):
+    index, rank = register_position(value)
+    if registers[index] < rank:
+        registers[index] = rank
+
+def merge(sketches: Iterable[bytes]) -> np.ndarray:
+    """Register-wise maximum of stored sketches"""
+    merged = np.zeros(HLL_REGISTERS, dtype=np.uint8)
+    for sketch in sketches:
+        np.maximum(merged, np.frombuffer(sketch, dtype=np.uint8), out=merged)
+    return merged
+
+def estimate(registers: np.ndarray) -> int:
+    """Estimated number of distinct values added to the (merged) registers"""
+    raw = _ALPHA * HLL_REGISTERS ** 2 / np.sum(np.ldexp(1.0, -registers.astype(np.int32)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if raw <= 2.5 * HLL_REGISTERS and zeros:
+        # Small range correction: linear counting over empty registers
+        return round(HLL_REGISTERS * math.log(HLL_REGISTERS / zeros))
+    return round(raw)
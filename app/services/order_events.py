@@ -0,0 +1,156 @@
+"""
+Live Order Events
+Order changes are pushed to connected admin dashboards (GET /orders/stream)
+through an in-process broker. Events are staged on the session and only
+published once the transaction commits.
+
+With ORDER_EVENTS_PG_NOTIFY enabled the events are sent with pg_notify instead,
+inside the writing transaction, and every worker process LISTENs on the channel
+so dashboards connected to any worker receive them.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Set, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from ..database import SessionLocal, engine
+
+logger = logging.getLogger(__name__)
+
+ORDER_EVENTS_PG_NOTIFY = os.getenv("ORDER_EVENTS_PG_NOTIFY", "false").lower() == "true"
+ORDER_EVENTS_CHANNEL = os.getenv("ORDER_EVENTS_CHANNEL", "order_events")
+ORDER_EVENTS_QUEUE_SIZE = int(os.getenv("ORDER_EVENTS_QUEUE_SIZE", 100))
+
+_SESSION_KEY = "pending_order_events"
+
+class OrderEventBroker:
+    """Fans events out to per-connection asyncio queues, grouped by tenant"""
+    
+    def __init__(self, queue_size: int = ORDER_EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, Set[Tuple[asyncio.Queue, asyncio.AbstractEventLoop]]] = defaultdict(set)
+        self._listeners: List[Callable[[dict], None]] = []
+        self._lock = threading.Lock()
+    
+    def add_listener(self, listener: Callable[[dict], None]):
+        """Call listener(event) synchronously for every published event (e.g. cache invalidation)"""
+        self._listeners.append(listener)
+    
+    def subscribe(self, tenant_id: int) -> asyncio.Queue:
+        """Register a queue for the calling event loop; must be called from a coroutine"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[tenant_id].add((queue, asyncio.get_running_loop()))
+        return queue
+    
+    def unsubscribe(self, tenant_id: int, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers[tenant_id] = {s for s in self._subscribers[tenant_id] if s[0] is not queue}
+            if not self._subscribers[tenant_id]:
+                del self._subscribers[tenant_id]
+    
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+    
+    def publish(self, event: dict):
+        """Deliver an event to the tenant's subscribers; safe to call from any thread"""
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception("Order event listener failed")
+        with self._lock:
+            subscribers = list(self._subscribers.get(event["tenant_id"], ()))
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self._offer, queue, event)
+    
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A stalled client misses events; it refetches when it catches up
+            logger.warning("Dropping order event for a slow stream subscriber")
+
+broker = OrderEventBroker()
+
+def stage_order_event(db: Session, tenant_id: int, event_type: str, order_id: int, payload: dict):
+    """Queue an order event for delivery when the session's transaction commits"""
+    event = {"tenant_id": tenant_id, "type": event_type, "order_id": order_id, **payload}
+    if ORDER_EVENTS_PG_NOTIFY:
+        # NOTIFY is transactional: Postgres delivers it only on commit
+        db.execute(sa.select(sa.func.pg_notify(ORDER_EVENTS_CHANNEL, json.dumps(event, default=str))))
+    else:
+        db.info.setdefault(_SESSION_KEY, []).append(event)
+
+@sa.event.listens_for(SessionLocal, "after_commit")
+def _publish_committed_events(session):
+    for event in session.info.pop(_SESSION_KEY, []):
+        broker.publish(event)
+
+@sa.event.listens_for(SessionLocal, "after_soft_rollback")
+def _discard_rolled_back_events(session, previous_transaction):
+    session.info.pop(_SESSION_KEY, None)
+
+class NotificationListener:
+    """LISTENs on the order events channel and republishes into this process's broker"""
+    
+    def __init__(self, channel: str = ORDER_EVENTS_CHANNEL, poll_seconds: float = 5):
+        self.channel = channel
+        self.poll_seconds = poll_seconds
+        self._stop_event = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        if not ORDER_EVENTS_PG_NOTIFY or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="order-events-listener", daemon=True)
+        self._thread.start()
+        logger.info(f"Listening for order events on channel {self.channel}")
+    
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.poll_seconds + 1)
+    
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Order events listener failed; reconnecting")
+                self._stop_event.wait(self.poll_seconds)
+    
+    def _listen(self):
+        import psycopg2
+        
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        connection = psycopg2.connect(dsn)
+        try:
+            connection.set_session(autocommit=True)
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.channel}"')
+            while not self._stop_event.is_set():
+                if select.select([connection], [], [], self.poll_seconds) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    notification = connection.notifies.pop(0)
+                    try:
+                        broker.publish(json.loads(notification.payload))
+                    except (ValueError, KeyError):
+                        logger.warning(f"Ignoring malformed order event: {notification.payload[:200]}")
+        finally:
+            connection.close()
+
+notification_listener = NotificationListener()
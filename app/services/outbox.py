@@ -0,0 +1,75 @@
+"""
+Transactional Outbox
+Order events are written to the outbox_events table in the same transaction
+as the order change and delivered here by a background worker, so handlers
+never run for changes that were rolled back. Processed events are kept for
+OUTBOX_RETENTION_HOURS (0 keeps them forever) and then deleted by the same
+worker.
+"""
+
+import logging
+import os
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+import sqlalchemy as sa
+
+from .. import crud, models
+from ..database import SessionLocal
+from .background import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", 1))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", 72))
+
+EventHandler = Callable[[models.OutboxEvent], Any]
+
+_handlers: Dict[str, List[EventHandler]] = defaultdict(list)
+
+def register_handler(event_type: str, handler: EventHandler):
+    """Subscribe a handler to an event type ("*" receives every event)"""
+    _handlers[event_type].append(handler)
+
+def _log_event(event: models.OutboxEvent):
+    logger.info(f"Order event {event.event_type} for order {event.aggregate_id} (tenant {event.tenant_id})")
+
+register_handler("*", _log_event)
+
+def drain_outbox():
+    """Deliver pending outbox events in batches until the queue is empty, then purge a batch of old ones"""
+    while True:
+        db = SessionLocal()
+        try:
+            events = crud.get_pending_outbox_events(db, limit=OUTBOX_BATCH_SIZE)
+            for event in events:
+                try:
+                    for handler in _handlers[event.event_type] + _handlers["*"]:
+                        handler(event)
+                except Exception as e:
+                    event.attempts += 1
+                    event.last_error = str(e)[:500]
+                    if event.attempts >= OUTBOX_MAX_ATTEMPTS:
+                        logger.error(f"Giving up on outbox event {event.id} after {event.attempts} attempts: {e}")
+                        event.processed_at = sa.func.now()
+                    continue
+                event.processed_at = sa.func.now()
+            db.commit()
+        finally:
+            db.close()
+        
+        if len(events) < OUTBOX_BATCH_SIZE:
+            break
+    
+    if OUTBOX_RETENTION_HOURS > 0:
+        db = SessionLocal()
+        try:
+            purged = crud.purge_processed_outbox_events(db, OUTBOX_RETENTION_HOURS, limit=OUTBOX_BATCH_SIZE)
+            if purged:
+                logger.info(f"Purged {purged} processed outbox events older than {OUTBOX_RETENTION_HOURS}h")
+        finally:
+            db.close()
+
+outbox_worker = PeriodicWorker("outbox-drainer", OUTBOX_POLL_SECONDS, drain_outbox)
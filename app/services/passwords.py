@@ -0,0 +1,96 @@
+"""
+Password Hashing
+bcrypt runs in a small process pool so logins and registrations don't burn
+request-thread CPU under the GIL. A semaphore bounds the hashes queued or in
+flight; when it is exhausted callers get PasswordHashingBusyError (503)
+instead of piling up behind a login storm.
+
+Hashes created with a different cost factor are reported by
+verify_and_update() so login can transparently rehash them.
+
+Environment:
+    BCRYPT_ROUNDS                 cost factor for new hashes (default 12)
+    PASSWORD_HASH_WORKERS         pool processes; 0 hashes inline (default: CPU count)
+    PASSWORD_HASH_MAX_PENDING     hashes queued or running at once (default 4 per worker)
+    PASSWORD_HASH_WAIT_SECONDS    how long to wait for a slot before giving up (default 2)
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", max(PASSWORD_HASH_WORKERS, 1) * 4))
+PASSWORD_HASH_WAIT_SECONDS = float(os.getenv("PASSWORD_HASH_WAIT_SECONDS", 2))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+class PasswordHashingBusyError(RuntimeError):
+    """Too many password hashes are already queued"""
+
+# Pool workers: module-level so they can be pickled into the child processes
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int, wait_seconds: float):
+        self.workers = workers
+        self.wait_seconds = wait_seconds
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: forking a process that runs server threads is unsafe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _run(self, func, *args):
+        if self.workers <= 0:
+            return func(*args)
+        if not self._slots.acquire(timeout=self.wait_seconds):
+            logger.warning("Password hashing saturated, rejecting request")
+            raise PasswordHashingBusyError("Too many sign-ins in progress, please retry shortly")
+        try:
+            return self._pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash, password)
+
+    def verify(self, password: str, hashed_password: Optional[str]) -> bool:
+        if not hashed_password:
+            return False  # Guest accounts have no password
+        return self._run(_verify, password, hashed_password)
+
+    def verify_and_update(self, password: str, hashed_password: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """Verify a password; on success also return a new hash if the stored one uses outdated parameters"""
+        if not self.verify(password, hashed_password):
+            return False, None
+        if pwd_context.needs_update(hashed_password):
+            return True, self.hash(password)
+        return True, None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_WAIT_SECONDS)
@@ -6,10 +6,15 @@ In production, this would integrate with Stripe, PayPal, etc.
 
 import uuid
 import random
+import os
+import time
 from typing import Dict, Any
 from decimal import Decimal
 import re
 
+# Simulated gateway round trip; real processors typically add 300-2000 ms
+PAYMENT_GATEWAY_LATENCY_MS = int(os.getenv("PAYMENT_GATEWAY_LATENCY_MS", 0))
+
 class MockPaymentGateway:
     """Mock payment gateway that always approves valid credit card formats"""
     
@@ -148,6 +153,8 @@ class MockPaymentGateway:
         
         # Mock processing delay (in real world, this would be an API call)
         # For demo, we'll always approve
+        if PAYMENT_GATEWAY_LATENCY_MS > 0:
+            time.sleep(PAYMENT_GATEWAY_LATENCY_MS / 1000)
         
         return {
             "success": True,
@@ -160,6 +167,27 @@ class MockPaymentGateway:
             "message": "Payment processed successfully"
         }
 
+    @staticmethod
+    def refund_payment(transaction_id: str, amount: float) -> Dict[str, Any]:
+        """
+        Refund a previously approved payment (mock implementation)
+        Used when an order cannot be fulfilled after the card was charged
+        """
+        if not transaction_id:
+            return {
+                "success": False,
+                "error": "Missing transaction ID",
+                "refund_id": None
+            }
+        
+        return {
+            "success": True,
+            "refund_id": f"RFD_{uuid.uuid4().hex[:12].upper()}",
+            "transaction_id": transaction_id,
+            "amount": amount,
+            "message": "Payment refunded successfully"
+        }
+
 # Test credit card numbers (these pass Luhn algorithm)
 TEST_CARDS = {
     "visa": "4532015112830366",
@@ -0,0 +1,39 @@
+"""
+Rate Limiting
+Fixed-window request counters keyed by client, kept in memory. Each worker
+process counts on its own, so with N workers a client can make up to N times
+the limit; that is enough to stop one client from hoarding stock or hammering
+an unauthenticated endpoint. At most max_keys clients are tracked, least
+recently seen first out.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+class RateLimiter:
+    def __init__(self, limit: int, window_seconds: float, max_keys: int = 10000):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._windows: "OrderedDict[str, Tuple[float, int]]" = OrderedDict()  # key -> (window start, requests)
+        self._lock = threading.Lock()
+
+    def hit(self, key: str) -> Optional[float]:
+        """Count a request; returns the seconds to wait if the key is over its limit, else None"""
+        if self.limit <= 0:
+            return None  # Disabled
+        now = time.monotonic()
+        with self._lock:
+            started, count = self._windows.get(key, (now, 0))
+            if now - started >= self.window_seconds:
+                started, count = now, 0
+            if count >= self.limit:
+                self._windows.move_to_end(key)
+                return started + self.window_seconds - now
+            self._windows[key] = (started, count + 1)
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        return None
@@ -0,0 +1,69 @@
+"""
+Token Versions
+Admin access tokens carry the user's token_version ("ver" claim). Bumping the
+version in the database (logout, role, email or password change) revokes
+every token issued before. Versions are served from an in-memory map of
+user id -> version, reloaded every TOKEN_VERSION_REFRESH_SECONDS, so checking
+a token needs no database query; users not in the map yet (created after the
+last reload) are looked up once.
+"""
+
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+from .. import crud
+from ..database import SessionLocal
+from .background import PeriodicWorker
+
+logger = logging.getLogger(__name__)
+
+TOKEN_VERSION_REFRESH_SECONDS = float(os.getenv("TOKEN_VERSION_REFRESH_SECONDS", 30))
+
+class TokenVersionCache:
+    def __init__(self):
+        self._versions: Dict[int, Optional[int]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        db = SessionLocal()
+        try:
+            versions = crud.get_user_token_versions(db)
+        finally:
+            db.close()
+        with self._lock:
+            # Versions only grow: keep a newer local bump over a snapshot read before it committed
+            self._versions = {
+                user_id: max(version, self._versions.get(user_id) or 0)
+                for user_id, version in versions.items()
+            }
+            self._loaded = True
+
+    def current(self, user_id: int) -> Optional[int]:
+        """The user's token version, or None if the user no longer exists"""
+        if not self._loaded:
+            self.refresh()
+        with self._lock:
+            if user_id in self._versions:
+                return self._versions[user_id]
+        db = SessionLocal()
+        try:
+            version = crud.get_user_token_version(db, user_id)
+        finally:
+            db.close()
+        with self._lock:
+            self._versions[user_id] = version
+        return version
+
+    def set(self, user_id: int, version: Optional[int]):
+        """Record a version bump (None: user deleted) made by this process without waiting for the next refresh"""
+        with self._lock:
+            self._versions[user_id] = version
+
+token_versions = TokenVersionCache()
+
+token_version_refresher = PeriodicWorker(
+    "token-version-refresh", TOKEN_VERSION_REFRESH_SECONDS, token_versions.refresh
+)
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useForm } from 'react-hook-form';
 import { storeAPI } from '../services/api';
 import LoadingSpinner from './LoadingSpinner';
@@ -9,6 +9,11 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
   const [orderResult, setOrderResult] = useState(null);
+  // One key per order attempt; the retry button resends it so the server
+  // can replay the original result instead of charging twice
+  const idempotencyKeyRef = useRef(null);
+  // Stock held for this checkout; released if the shopper leaves without ordering
+  const holdTokenRef = useRef(null);
 
   // Prevent background scroll when modal is open
   useEffect(() => {
@@ -24,6 +29,16 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
     };
   }, []);
 
+  // Release any inventory hold when checkout closes without an order
+  useEffect(() => {
+    return () => {
+      if (holdTokenRef.current) {
+        storeAPI.releaseInventoryHold(tenantDomain, holdTokenRef.current).catch(() => {});
+        holdTokenRef.current = null;
+      }
+    };
+  }, [tenantDomain]);
+
   const shippingForm = useForm({
     defaultValues: isAuthenticated && customer ? {
       first_name: customer.first_name || '',
@@ -54,8 +69,41 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
     return cart.reduce((total, item) => total + (item.price * item.quantity), 0);
   };
 
-  const handleShippingSubmit = (data) => {
-    setStep(2);
+  const handleShippingSubmit = async (data) => {
+    try {
+      setLoading(true);
+      setError('');
+      // Hold the cart's stock while the shopper enters payment details
+      const response = await storeAPI.holdInventory(
+        tenantDomain,
+        cart.map(item => ({ product_id: item.id, quantity: item.quantity })),
+        holdTokenRef.current
+      );
+      holdTokenRef.current = response.data.hold_token;
+      setStep(2);
+    } catch (err) {
+      if (err.response?.status === 409) {
+        setError(err.response.data?.detail || 'Some items in your cart are no longer available.');
+      } else {
+        // Holds are best effort; stock is still checked when the order is placed
+        setStep(2);
+      }
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  const generateIdempotencyKey = () => {
+    if (window.crypto?.randomUUID) {
+      return window.crypto.randomUUID();
+    }
+    return `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  };
+
+  const handlePaymentFormSubmit = (paymentData) => {
+    // A fresh submission (possibly with edited details) is a new order attempt
+    idempotencyKeyRef.current = generateIdempotencyKey();
+    return handlePaymentSubmit(paymentData);
   };
 
   const handlePaymentSubmit = async (paymentData, retryCount = 0) => {
@@ -63,6 +111,11 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
       setLoading(true);
       setError('');
 
+      if (!idempotencyKeyRef.current) {
+        idempotencyKeyRef.current = generateIdempotencyKey();
+      }
+      const idempotencyKey = idempotencyKeyRef.current;
+
       // Check if we're online
       if (!navigator.onLine) {
         throw new Error('No internet connection. Please check your network and try again.');
@@ -97,6 +150,7 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
           product_id: item.id,
           quantity: item.quantity
         })),
+        hold_token: holdTokenRef.current,
         shipping_address: {
           address_line1: shippingData.address_line1,
           address_line2: shippingData.address_line2 || '',
@@ -126,7 +180,7 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
       if (isAuthenticated) {
         // Authenticated customer order
         try {
-          response = await storeAPI.createOrder(tenantDomain, orderData);
+          response = await storeAPI.createOrder(tenantDomain, orderData, idempotencyKey);
         } catch (authError) {
           // If authentication fails, fall back to guest order
           console.warn('Authenticated order failed, falling back to guest order:', authError);
@@ -137,7 +191,7 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
             last_name: customer.last_name || shippingData.last_name,
             phone: customer.phone || shippingData.phone
           };
-          response = await storeAPI.createGuestOrder(tenantDomain, orderData, customerInfo);
+          response = await storeAPI.createGuestOrder(tenantDomain, orderData, customerInfo, idempotencyKey);
         }
       } else {
         // Guest order
@@ -148,15 +202,23 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
           last_name: shippingData.last_name,
           phone: shippingData.phone
         };
-        response = await storeAPI.createGuestOrder(tenantDomain, orderData, customerInfo);
+        response = await storeAPI.createGuestOrder(tenantDomain, orderData, customerInfo, idempotencyKey);
       }
       
       setOrderResult(response.data);
       setStep(3);
+      idempotencyKeyRef.current = null;
+      holdTokenRef.current = null; // Converted into the order's stock decrement
       
       // Clear cart immediately after successful order
       onComplete();
     } catch (err) {
+      // The same order is still being processed: ask again with the same key once it's done
+      if (err.response?.status === 409 && idempotencyKeyRef.current && retryCount < 10) {
+        const retryAfter = parseInt(err.response.headers?.['retry-after'] || '1', 10);
+        await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        return handlePaymentSubmit(paymentData, retryCount + 1);
+      }
       console.error('Order submission error:', err);
       console.error('Error response:', err.response);
       
@@ -572,7 +634,7 @@ const Checkout = ({ cart, tenantDomain, customer, isAuthenticated, onClose, onCo
 
           {/* Step 2: Payment Information */}
           {step === 2 && (
-            <form onSubmit={paymentForm.handleSubmit(handlePaymentSubmit)}>
+            <form onSubmit={paymentForm.handleSubmit(handlePaymentFormSubmit)}>
               <h4 style={{ marginBottom: '1rem', color: 'var(--text-primary)' }}>Payment Information</h4>
               
               {/* Test Cards */}
@@ -34,6 +34,17 @@ const OrdersManagement = () => {
     }
   }, [currentPage]);
 
+  // Refresh the first page when the server pushes an order event
+  useEffect(() => {
+    const source = ordersAPI.subscribeToEvents(() => {
+      if (currentPage === 1) {
+        fetchOrders(true);
+      }
+      fetchOrdersCount();
+    });
+    return () => source.close();
+  }, [currentPage, statusFilter, searchQuery, dateFilter]);
+
   const fetchOrders = async (resetOrders = true) => {
     try {
       const loadingState = currentPage === 1 || resetOrders;
@@ -21,8 +21,9 @@ const ProfileSettings = () => {
             setMessage('');
 
             await profileAPI.updatePassword(data.oldPassword, data.newPassword);
-            setMessage('Password updated successfully!');
-            passwordForm.reset();
+            // Changing the password revokes existing sessions, including this one
+            alert('Password updated successfully! Please sign in again with your new password.');
+            logout();
         } catch (err) {
             setError(err.response?.data?.detail || 'Failed to update password');
         } finally {
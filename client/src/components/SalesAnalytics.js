@@ -21,6 +21,16 @@ const SalesAnalytics = () => {
     { value: 365, label: 'Last year' }
   ];
 
+  const timeZone = Intl.DateTimeFormat().resolvedOptions().timeZone || 'UTC';
+
+  // Keep charts to a few dozen points: weekly buckets for a quarter, monthly for a year
+  const trendGranularity = (days) => {
+    if (days <= 2) return 'hour';
+    if (days <= 31) return 'day';
+    if (days <= 120) return 'week';
+    return 'month';
+  };
+
   const fetchAnalyticsData = async (days = 30, categoryId = null) => {
     try {
       setLoading(true);
@@ -34,7 +44,7 @@ const SalesAnalytics = () => {
       console.log('Overview data:', overview);
 
       // Fetch revenue trend
-      const trendResponse = await ordersAPI.getRevenueTrend(days, categoryId);
+      const trendResponse = await ordersAPI.getRevenueTrend(days, categoryId, trendGranularity(days), timeZone);
       const trend = trendResponse.data;
       console.log('Trend data:', trend);
 
@@ -127,7 +137,9 @@ const SalesAnalytics = () => {
   };
 
   const formatDate = (dateString) => {
-    return new Date(dateString).toLocaleDateString('en-US', {
+    // Trend buckets are local dates/times; date-only strings would otherwise parse as UTC
+    const date = new Date(dateString.includes('T') ? dateString : `${dateString}T00:00:00`);
+    return date.toLocaleDateString('en-US', {
       month: 'short',
       day: 'numeric'
     });
@@ -146,7 +158,7 @@ const SalesAnalytics = () => {
   };
 
   const renderLineChart = () => {
-    if (!revenueTrend || revenueTrend.length === 0) {
+    if (!revenueTrend || revenueTrend.every(d => d.order_count === 0)) {
       return <p style={{ textAlign: 'center', color: 'var(--text-secondary)' }}>No revenue data available</p>;;
     }
 
@@ -436,6 +448,28 @@ const SalesAnalytics = () => {
             per order average
           </p>
         </div>
+
+        {/* Unique Customers (estimated, not available per category) */}
+        {analyticsData?.unique_customers != null && (
+          <div style={{
+            padding: '1.5rem',
+            backgroundColor: 'var(--bg-elevated)',
+            borderRadius: '8px',
+            boxShadow: 'var(--shadow-md)',
+            border: '1px solid var(--border-primary)'
+          }}>
+            <div style={{ display: 'flex', alignItems: 'center', marginBottom: '0.5rem' }}>
+              <span style={{ fontSize: '1.5rem', marginRight: '0.5rem' }}>👥</span>
+              <h4 style={{ margin: 0, color: 'var(--text-secondary)' }}>Unique Customers</h4>
+            </div>
+            <p style={{ fontSize: '2rem', fontWeight: 'bold', margin: '0.5rem 0', color: 'var(--color-primary)' }}>
+              ~{analyticsData.unique_customers}
+            </p>
+            <p style={{ margin: 0, fontSize: '0.9rem', color: 'var(--text-secondary)' }}>
+              {(analyticsData.repeat_rate * 100).toFixed(1)}% repeat orders
+            </p>
+          </div>
+        )}
       </div>
 
       <div style={{ display: 'grid', gridTemplateColumns: '1fr 1fr', gap: '2rem', marginBottom: '2rem' }}>
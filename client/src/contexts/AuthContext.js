@@ -109,6 +109,9 @@ export const AuthProvider = ({ children }) => {
 
   const logout = () => {
     if (typeof window !== 'undefined' && window.localStorage) {
+      // Best effort: the token is dropped locally either way
+      const token = localStorage.getItem('access_token');
+      if (token) authAPI.logout(token).catch(() => {});
       localStorage.removeItem('access_token');
     }
     setUser(null);
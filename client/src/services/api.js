@@ -126,7 +126,13 @@ export const authAPI = {
       tenant_domain: tenantDomain
     });
     return response.data;
-  }
+  },
+
+  // Revokes every token issued to the user; the token is passed explicitly
+  // because it is removed from storage before the request interceptor runs
+  logout: (token) => api.post('/auth/logout', null, {
+    headers: { 'X-Auth-Token': token, Authorization: `Bearer ${token}` }
+  })
 };
 
 // Products API
@@ -234,22 +240,78 @@ export const ordersAPI = {
   },
   getById: (id) => api.get(`/orders/${id}`),
   updateStatus: (id, status) => api.put(`/orders/${id}/status`, { status }),
+  // Columnar export (table: orders | order_items | products, format: parquet | arrow)
+  exportData: (table = 'orders', format = 'parquet', dateFrom = null, dateTo = null) => {
+    const params = new URLSearchParams({ table, format });
+    if (dateFrom) params.append('date_from', dateFrom);
+    if (dateTo) params.append('date_to', dateTo);
+    return api.get(`/orders/export?${params.toString()}`, { responseType: 'blob', timeout: 0 });
+  },
+  updateStatusBatch: (orderIds, status) =>
+    api.post('/orders/status:batch', { order_ids: orderIds, status }),
+  // Live order events (Server-Sent Events). EventSource cannot send headers, so a
+  // short-lived stream ticket goes in the query string rather than the access token.
+  // Returns a handle; call close() when done.
+  subscribeToEvents: (onEvent) => {
+    let source = null;
+    let retryTimer = null;
+    let closed = false;
+    const reconnectLater = () => {
+      if (!closed) retryTimer = setTimeout(connect, 3000);
+    };
+    const connect = async () => {
+      try {
+        const response = await api.post('/orders/stream-ticket');
+        if (closed) return;
+        source = new EventSource(`${getApiBaseUrl()}/orders/stream?ticket=${encodeURIComponent(response.data.ticket)}`);
+        ['order.created', 'order.confirmed', 'order.payment_failed', 'order.status_changed'].forEach(type => {
+          source.addEventListener(type, (event) => onEvent(type, JSON.parse(event.data)));
+        });
+        // The browser retries a dropped stream with the same URL, which fails for
+        // good once the ticket has expired; start over with a fresh ticket then
+        source.onerror = () => {
+          if (source.readyState === EventSource.CLOSED) reconnectLater();
+        };
+      } catch (error) {
+        reconnectLater();
+      }
+    };
+    connect();
+    return {
+      close: () => {
+        closed = true;
+        clearTimeout(retryTimer);
+        if (source) source.close();
+      }
+    };
+  },
   // Analytics endpoints
   getAnalyticsOverview: (days = 30, categoryId = null) => {
     const params = new URLSearchParams({ days: days.toString() });
     if (categoryId) params.append('category_id', categoryId.toString());
     return api.get(`/orders/analytics/overview?${params.toString()}`);
   },
-  getRevenueTrend: (days = 30, categoryId = null) => {
-    const params = new URLSearchParams({ days: days.toString() });
+  getRevenueTrend: (days = 30, categoryId = null, granularity = 'day', tz = 'UTC') => {
+    const params = new URLSearchParams({ days: days.toString(), granularity, tz });
     if (categoryId) params.append('category_id', categoryId.toString());
     return api.get(`/orders/analytics/revenue-trend?${params.toString()}`);
   },
-  getTopProducts: (days = 30, limit = 10, categoryId = null) => {
-    const params = new URLSearchParams({ days: days.toString(), limit: limit.toString() });
+  getTopProducts: (days = 30, limit = 10, categoryId = null, rankBy = 'revenue', allTime = false) => {
+    const params = new URLSearchParams({ days: days.toString(), limit: limit.toString(), rank_by: rankBy });
     if (categoryId) params.append('category_id', categoryId.toString());
+    if (allTime) params.append('all_time', 'true');
     return api.get(`/orders/analytics/top-products?${params.toString()}`);
-  }
+  },
+  getUniqueCustomers: (days = 30, granularity = 'day') => {
+    const params = new URLSearchParams({ days: days.toString(), granularity });
+    return api.get(`/orders/analytics/unique-customers?${params.toString()}`);
+  },
+  getCustomerSegments: (segment = null, skip = 0, limit = 50) => {
+    const params = new URLSearchParams({ skip: skip.toString(), limit: limit.toString() });
+    if (segment) params.append('segment', segment);
+    return api.get(`/orders/analytics/customers?${params.toString()}`);
+  },
+  refreshCustomerSegments: () => api.post('/orders/analytics/customers/refresh')
 };
 
 // Payment API
@@ -268,13 +330,26 @@ export const storeAPI = {
     api.get(`/store/${tenantDomain}/products/${productId}`),
   getCategories: (tenantDomain) =>
     api.get(`/store/${tenantDomain}/categories`),
-  createOrder: async (tenantDomain, orderData) => {
+  quoteCart: (tenantDomain, items, holdToken = null) =>
+    api.post(`/store/${tenantDomain}/cart/quote`, {
+      items: items.map(item => ({ product_id: item.product_id, quantity: item.quantity })),
+      hold_token: holdToken
+    }),
+  holdInventory: (tenantDomain, items, holdToken = null) =>
+    api.post(`/store/${tenantDomain}/checkout/holds`, {
+      items: items.map(item => ({ product_id: item.product_id, quantity: item.quantity })),
+      hold_token: holdToken
+    }),
+  releaseInventoryHold: (tenantDomain, holdToken) =>
+    api.delete(`/store/${tenantDomain}/checkout/holds/${holdToken}`),
+  createOrder: async (tenantDomain, orderData, idempotencyKey = null) => {
     const token = localStorage.getItem(`customer_token_${tenantDomain}`);
     try {
       return await api.post(`/store/${tenantDomain}/orders`, orderData, {
         headers: {
           'Authorization': `Bearer ${token}`,
-          'Content-Type': 'application/json'
+          'Content-Type': 'application/json',
+          ...(idempotencyKey && { 'Idempotency-Key': idempotencyKey })
         },
         timeout: 30000 // 30 second timeout
       });
@@ -295,13 +370,16 @@ export const storeAPI = {
       throw error;
     }
   },
-  createGuestOrder: async (tenantDomain, orderData, customerInfo) => {
+  createGuestOrder: async (tenantDomain, orderData, customerInfo, idempotencyKey = null) => {
     try {
       return await api.post(`/store/${tenantDomain}/orders/guest`, {
         ...orderData,
         customer_info: customerInfo
       }, {
-        headers: { 'Content-Type': 'application/json' },
+        headers: {
+          'Content-Type': 'application/json',
+          ...(idempotencyKey && { 'Idempotency-Key': idempotencyKey })
+        },
         timeout: 30000 // 30 second timeout
       });
     } catch (error) {